@@ -0,0 +1,110 @@
+"""Benchmarks of the JSON codecs on the bus and API payloads, and of the
+msgpack codec and compressions of the bus"""
+from datetime import datetime
+from typing import List
+
+from rating_engine.schema import engine as schema
+from rating_engine.services import codec as codec_service
+from rating_engine.services.rater import UTC
+
+from harness import Benchmark
+from stand_in import get_account
+
+
+def get_account_response(running_transactions: int = 20) -> bytes:
+    """Account look-up response body, as sent by the API"""
+    accounts = [
+        dict(
+            account,
+            destination_rate=dict(
+                carrier_tag='CARRIER',
+                pricelist_tag='DEFAULT',
+                prefix='39',
+                description='Italy',
+                connect_fee=10,
+                rate=100,
+                rate_increment=60,
+                interval_start=0,
+            ),
+            running_transactions=[
+                dict(transaction, destination_rate=None)
+                for transaction in account['running_transactions']
+            ],
+        )
+        for account in (
+            get_account('1000', running_transactions=running_transactions),
+            get_account('9000'),
+        )
+    ]
+    return codec_service.JsonCodec().dumps(
+        {'data': {'Account': accounts[0], 'DestinationAccount': accounts[1]}}
+    )
+
+
+def get_benchmarks() -> List[Benchmark]:
+    request = schema.AuthorizationTransactionRequest(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        account_tags=['BENCHMARK'],
+        destination_account_tag='9000',
+        destination_account_tags=['BENCHMARK'],
+        source='100',
+        source_ip='127.0.0.1',
+        destination='393291234567',
+        carrier_ip='127.0.0.1',
+        tags=['BENCHMARK'],
+        timestamp_auth=UTC.localize(datetime.utcnow()),
+        authorized=True,
+        authorized_destination=True,
+        balance=100000,
+        carriers=['UDP:carrier.example.com:5060'],
+        max_available_units=3600,
+    )
+    kwargs = dict(request=request.dict())
+    response = get_account_response()
+    benchmarks = []
+    for name, codec_class in codec_service.get_available_codecs().items():
+        codec = codec_class()
+
+        def serialize(codec=codec):
+            codec.dumps(kwargs)
+
+        def decode_account(codec=codec):
+            codec.loads(response)
+
+        benchmarks.extend(
+            [
+                Benchmark('codec.%s.authorization_transaction' % name, serialize),
+                Benchmark('codec.%s.account_response' % name, decode_account),
+            ]
+        )
+    if codec_service.msgpack is not None:
+        msgpack_codec = codec_service.MsgpackCodec()
+        data = msgpack_codec.dumps(kwargs)
+
+        def serialize_msgpack():
+            msgpack_codec.dumps(kwargs)
+
+        def deserialize_msgpack():
+            msgpack_codec.loads(data)
+
+        benchmarks.extend(
+            [
+                Benchmark('codec.msgpack.authorization_transaction', serialize_msgpack),
+                Benchmark(
+                    'codec.msgpack.authorization_transaction[loads]',
+                    deserialize_msgpack,
+                ),
+            ]
+        )
+    batch = codec_service.JsonCodec().dumps(dict(request=[kwargs['request']] * 100))
+    for encoding in codec_service.get_available_compressions():
+
+        def compress(encoding=encoding):
+            codec_service.compress(batch, encoding)
+
+        benchmarks.append(
+            Benchmark('codec.%s.authorization_transactions' % encoding, compress)
+        )
+    return benchmarks
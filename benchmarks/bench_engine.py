@@ -0,0 +1,67 @@
+"""Benchmarks of EngineService against the in-memory API stand-in"""
+from collections import deque
+from itertools import count
+from typing import List
+
+from conftest import MockedBus
+from rating_engine.schema import engine as schema
+from rating_engine.services.engine import EngineService
+
+from harness import Benchmark
+from stand_in import InMemoryAPIService, get_account
+
+
+def get_engine(running_transactions: int = 50) -> EngineService:
+    api = InMemoryAPIService()
+    api.add_account(
+        get_account('1000', running_transactions=running_transactions),
+        linked=[get_account('2000'), get_account('3000')],
+    )
+    api.add_account(get_account('9000', account_type='POSTPAID'))
+    return EngineService(api, MockedBus())
+
+
+def get_benchmarks() -> List[Benchmark]:
+    engine = get_engine()
+    authorization_request = schema.AuthorizationRequest(
+        transaction_tag='100',
+        account_tag='1000',
+        destination_account_tag='9000',
+        source='100',
+        destination='393291234567',
+    )
+
+    async def authorization():
+        await engine.authorization(authorization_request.copy())
+
+    begin_engine = get_engine(running_transactions=0)
+    transaction_tags = count()
+    begun: deque = deque()
+
+    async def begin_transaction():
+        transaction_tag = str(next(transaction_tags))
+        await begin_engine.begin_transaction(
+            schema.BeginTransactionRequest(
+                transaction_tag=transaction_tag,
+                account_tag='1000',
+                destination_account_tag='9000',
+                source='100',
+                destination='393291234567',
+            )
+        )
+        begun.append(transaction_tag)
+
+    async def end_transaction():
+        await begin_engine.end_transaction(
+            schema.EndTransactionRequest(
+                transaction_tag=begun.popleft(),
+                account_tag='1000',
+                destination_account_tag='9000',
+            )
+        )
+
+    return [
+        Benchmark('engine.authorization', authorization, iterations=2000),
+        Benchmark('engine.begin_transaction', begin_transaction, iterations=2000),
+        Benchmark('engine.end_transaction', end_transaction, iterations=2000),
+    ]
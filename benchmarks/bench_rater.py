@@ -0,0 +1,100 @@
+"""Benchmarks of the RaterService hot paths"""
+from datetime import datetime, timedelta
+from typing import List
+
+from rating_engine.services.rater import (
+    RatePlan,
+    RaterService,
+    UTC,
+    _rate_columns_numpy,
+    _rate_columns_python,
+    np,
+)
+
+from harness import Benchmark
+from stand_in import DESTINATION_RATE, get_account
+
+
+def get_benchmarks() -> List[Benchmark]:
+    rater = RaterService()
+    now = UTC.localize(datetime.utcnow())
+    transaction = {
+        'timestamp_begin': now - timedelta(seconds=95),
+        'timestamp_end': now,
+        'destination_rate': DESTINATION_RATE,
+    }
+    running_transaction = {
+        'timestamp_begin': (now - timedelta(seconds=95)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'timestamp_end': None,
+        'destination_rate': DESTINATION_RATE,
+    }
+    banded_rate = RatePlan(
+        connect_fee=10,
+        rate=100,
+        rate_increment=60,
+        bands=RatePlan.from_destination_rate(
+            {'bands': [{'start': 600, 'rate': 50, 'rate_increment': 60}]}
+        ).bands,
+    )
+    running_transactions = get_account('1000', running_transactions=50)[
+        'running_transactions'
+    ]
+
+    def get_columns(size: int) -> tuple:
+        return (
+            [now.timestamp() - 95] * size,
+            [now.timestamp()] * size,
+            [10] * size,
+            [100] * size,
+            [60] * size,
+            [0] * size,
+        )
+
+    columns = get_columns(10000)
+    # both batch paths around RaterService.NUMPY_MIN_TRANSACTIONS
+    crossover = [
+        Benchmark(
+            'rater.rate_columns[%s %d]' % (name, size),
+            lambda rate=rate, batch=get_columns(size): rate(*batch),
+            iterations=2000,
+        )
+        for size in (8, 32, 64, 128)
+        for name, rate in (
+            ('python', _rate_columns_python),
+            ('numpy', _rate_columns_numpy),
+        )
+        if np is not None or name == 'python'
+    ]
+    return crossover + [
+        Benchmark(
+            'rater.get_transaction_fee_and_duration',
+            lambda: rater.get_transaction_fee_and_duration(transaction),
+        ),
+        Benchmark(
+            'rater.get_transaction_fee_and_duration[running]',
+            lambda: rater.get_transaction_fee_and_duration(running_transaction),
+        ),
+        Benchmark(
+            'rater.get_maximum_allowed_units_for_transaction',
+            lambda: rater.get_maximum_allowed_units_for_transaction(
+                100000, DESTINATION_RATE
+            ),
+        ),
+        Benchmark(
+            'rater.get_maximum_allowed_units_for_transaction[bands]',
+            lambda: rater.get_maximum_allowed_units_for_transaction(
+                100000, banded_rate
+            ),
+        ),
+        Benchmark(
+            'rater.get_transactions_fee[50 running]',
+            lambda: rater.get_transactions_fee(running_transactions),
+            iterations=1000,
+        ),
+        Benchmark(
+            'rater.get_transactions_fees_and_durations[10000]',
+            lambda: rater.get_transactions_fees_and_durations(*columns),
+            iterations=100,
+            warmup=5,
+        ),
+    ]
@@ -0,0 +1,72 @@
+"""Benchmarks of an RPC round trip through a local socket, to compare the
+event loops; the App handles the requests as when consuming the bus"""
+import asyncio
+import struct
+
+from typing import List, Optional
+
+from rating_engine.services.codec import JsonCodec
+
+from bench_app import get_app
+from harness import Benchmark
+
+
+HEADER = struct.Struct('!I')
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return await reader.readexactly(size)
+
+
+def write_frame(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+class RPCLoopback(object):
+    """Calls the App handlers through a TCP connection to the loop itself"""
+
+    def __init__(self):
+        self.app = get_app()
+        self.codec = JsonCodec()
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        handlers = {'authorization': self.app._authorization}
+        while True:
+            try:
+                request = self.codec.loads(await read_frame(reader))
+            except (asyncio.IncompleteReadError, asyncio.CancelledError):
+                break
+            response = await handlers[request['method']](**request['kwargs'])
+            write_frame(writer, self.codec.dumps(response))
+        writer.close()
+
+    async def call(self, method: str, kwargs: dict) -> dict:
+        if self.writer is None:
+            server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        write_frame(self.writer, self.codec.dumps(dict(method=method, kwargs=kwargs)))
+        return self.codec.loads(await read_frame(self.reader))
+
+
+def get_benchmarks() -> List[Benchmark]:
+    rpc = RPCLoopback()
+    request = dict(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        destination_account_tag='9000',
+        source='100',
+        destination='393291234567',
+        tags=['BENCHMARK'],
+    )
+
+    async def authorization():
+        await rpc.call('authorization', dict(request=request))
+
+    return [
+        Benchmark('rpc.authorization_round_trip', authorization, iterations=2000),
+    ]
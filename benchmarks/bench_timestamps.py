@@ -0,0 +1,86 @@
+"""Benchmarks of the timestamp decoding used when rating running transactions
+
+Rates a prepaid account with 50 running transactions, as returned by the API,
+decoding the timestamps with dateutil, with parse_timestamp and with its memo.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Callable, List
+
+from dateutil import parser
+
+from rating_engine.services import rater as rater_service
+
+from harness import Benchmark
+
+
+RUNNING_TRANSACTIONS = 50
+NUMBER = 200
+
+
+def get_account(running_transactions: int = RUNNING_TRANSACTIONS) -> dict:
+    now = datetime.utcnow()
+    destination_rate = rater_service.RatePlan(
+        carrier_tag='CARRIER',
+        pricelist_tag='DEFAULT',
+        prefix='39',
+        description='Italy',
+        connect_fee=10,
+        rate=100,
+        rate_increment=60,
+        interval_start=0,
+    )
+    return {
+        'account_tag': '1000',
+        'type': 'PREPAID',
+        'balance': 1000000,
+        'running_transactions': [
+            {
+                'transaction_tag': str(n),
+                'destination_rate': destination_rate,
+                'timestamp_begin': (now - timedelta(seconds=7 * n)).strftime(
+                    "%Y-%m-%dT%H:%M:%SZ"
+                ),
+                'timestamp_end': None,
+            }
+            for n in range(running_transactions)
+        ],
+    }
+
+
+def with_parser(parse: Callable[[str], datetime], func: Callable[[], Any]):
+    """Call func with the rater decoding the timestamps with parse"""
+
+    def run():
+        original = rater_service.parse_timestamp
+        rater_service.parse_timestamp = parse
+        try:
+            return func()
+        finally:
+            rater_service.parse_timestamp = original
+
+    return run
+
+
+def get_benchmarks() -> List[Benchmark]:
+    rater = rater_service.RaterService()
+    account = get_account()
+
+    def rate_account():
+        return rater.get_transactions_fee(account['running_transactions'])
+
+    uncached = rater_service.parse_timestamp.__wrapped__  # type: ignore
+    return [
+        Benchmark(
+            'timestamps.rate_account[dateutil]',
+            with_parser(parser.parse, rate_account),
+            iterations=NUMBER,
+        ),
+        Benchmark(
+            'timestamps.rate_account[decoder]',
+            with_parser(uncached, rate_account),
+            iterations=NUMBER,
+        ),
+        Benchmark(
+            'timestamps.rate_account[decoder+memo]', rate_account, iterations=NUMBER
+        ),
+    ]
@@ -0,0 +1,106 @@
+import asyncio
+import inspect
+
+from time import perf_counter_ns
+from typing import Any, Callable, List, NamedTuple, Optional
+
+
+class Benchmark(NamedTuple):
+    """A named operation to time; func may be a coroutine function"""
+
+    name: str
+    func: Callable[[], Any]
+    iterations: int = 10000
+    warmup: int = 100
+
+
+class Result(NamedTuple):
+    name: str
+    iterations: int
+    ops_per_sec: float
+    mean_us: float
+    p50_us: float
+    p99_us: float
+
+    @classmethod
+    def from_timings(cls, name: str, timings: List[int]) -> 'Result':
+        timings = sorted(timings)
+        total = sum(timings)
+        return cls(
+            name=name,
+            iterations=len(timings),
+            ops_per_sec=round(len(timings) / total * 1e9, 1) if total else 0.0,
+            mean_us=round(total / len(timings) / 1e3, 3),
+            p50_us=round(percentile(timings, 50) / 1e3, 3),
+            p99_us=round(percentile(timings, 99) / 1e3, 3),
+        )
+
+
+def percentile(sorted_values: List[int], percent: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values))))
+    return sorted_values[max(0, index)]
+
+
+def measure(benchmark: Benchmark, iterations: Optional[int] = None) -> Result:
+    iterations = iterations or benchmark.iterations
+    func = benchmark.func
+    timings = []
+    for n in range(benchmark.warmup + iterations):
+        start = perf_counter_ns()
+        func()
+        if n >= benchmark.warmup:
+            timings.append(perf_counter_ns() - start)
+    return Result.from_timings(benchmark.name, timings)
+
+
+async def measure_async(
+    benchmark: Benchmark, iterations: Optional[int] = None
+) -> Result:
+    iterations = iterations or benchmark.iterations
+    func = benchmark.func
+    timings = []
+    for n in range(benchmark.warmup + iterations):
+        start = perf_counter_ns()
+        await func()
+        if n >= benchmark.warmup:
+            timings.append(perf_counter_ns() - start)
+    return Result.from_timings(benchmark.name, timings)
+
+
+def run(
+    benchmarks: List[Benchmark],
+    iterations: Optional[int] = None,
+    loop: Optional[asyncio.AbstractEventLoop] = None,
+) -> List[Result]:
+    loop = loop or asyncio.new_event_loop()
+    results = []
+    for benchmark in benchmarks:
+        if inspect.iscoroutinefunction(benchmark.func):
+            result = loop.run_until_complete(measure_async(benchmark, iterations))
+        else:
+            result = measure(benchmark, iterations)
+        results.append(result)
+    return results
+
+
+def compare(
+    results: List[dict], baseline: List[dict], threshold: float
+) -> List[dict]:
+    """Results whose throughput dropped by more than threshold (0.1 = 10%)"""
+    baseline_by_name = {result['name']: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_name.get(result['name'])
+        if previous is None or not previous['ops_per_sec']:
+            continue
+        change = result['ops_per_sec'] / previous['ops_per_sec'] - 1
+        if change < -threshold:
+            regressions.append(
+                dict(
+                    name=result['name'],
+                    ops_per_sec=result['ops_per_sec'],
+                    baseline_ops_per_sec=previous['ops_per_sec'],
+                    change=round(change, 3),
+                )
+            )
+    return regressions
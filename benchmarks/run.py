@@ -0,0 +1,104 @@
+"""Run the rating engine benchmarks, no services needed
+
+    python benchmarks/run.py [--output results.json] [--baseline previous.json]
+    python benchmarks/run.py --suite rpc --loop asyncio --loop uvloop
+
+Results are written as JSON with ops/sec and mean, p50 and p99 latency in
+microseconds for every benchmark. With --baseline the exit status is 1 when
+a benchmark throughput dropped more than --threshold from the baseline.
+"""
+import asyncio
+import json
+import os
+import platform
+import sys
+
+from datetime import datetime
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_app  # noqa: E402
+import bench_codec  # noqa: E402
+import bench_engine  # noqa: E402
+import bench_rater  # noqa: E402
+import bench_rpc  # noqa: E402
+import bench_timestamps  # noqa: E402
+import harness  # noqa: E402
+
+from rating_engine.app import LOOPS, set_event_loop_policy  # noqa: E402
+from rating_engine.services import rater  # noqa: E402
+
+
+SUITES = {
+    'rater': bench_rater,
+    'engine': bench_engine,
+    'app': bench_app,
+    'codec': bench_codec,
+    'rpc': bench_rpc,
+    'timestamps': bench_timestamps,
+}
+
+
+def new_event_loop(name: str) -> asyncio.AbstractEventLoop:
+    if set_event_loop_policy(name) != name:
+        raise click.UsageError("%s is not installed" % name)
+    return asyncio.new_event_loop()
+
+
+@click.command()
+@click.option('--output', type=click.File('w'), default='-', show_default=True)
+@click.option('--baseline', type=click.File('r'), default=None)
+@click.option('--threshold', type=click.FLOAT, default=0.1, show_default=True)
+@click.option('--iterations', type=click.INT, default=None)
+@click.option('--suite', type=click.Choice(sorted(SUITES)), multiple=True)
+@click.option('--filter', 'name_filter', type=click.STRING, default=None)
+@click.option(
+    '--loop',
+    'loops',
+    type=click.Choice(LOOPS),
+    multiple=True,
+    help='Event loops to run the benchmarks on, suffixed [loop] when several',
+)
+def main(output, baseline, threshold, iterations, suite, name_filter, loops):
+    results = []
+    for loop_name in loops or ('asyncio',):
+        loop = new_event_loop(loop_name)
+        # built for every loop, some hold connections bound to it
+        benchmarks = []
+        for name in suite or SUITES:
+            benchmarks.extend(SUITES[name].get_benchmarks())
+        if name_filter:
+            benchmarks = [b for b in benchmarks if name_filter in b.name]
+        for result in harness.run(benchmarks, iterations=iterations, loop=loop):
+            if len(loops) > 1:
+                result = result._replace(name='%s[%s]' % (result.name, loop_name))
+            results.append(result._asdict())
+        # stop what the benchmarks left running, e.g. servers
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+    report = dict(
+        timestamp=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        numpy=rater.np is not None,
+        loops=list(loops or ('asyncio',)),
+        results=results,
+    )
+    if baseline is not None:
+        report['regressions'] = harness.compare(
+            results, json.load(baseline)['results'], threshold
+        )
+    json.dump(report, output, indent=2)
+    output.write('\n')
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
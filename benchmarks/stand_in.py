@@ -0,0 +1,220 @@
+"""In-memory stand-in for the rating API, to benchmark the engine without services"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from rating_engine.services.rater import RatePlan, UTC
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+DESTINATION_RATE = RatePlan(
+    carrier_tag='CARRIER',
+    pricelist_tag='DEFAULT',
+    prefix='39',
+    description='Italy',
+    connect_fee=10,
+    rate=100,
+    rate_increment=60,
+    interval_start=0,
+)
+
+
+def _dumps_timestamp(value: Optional[datetime]) -> Optional[str]:
+    return value.astimezone(UTC).strftime(TIMESTAMP_FORMAT) if value else None
+
+
+def get_account(
+    account_tag: str,
+    running_transactions: int = 0,
+    account_type: str = 'PREPAID',
+    balance: int = 100000000,
+) -> dict:
+    now = datetime.utcnow()
+    return {
+        'account_tag': account_tag,
+        'type': account_type,
+        'name': account_tag,
+        'balance': balance,
+        'active': True,
+        'notification_email': None,
+        'notification_mobile': None,
+        'max_concurrent_transactions': None,
+        'max_inbound_transactions': None,
+        'max_outbound_transactions': None,
+        'running_transactions': [
+            {
+                'destination_rate': DESTINATION_RATE,
+                'transaction_tag': 'running-%d' % n,
+                'source': '100',
+                'source_ip': '127.0.0.1',
+                'carrier_ip': '127.0.0.1',
+                'destination': '393291234567',
+                'tags': [],
+                'in_progress': True,
+                'inbound': False,
+                'timestamp_begin': (now - timedelta(seconds=7 * n)).strftime(
+                    TIMESTAMP_FORMAT
+                ),
+                'timestamp_end': None,
+            }
+            for n in range(running_transactions)
+        ],
+        'carrier_tags': ['CARRIER'],
+        'carrier_tags_override': None,
+        'destination_rate': DESTINATION_RATE,
+        'least_cost_routing': [
+            {'host': 'carrier.example.com', 'port': 5060, 'protocol': 'UDP'}
+        ],
+        'linked_accounts': [],
+        'pricelist_tags': ['DEFAULT'],
+        'tags': ['BENCHMARK'],
+    }
+
+
+class InMemoryAPIService(object):
+    """Implements the APIService methods used by EngineService"""
+
+    _accounts: Dict[Tuple[str, str], dict]
+    _transactions: List[dict]
+
+    batch_mutations = False
+
+    def __init__(self):
+        self._accounts = {}
+        self._transactions = []
+
+    def add_account(self, account: dict, tenant: str = 'default', linked=()):
+        account = dict(account, linked_accounts=[a['account_tag'] for a in linked])
+        self._accounts[(tenant, account['account_tag'])] = account
+        for linked_account in linked:
+            self.add_account(linked_account, tenant)
+
+    def _get_account(
+        self, tenant: str, account_tag: Optional[str], linked: bool = True
+    ) -> Optional[dict]:
+        account = self._accounts.get((tenant, account_tag))
+        if account is None:
+            return None
+        return dict(
+            account,
+            running_transactions=list(account['running_transactions']),
+            linked_accounts=[
+                self._get_account(tenant, linked_account_tag, linked=False)
+                for linked_account_tag in account['linked_accounts']
+            ]
+            if linked
+            else [],
+        )
+
+    async def close(self):
+        pass
+
+    async def get_account_and_destination_account_by_id(
+        self,
+        tenant: str,
+        account_tag: Optional[str] = None,
+        destination: Optional[str] = None,
+        destination_account_tag: Optional[str] = None,
+        **kw,
+    ) -> Tuple[Optional[dict], Optional[dict]]:
+        return (
+            self._get_account(tenant, account_tag),
+            self._get_account(tenant, destination_account_tag),
+        )
+
+    async def begin_account_transaction(
+        self,
+        tenant: str,
+        account_tag: str,
+        destination_rate: Optional[RatePlan],
+        transaction_tag: str,
+        source: Optional[str],
+        source_ip: Optional[str],
+        destination: Optional[str],
+        carrier_ip: Optional[str],
+        timestamp_begin: datetime,
+        primary: bool = False,
+        inbound: bool = False,
+    ) -> Optional[dict]:
+        transaction = {
+            'destination_rate': destination_rate,
+            'transaction_tag': transaction_tag,
+            'source': source,
+            'source_ip': source_ip,
+            'carrier_ip': carrier_ip,
+            'destination': destination,
+            'tags': [],
+            'in_progress': True,
+            'inbound': inbound,
+            'primary': primary,
+            'timestamp_begin': _dumps_timestamp(timestamp_begin),
+            'timestamp_end': None,
+        }
+        self._accounts[(tenant, account_tag)]['running_transactions'].append(
+            transaction
+        )
+        return dict(transaction)
+
+    async def rollback_account_transaction(
+        self, tenant: str, account_tag: Optional[str], transaction_tag: str,
+    ) -> Optional[bool]:
+        account = self._accounts[(tenant, account_tag)]
+        account['running_transactions'] = [
+            transaction
+            for transaction in account['running_transactions']
+            if transaction['transaction_tag'] != transaction_tag
+        ]
+        return True
+
+    async def end_account_transaction(
+        self,
+        tenant: str,
+        account_tag: str,
+        transaction_tag: str,
+        timestamp_end: datetime,
+    ) -> Optional[dict]:
+        account = self._accounts[(tenant, account_tag)]
+        for transaction in account['running_transactions']:
+            if transaction['transaction_tag'] == transaction_tag:
+                transaction['timestamp_end'] = _dumps_timestamp(timestamp_end)
+                transaction['in_progress'] = False
+                return dict(transaction)
+        return None
+
+    async def get_primary_transactions_by_tenant_and_tag(
+        self, tenant: str, transaction_tag: str,
+    ) -> List[dict]:
+        return [
+            transaction
+            for transaction in self._transactions
+            if transaction['tenant'] == tenant
+            and transaction['transaction_tag'] == transaction_tag
+            and transaction.get('primary')
+        ]
+
+    async def upsert_transaction(
+        self,
+        tenant: str,
+        account_tag: str,
+        transaction: dict,
+        duration: int = 0,
+        fee: int = 0,
+    ) -> Optional[bool]:
+        return True
+
+    async def upsert_authorization_transaction(
+        self, tenant: str, account_tag: str, transaction: dict
+    ) -> Optional[bool]:
+        return True
+
+    async def commit_account_transaction(
+        self, tenant: str, account_tag: str, transaction_tag: str, fee: int
+    ) -> Optional[bool]:
+        account = self._accounts[(tenant, account_tag)]
+        account['balance'] -= fee
+        account['running_transactions'] = [
+            transaction
+            for transaction in account['running_transactions']
+            if transaction['transaction_tag'] != transaction_tag
+        ]
+        return True
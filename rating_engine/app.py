@@ -1,16 +1,40 @@
 import asyncio
 import logging
 import os
+import signal
 import sys
+import threading
 
 from functools import wraps
 from pydantic import ValidationError
+from typing import List, Optional
 
 from .enums import MethodName
 from .schema import engine as schema
 from .services import api as api_service
 from .services import bus as bus_service
+from .services import cache as cache_service
+from .services import codec as codec_service
 from .services import engine as engine_service
+from .services import rater as rater_service
+
+try:
+    import uvloop  # type: ignore
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+
+LOOPS = ('asyncio', 'uvloop')
+
+
+def set_event_loop_policy(name: str = 'asyncio') -> str:
+    """Install the policy of the named event loop, before the first loop is
+    created; the asyncio one is kept when uvloop is not installed"""
+    if name == 'uvloop' and uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return 'uvloop'
+    asyncio.set_event_loop_policy(None)
+    return 'asyncio'
 
 
 def log_request_and_response(f):
@@ -36,13 +60,65 @@ class App(object):
 
     def __init__(self, config: dict):
         self._config = config
-        self._bus = bus_service.BusService(messagebus_uri=config["messagebus_uri"])
+        codec = codec_service.get_codec(config.get('codec') or 'json')
+        self._bus = bus_service.BusService(
+            messagebus_uri=config["messagebus_uri"],
+            codec=codec,
+            prefetch_count=config.get('prefetch_count') or 0,
+            method_concurrency=config.get('method_concurrency'),
+            channel_per_method=bool(config.get('channel_per_method')),
+            concurrency=config.get('concurrency') or 0,
+            max_priority=config.get('max_priority', bus_service.MAX_PRIORITY),
+            queue_migration=config.get('queue_migration') or 'recreate',
+            publish_window=config.get('publish_window') or 0,
+            publish_retries=config.get('publish_retries', 3),
+            publish_retry_size=config.get('publish_retry_size') or 10000,
+            publish_retry_delay=config.get('publish_retry_delay') or 1,
+            payload_format=config.get('bus_format') or 'json',
+            compression=config.get('bus_compression'),
+            compression_threshold=config.get('bus_compression_threshold') or 1024,
+        )
+        account_cache = (
+            cache_service.AccountCache(
+                ttl=config['account_cache_ttl'],
+                maxsize=config.get('account_cache_size') or 10000,
+            )
+            if config.get('account_cache_ttl')
+            else None
+        )
         api = api_service.APIService(
             api_url=config['api_url'],
             api_username=config['api_username'],
             api_password=config['api_password'],
+            account_cache=account_cache,
+            batch_mutations=bool(config.get('api_batch_mutations')),
+            lookup_window=config.get('api_lookup_window') or 0,
+            variables=bool(config.get('api_variables')),
+            persisted_queries=bool(config.get('api_persisted_queries')),
+            max_connections=config.get('api_max_connections', 100),
+            max_connections_per_host=config.get('api_max_connections_per_host', 0),
+            keepalive_timeout=config.get('api_keepalive_timeout', 15),
+            dns_cache_ttl=config.get('api_dns_cache_ttl', 10),
+            connect_timeout=config.get('api_connect_timeout') or None,
+            read_timeout=config.get('api_read_timeout') or None,
+            unix_socket=config.get('api_unix_socket'),
+            codec=codec,
+        )
+        transaction_states = (
+            cache_service.TransactionStateCache(
+                ttl=config['transaction_state_ttl'],
+                maxsize=config.get('transaction_state_size') or 100000,
+            )
+            if config.get('transaction_state_ttl')
+            else None
+        )
+        self._rating = engine_service.EngineService(
+            api,
+            self._bus,
+            transaction_states=transaction_states,
+            authorization_batch_size=config.get('authorization_batch_size') or 0,
+            authorization_batch_delay=config.get('authorization_batch_delay') or 0.2,
         )
-        self._rating = engine_service.EngineService(api, self._bus)
         self._setup_logger(config)
 
     def _setup_logger(self, config: dict):
@@ -60,17 +136,33 @@ class App(object):
         return self._config
 
     def run(self):
+        name = self._config.get('loop') or 'asyncio'
+        chosen = set_event_loop_policy(name)
+        if chosen != name:
+            self.logger.warning("%s is not installed, using %s", name, chosen)
+        self.logger.info("Event loop: %s", chosen)
         try:
             loop = asyncio.get_event_loop()
         except RuntimeError:
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
         loop.run_until_complete(self._run())
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, loop.stop)
         try:
             loop.run_forever()
         finally:  # pragma: no cover
+            loop.run_until_complete(self.close())
             loop.run_until_complete(loop.shutdown_asyncgens())
 
+    async def close(self):
+        """Flush the buffered records before closing the API and bus connections"""
+        self.logger.info("Shutting down")
+        await self._rating.close()
+        await self._rating.get_api().close()
+        await self._bus.close()
+
     async def _run(self):
         self.logger.info("Connecting to RabbitMQ: %s", self._config["messagebus_uri"])
         await self._bus.connect()
@@ -82,6 +174,10 @@ class App(object):
                 MethodName.AUTHORIZATION_TRANSACTION.value,
                 self._authorization_transaction,
             ),
+            (
+                MethodName.AUTHORIZATION_TRANSACTIONS.value,
+                self._authorization_transactions,
+            ),
             (MethodName.BEGIN_TRANSACTION.value, self._begin_transaction),
             (MethodName.ROLLBACK_TRANSACTION.value, self._rollback_transaction),
             (MethodName.END_TRANSACTION.value, self._end_transaction),
@@ -89,8 +185,46 @@ class App(object):
         ):
             self.logger.info("* %s", method)
             await self._bus.rpc_register(method, callback)
+            migration = self._bus.queue_migrations.get(method)
+            if migration == 'recreated':
+                self.logger.warning("  queue recreated with priorities")
+            elif migration == 'kept':
+                self.logger.warning("  queue kept without priorities, it is not empty")
+        stats_interval = self._config.get('stats_interval')
+        if stats_interval:
+            asyncio.ensure_future(self._log_stats(stats_interval))
         self.logger.info("Ready")
 
+    def get_stats(self) -> dict:
+        api = self._rating.get_api()
+        stats = dict(api_lookups=api.lookup_stats, api_pool=api.get_pool_stats())
+        account_cache = api.account_cache
+        if account_cache is not None:
+            stats['account_cache'] = account_cache.stats()
+        transaction_states = self._rating.transaction_states
+        if transaction_states is not None:
+            stats['transaction_states'] = transaction_states.stats()
+        if self._bus.confirms is not None:
+            stats['publish_confirms'] = self._bus.confirms.stats()
+        for method, values in self._bus.method_stats.items():
+            stats['bus[%s]' % method] = values
+        authorization_records = self._rating.authorization_records
+        if authorization_records is not None:
+            stats['authorization_records'] = authorization_records.stats()
+        rater = rater_service.RaterService
+        stats['maximum_allowed_units_memo'] = rater.get_maximum_allowed_units_stats()
+        return stats
+
+    async def _log_stats(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            for name, values in self.get_stats().items():
+                self.logger.info(
+                    "%s: %s",
+                    name,
+                    ", ".join("%s=%s" % (key, value) for key, value in values.items()),
+                )
+
     @log_request_and_response
     async def _authorization(self, request: dict) -> dict:
         try:
@@ -109,6 +243,24 @@ class App(object):
         response = await self._rating.authorization_transaction(request_obj)
         return dict(response)
 
+    @log_request_and_response
+    async def _authorization_transactions(self, request: List[dict]) -> dict:
+        request_objs = []
+        responses: List[Optional[dict]] = []
+        for item in request:
+            try:
+                request_objs.append(schema.AuthorizationTransactionRequest(**item))
+                responses.append(None)
+            except ValidationError as e:
+                responses.append({"errors": e.errors()})
+        results = iter(await self._rating.authorization_transactions(request_objs))
+        return dict(
+            responses=[
+                response if response is not None else dict(next(results))
+                for response in responses
+            ]
+        )
+
     @log_request_and_response
     async def _begin_transaction(self, request: dict) -> dict:
         try:
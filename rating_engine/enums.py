@@ -4,6 +4,7 @@ from enum import Enum
 class MethodName(Enum):
     AUTHORIZATION = "authorization"
     AUTHORIZATION_TRANSACTION = "authorization_transaction"
+    AUTHORIZATION_TRANSACTIONS = "authorization_transactions"
     BEGIN_TRANSACTION = "begin_transaction"
     END_TRANSACTION = "end_transaction"
     ROLLBACK_TRANSACTION = "rollback_transaction"
@@ -14,3 +15,18 @@ class RPCCallPriority(Enum):
     LOW = 10
     MEDIUM = 20
     HIGH = 30
+
+
+class RateBandType(Enum):
+    DURATION = "DURATION"
+    TIME_OF_DAY = "TIME_OF_DAY"
+
+
+class AccountProfile(Enum):
+    """Fields of the accounts looked up, by engine operation"""
+
+    FULL = "full"
+    AUTHORIZATION = "authorization"
+    BEGIN = "begin"
+    END = "end"
+    RECORD = "record"
@@ -0,0 +1,207 @@
+"""Offline re-rating of completed transactions with a different pricelist
+
+Transactions are read from a JSONL or CSV file, rated in chunks across a
+process pool and written out in the input order with their fee and duration.
+Only a bounded number of chunks is in flight at any time, so memory stays
+flat regardless of the size of the input.
+"""
+import csv
+import json
+import os
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import IO, Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pytz import timezone
+
+from .services.rater import RatePlan, RaterService, parse_timestamp
+
+
+FORMATS = ('jsonl', 'csv')
+
+RATED_FIELDS = ['carrier_tag', 'pricelist_tag', 'prefix', 'fee', 'duration']
+
+
+class Pricelist(object):
+    """Rate plans of a pricelist, matched by the longest destination prefix"""
+
+    _rate_plans: Dict[str, RatePlan]
+
+    def __init__(self, destination_rates: Iterable[dict]):
+        self._rate_plans = {}
+        for destination_rate in destination_rates:
+            rate_plan = RatePlan.from_destination_rate(destination_rate)
+            if rate_plan is not None:
+                self._rate_plans[rate_plan.prefix or ''] = rate_plan
+        self._max_length = max(map(len, self._rate_plans), default=0)
+
+    def __len__(self) -> int:
+        return len(self._rate_plans)
+
+    def get_rate_plan(self, destination: Optional[str]) -> Optional[RatePlan]:
+        destination = destination or ''
+        for length in range(min(len(destination), self._max_length), -1, -1):
+            rate_plan = self._rate_plans.get(destination[:length])
+            if rate_plan is not None:
+                return rate_plan
+        return None
+
+
+def load_destination_rates(f: IO[str]) -> List[dict]:
+    """A JSON list of destination rates, or an object with a destination_rates list"""
+    destination_rates = json.load(f)
+    if isinstance(destination_rates, dict):
+        destination_rates = destination_rates['destination_rates']
+    return destination_rates
+
+
+class Rerater(object):
+    """Rates chunks of transaction records against a pricelist"""
+
+    def __init__(self, pricelist: Pricelist, tz: str = 'UTC'):
+        self._pricelist = pricelist
+        self._rater = RaterService(tz=timezone(tz))
+
+    def _timestamp(self, value: Any) -> Optional[float]:
+        if not value:
+            return None
+        if not isinstance(value, datetime):
+            value = parse_timestamp(value)
+        return self._rater.tz_localize(value).timestamp()
+
+    def rate(self, records: List[dict]) -> List[dict]:
+        """Add the rate plan, fee and duration to each record; the flat rate
+        plans are rated in one batch, the banded ones one by one"""
+        rated = []
+        batch: List[Tuple[dict, RatePlan]] = []
+        begin: List[float] = []
+        end: List[float] = []
+        for record in records:
+            rate_plan = self._pricelist.get_rate_plan(record.get('destination'))
+            record = dict(
+                record,
+                carrier_tag=rate_plan.carrier_tag if rate_plan else None,
+                pricelist_tag=rate_plan.pricelist_tag if rate_plan else None,
+                prefix=rate_plan.prefix if rate_plan else None,
+                fee=0,
+                duration=0,
+            )
+            rated.append(record)
+            timestamp_begin = self._timestamp(record.get('timestamp_begin'))
+            timestamp_end = self._timestamp(record.get('timestamp_end'))
+            if timestamp_begin is None or timestamp_end is None:
+                continue
+            if rate_plan is not None and rate_plan.bands:
+                fee, duration = self._rater.get_transaction_fee_and_duration(
+                    dict(record, destination_rate=rate_plan)
+                )
+                record.update(fee=fee, duration=duration)
+                continue
+            batch.append((record, rate_plan or RatePlan()))
+            begin.append(timestamp_begin)
+            end.append(timestamp_end)
+        if batch:
+            fees, durations = self._rater.get_transactions_fees_and_durations(
+                begin,
+                end,
+                [rate_plan.connect_fee for _, rate_plan in batch],
+                [rate_plan.rate for _, rate_plan in batch],
+                [rate_plan.rate_increment for _, rate_plan in batch],
+                [rate_plan.interval_start for _, rate_plan in batch],
+            )
+            for (record, _), fee, duration in zip(batch, fees, durations):
+                record.update(fee=fee, duration=duration)
+        return rated
+
+
+_rerater: Optional[Rerater] = None
+
+
+def _init_worker(destination_rates: List[dict], tz: str):
+    global _rerater
+    _rerater = Rerater(Pricelist(destination_rates), tz)
+
+
+def _rate_chunk(fmt: str, chunk: List[Any], rerater: Optional[Rerater] = None):
+    rerater = rerater or _rerater
+    assert rerater is not None
+    records = [json.loads(line) for line in chunk] if fmt == 'jsonl' else chunk
+    return rerater.rate(records)
+
+
+def read_chunks(
+    f: IO[str], fmt: str, chunk_size: int
+) -> Iterator[Tuple[List[str], List[Any]]]:
+    """Chunks of raw JSONL lines or CSV rows, with the CSV field names"""
+    if fmt == 'jsonl':
+        lines = (line for line in f if line.strip())
+        while True:
+            chunk: List[Any] = list(islice(lines, chunk_size))
+            if not chunk:
+                return
+            yield ([], chunk)
+    reader = csv.DictReader(f)
+    while True:
+        chunk = list(islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield (list(reader.fieldnames or ()), chunk)
+
+
+def rerate(
+    input: IO[str],
+    output: IO[str],
+    destination_rates: List[dict],
+    fmt: str = 'jsonl',
+    tz: str = 'UTC',
+    workers: Optional[int] = None,
+    chunk_size: int = 10000,
+) -> int:
+    """Re-rate the transactions of input into output, returns the records count
+
+    workers=0 rates in the current process.
+    """
+    chunks = read_chunks(input, fmt, chunk_size)
+    writer: Optional[csv.DictWriter] = None
+    count = 0
+
+    def write(fieldnames: List[str], records: List[dict]):
+        nonlocal writer, count
+        count += len(records)
+        if fmt == 'jsonl':
+            output.writelines(json.dumps(record) + '\n' for record in records)
+            return
+        if writer is None:
+            fieldnames = fieldnames + [
+                field for field in RATED_FIELDS if field not in fieldnames
+            ]
+            writer = csv.DictWriter(output, fieldnames=fieldnames)
+            writer.writeheader()
+        writer.writerows(records)
+
+    if workers == 0:
+        rerater = Rerater(Pricelist(destination_rates), tz)
+        for fieldnames, chunk in chunks:
+            write(fieldnames, _rate_chunk(fmt, chunk, rerater))
+        return count
+
+    workers = workers or os.cpu_count() or 1
+    window = 2 * workers
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(destination_rates, tz),
+    ) as executor:
+        pending: Deque[Tuple[List[str], Future]] = deque()
+        for fieldnames, chunk in chunks:
+            pending.append((fieldnames, executor.submit(_rate_chunk, fmt, chunk)))
+            if len(pending) >= window:
+                fieldnames, future = pending.popleft()
+                write(fieldnames, future.result())
+        while pending:
+            fieldnames, future = pending.popleft()
+            write(fieldnames, future.result())
+    return count
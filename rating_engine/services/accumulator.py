@@ -0,0 +1,223 @@
+from collections import OrderedDict
+from datetime import datetime
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import rater as rater_service
+
+
+class _RunningTransaction(object):
+    __slots__ = ('begin', 'rate_plan', 'unit', 'fee')
+
+    unit: Optional[int]
+
+    def __init__(self, begin: int, rate_plan: rater_service.RatePlan):
+        self.begin = begin
+        self.rate_plan = rate_plan
+        self.unit = None
+        self.fee = 0
+
+
+class PendingCostAccumulator(object):
+    """Pending cost of the running transactions of an account
+
+    The fee of a running transaction grows by its connect fee when it starts
+    and by its rate at every rate_increment boundary past interval_start.
+    The next boundary of each transaction is kept in a heap, so reading the
+    pending cost only visits the transactions that crossed a boundary since
+    the previous read, each of them jumping straight to its current unit,
+    instead of rating every running transaction again.
+
+    Like the rater, fees are exact for transactions shorter than a day.
+    """
+
+    _rater: rater_service.RaterService
+    _transactions: Dict[str, _RunningTransaction]
+    _steps: List[Tuple[int, int, str, _RunningTransaction]]
+
+    def __init__(self, rater: rater_service.RaterService):
+        self._rater = rater
+        self._transactions = {}
+        self._steps = []
+        self._sequence = count()
+        self._fixed: Dict[str, int] = {}
+        self._banded: Dict[str, dict] = {}
+        self._pending_cost = 0
+        self._now = 0
+
+    def __len__(self) -> int:
+        return len(self._transactions) + len(self._fixed) + len(self._banded)
+
+    def _timestamp(self, value: Any) -> int:
+        if not isinstance(value, datetime):
+            value = rater_service.parse_timestamp(value)
+        return round(self._rater.tz_localize(value).timestamp() * 1000000)
+
+    def _push(self, timestamp: int, transaction_tag: str, tx: _RunningTransaction):
+        heappush(self._steps, (timestamp, next(self._sequence), transaction_tag, tx))
+
+    def add(self, transaction: dict):
+        """Start accruing the fee of a running transaction"""
+        transaction_tag = transaction['transaction_tag']
+        self.remove(transaction_tag)
+        if transaction.get('timestamp_end'):
+            fee = self._rater.get_transaction_fee(transaction)
+            self._fixed[transaction_tag] = fee
+            self._pending_cost += fee
+            return
+        rate_plan = (
+            rater_service.RatePlan.from_destination_rate(
+                transaction.get('destination_rate')
+            )
+            or rater_service.EMPTY_RATE_PLAN
+        )
+        if rate_plan.bands:
+            # banded fees do not grow by fixed steps, rate them on every read
+            self._banded[transaction_tag] = transaction
+            return
+        tx = _RunningTransaction(
+            self._timestamp(transaction['timestamp_begin']), rate_plan
+        )
+        self._transactions[transaction_tag] = tx
+        self._push(tx.begin, transaction_tag, tx)
+
+    def remove(self, transaction_tag: str):
+        """Stop accruing the fee of a transaction, e.g. when it ends"""
+        tx = self._transactions.pop(transaction_tag, None)
+        if tx is not None:
+            self._pending_cost -= tx.fee
+        self._pending_cost -= self._fixed.pop(transaction_tag, 0)
+        self._banded.pop(transaction_tag, None)
+
+    def reconcile(self, running_transactions: Iterable[dict]):
+        """Align the accumulator with the running transactions of an API snapshot
+
+        This is one lookup per running transaction; only the new and the
+        ended ones are rated.
+        """
+        transaction_tags: Set[str] = set()
+        for transaction in running_transactions:
+            transaction_tag = transaction['transaction_tag']
+            transaction_tags.add(transaction_tag)
+            if transaction_tag in self._fixed:
+                continue
+            if transaction_tag in self._transactions or transaction_tag in self._banded:
+                if transaction.get('timestamp_end'):
+                    self.add(transaction)
+            else:
+                self.add(transaction)
+        if len(self) > len(transaction_tags):
+            for transaction_tag in [
+                transaction_tag
+                for transactions in (self._transactions, self._fixed, self._banded)
+                for transaction_tag in transactions
+                if transaction_tag not in transaction_tags
+            ]:
+                self.remove(transaction_tag)
+
+    def get_pending_cost(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.utcnow()
+        timestamp = self._timestamp(now)
+        self._now = max(self._now, timestamp)
+        steps = self._steps
+        while steps and steps[0][0] < self._now:
+            _, _, transaction_tag, tx = heappop(steps)
+            if self._transactions.get(transaction_tag) is not tx:
+                continue
+            rate_plan = tx.rate_plan
+            if tx.unit is None:
+                tx.fee += rate_plan.connect_fee
+                self._pending_cost += rate_plan.connect_fee
+                tx.unit = rate_plan.interval_start
+            if rate_plan.rate:
+                increment = (rate_plan.rate_increment or 1) * 1000000
+                # units started so far, the next boundary is past now
+                unit = max(tx.unit, -(-(self._now - tx.begin) // increment))
+                tx.fee += (unit - tx.unit) * rate_plan.rate
+                self._pending_cost += (unit - tx.unit) * rate_plan.rate
+                tx.unit = unit
+                self._push(tx.begin + unit * increment, transaction_tag, tx)
+        return self._pending_cost + sum(
+            self._rater.get_transaction_fee(dict(transaction, timestamp_end=now))
+            for transaction in self._banded.values()
+        )
+
+
+class PendingCostService(object):
+    """Pending cost accumulators, one per tenant and account
+
+    The transactions of an account may end on another engine, leaving its
+    accumulator behind until the account is authorized here again; the
+    accumulators not used for idle_timeout seconds are dropped, the next
+    read rebuilds them from the API snapshot.
+    """
+
+    IDLE_TIMEOUT = 3600
+
+    _accumulators: 'OrderedDict[Tuple[str, str], Tuple[float, PendingCostAccumulator]]'
+
+    def __init__(
+        self,
+        rater: rater_service.RaterService,
+        idle_timeout: Optional[float] = None,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self._rater = rater
+        self._idle_timeout = (
+            idle_timeout if idle_timeout is not None else self.IDLE_TIMEOUT
+        )
+        self._clock = clock
+        self._accumulators = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._accumulators)
+
+    def get_accumulator(self, tenant: str, account_tag: str) -> PendingCostAccumulator:
+        key = (tenant, account_tag)
+        now = self._clock()
+        self._evict(now)
+        entry = self._accumulators.get(key)
+        if entry is None:
+            accumulator = PendingCostAccumulator(self._rater)
+        else:
+            _, accumulator = entry
+            self._accumulators.move_to_end(key)
+        self._accumulators[key] = (now, accumulator)
+        return accumulator
+
+    def _evict(self, now: float):
+        accumulators = self._accumulators
+        while accumulators:
+            key, (used, _) = next(iter(accumulators.items()))
+            if used > now - self._idle_timeout:
+                break
+            del accumulators[key]
+
+    def _discard(self, tenant: str, account_tag: str):
+        entry = self._accumulators.get((tenant, account_tag))
+        if entry is not None and not entry[1]:
+            del self._accumulators[(tenant, account_tag)]
+
+    def get_pending_cost(
+        self,
+        tenant: str,
+        account_tag: str,
+        running_transactions: Iterable[dict],
+        now: Optional[datetime] = None,
+    ) -> int:
+        accumulator = self.get_accumulator(tenant, account_tag)
+        accumulator.reconcile(running_transactions)
+        pending_cost = accumulator.get_pending_cost(now)
+        self._discard(tenant, account_tag)
+        return pending_cost
+
+    def begin_transaction(self, tenant: str, account_tag: str, transaction: dict):
+        self.get_accumulator(tenant, account_tag).add(transaction)
+
+    def end_transaction(self, tenant: str, account_tag: str, transaction_tag: str):
+        entry = self._accumulators.get((tenant, account_tag))
+        if entry is not None:
+            entry[1].remove(transaction_tag)
+            self._discard(tenant, account_tag)
@@ -1,21 +1,127 @@
 import aiohttp
+import asyncio
 
 from datetime import datetime
-from json import dumps
-from typing import Any, List, Optional, Tuple
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
 from pytz import timezone
 
-
-def _dumps(val: Any, d: Any = ''):
-    return dumps(val if val is not None else d, default=_dumps_converter)
+from ..enums import AccountProfile
+from .cache import AccountCache, LookupKey
+from .codec import Codec, JsonCodec
+from .graphql import (
+    Field,
+    Selection,
+    get_document,
+    get_variables,
+    render_document,
+)
+from .rater import RatePlan
 
 
 UTC = timezone('UTC')
 
+# GraphQL type of the arguments of the queries and mutations
+VARIABLE_TYPES = {
+    'tenant': 'String!',
+    'account_tag': 'String!',
+    'transaction_tag': 'String!',
+    'destination': 'String',
+    'source': 'String',
+    'source_ip': 'String',
+    'carrier_ip': 'String',
+    'tags': '[String]',
+    'timestamp_begin': 'String',
+    'timestamp_end': 'String',
+    'timestamp_auth': 'String',
+    'primary': 'Boolean',
+    'inbound': 'Boolean',
+    'authorized': 'Boolean',
+    'unauthorized_reason': 'String',
+    'duration': 'Int',
+    'fee': 'Int',
+    'destination_rate_carrier_tag': 'String',
+    'destination_rate_pricelist_tag': 'String',
+    'destination_rate_prefix': 'String',
+    'destination_rate_description': 'String',
+    'destination_rate_connect_fee': 'Int',
+    'destination_rate_rate': 'Int',
+    'destination_rate_rate_increment': 'Int',
+    'destination_rate_interval_start': 'Int',
+}
+
+# value sent in place of None, by type
+DEFAULTS = {'String': '', 'Int': 0, 'Boolean': False, '[String]': []}
+
 
 def _dumps_converter(v: Any):
     if isinstance(v, datetime):
         return v.astimezone(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return v
+
+
+def _get_values(field: Field, values: dict) -> dict:
+    """Values of the variables of the field, as JSON values"""
+    result = {}
+    for name, type_ in field.variables:
+        value = values.get(name)
+        if value is None:
+            value = DEFAULTS.get(type_.rstrip('!'), '')
+        result[name] = _dumps_converter(value)
+    return result
+
+
+def _parse_account_fields(
+    template: str, destination_rate: str, least_cost_routing: str
+) -> Tuple[Field, Field]:
+    """Account field without and with the rate and routing of a destination"""
+    return (
+        Field.parse(
+            'query',
+            template
+            % dict(
+                tenant='%(tenant)s',
+                account_tag='%(account_tag)s',
+                destination_rate='',
+                least_cost_routing='',
+            ),
+            VARIABLE_TYPES,
+        ),
+        Field.parse(
+            'query',
+            template
+            % dict(
+                tenant='%(tenant)s',
+                account_tag='%(account_tag)s',
+                destination_rate=destination_rate,
+                least_cost_routing=least_cost_routing,
+            ),
+            VARIABLE_TYPES,
+        ),
+    )
+
+
+def _is_persisted_query_not_found(result: dict) -> bool:
+    return any(
+        error.get('message') == 'PersistedQueryNotFound'
+        or (error.get('extensions') or {}).get('code') == 'PERSISTED_QUERY_NOT_FOUND'
+        for error in result.get('errors') or ()
+    )
+
+
+def _load_rate_plans(obj: Optional[dict]) -> Optional[dict]:
+    """Replace the destination_rate dicts of an account or transaction with
+    interned rate plans, recursing into running transactions and linked accounts"""
+    if obj is None:
+        return None
+    if 'destination_rate' in obj:
+        obj['destination_rate'] = RatePlan.from_destination_rate(
+            obj['destination_rate']
+        )
+    for key in ('running_transactions', 'linked_accounts'):
+        for item in obj.get(key) or ():
+            _load_rate_plans(item)
+    return obj
 
 
 class APIService(object):
@@ -24,10 +130,17 @@ class APIService(object):
     _api_usename: Optional[str]
     _api_password: Optional[str]
     _session: Optional[aiohttp.ClientSession]
+    _account_cache: Optional[AccountCache]
+    _batch_mutations: bool
+    _pending_mutations: List[Tuple[Selection, asyncio.Future]]
+    _lookups: Dict[LookupKey, Tuple[int, asyncio.Future]]
+    _pending_lookups: List[Tuple[LookupKey, asyncio.Future]]
+    _variables: bool
+    _persisted_queries: bool
+    _unix_socket: Optional[str]
+    _codec: Codec
 
-    QUERY_GET_ACCOUNT_BY_ID_WRAPPER = """query {
-        %(query)s
-}"""
+    HEADERS = {'Content-Type': 'application/json'}
 
     QUERY_GET_ACCOUNT_BY_ID = """Account(tenant: %(tenant)s, account_tag: %(account_tag)s) {
         account_tag
@@ -141,8 +254,7 @@ class APIService(object):
         },
     """
 
-    QUERY_BEGIN_ACCOUNT_TRANSACTION = """mutation {
-    beginAccountTransaction(
+    QUERY_BEGIN_ACCOUNT_TRANSACTION = """beginAccountTransaction(
         tenant: %(tenant)s
         account_tag: %(account_tag)s
         transaction: {
@@ -179,20 +291,18 @@ class APIService(object):
             timestamp_end
         }
     }
-}"""
+"""
 
-    QUERY_ROLLBACK_ACCOUNT_TRANSACTION = """mutation {
-    rollbackAccountTransaction(
+    QUERY_ROLLBACK_ACCOUNT_TRANSACTION = """rollbackAccountTransaction(
         tenant: %(tenant)s
         account_tag: %(account_tag)s
         transaction_tag: %(transaction_tag)s
     ) {
         ok
     }
-}"""
+"""
 
-    QUERY_END_ACCOUNT_TRANSACTION = """mutation {
-    endAccountTransaction(
+    QUERY_END_ACCOUNT_TRANSACTION = """endAccountTransaction(
         tenant: %(tenant)s
         account_tag: %(account_tag)s
         transaction_tag: %(transaction_tag)s
@@ -223,10 +333,9 @@ class APIService(object):
             timestamp_end
         }
     }
-}"""
+"""
 
-    QUERY_COMMIT_ACCOUNT_TRANSACTION = """mutation {
-    commitAccountTransaction(
+    QUERY_COMMIT_ACCOUNT_TRANSACTION = """commitAccountTransaction(
         tenant: %(tenant)s
         account_tag: %(account_tag)s
         transaction_tag: %(transaction_tag)s
@@ -234,10 +343,9 @@ class APIService(object):
     ) {
         ok
     }
-}"""
+"""
 
-    QUERY_GET_PRIMARY_TRANSACTIONS_BY_TENANT_AND_TAG = """query {
-    allTransactions(filter:{tenant: %(tenant)s, transaction_tag: %(transaction_tag)s, primary: true}) {
+    QUERY_GET_PRIMARY_TRANSACTIONS_BY_TENANT_AND_TAG = """allTransactions(filter:{tenant: %(tenant)s, transaction_tag: %(transaction_tag)s, primary: true}) {
         tenant
         transaction_tag
         account_tag
@@ -248,10 +356,9 @@ class APIService(object):
         inbound
         primary
     }
-}"""
+"""
 
-    QUERY_UPSERT_TRANSACTION = """mutation {
-    upsertTransaction (
+    QUERY_UPSERT_TRANSACTION = """upsertTransaction (
         tenant: %(tenant)s
         transaction_tag: %(transaction_tag)s
         account_tag: %(account_tag)s
@@ -270,10 +377,9 @@ class APIService(object):
     ) {
         id
     }
-}"""
+"""
 
-    QUERY_UPSERT_AUTHORIZATION_TRANSACTION = """mutation {
-    upsertTransaction (
+    QUERY_UPSERT_AUTHORIZATION_TRANSACTION = """upsertTransaction (
         tenant: %(tenant)s
         transaction_tag: %(transaction_tag)s
         account_tag: %(account_tag)s
@@ -290,93 +396,565 @@ class APIService(object):
     ) {
         id
     }
-}"""
+"""
+
+    # the fields of the accounts used by each engine operation
+    QUERY_GET_ACCOUNT_BY_ID_FOR_AUTHORIZATION = """Account(tenant: %(tenant)s, account_tag: %(account_tag)s) {
+        account_tag
+        type
+        balance
+        active
+        max_concurrent_transactions
+        max_inbound_transactions
+        max_outbound_transactions
+        running_transactions {
+            destination_rate {
+                carrier_tag
+                pricelist_tag
+                prefix
+                description
+                connect_fee
+                rate
+                rate_increment
+                interval_start
+            }
+            transaction_tag
+            inbound
+            timestamp_begin
+            timestamp_end
+        }
+        %(destination_rate)s
+        %(least_cost_routing)s
+        linked_accounts {
+            account_tag
+            type
+            balance
+            max_concurrent_transactions
+            max_inbound_transactions
+            max_outbound_transactions
+            running_transactions {
+                destination_rate {
+                    carrier_tag
+                    pricelist_tag
+                    prefix
+                    description
+                    connect_fee
+                    rate
+                    rate_increment
+                    interval_start
+                }
+                transaction_tag
+                inbound
+                timestamp_begin
+                timestamp_end
+            }
+            %(destination_rate)s
+        }
+        tags
+    }
+"""
+
+    QUERY_GET_ACCOUNT_BY_ID_FOR_BEGIN = """Account(tenant: %(tenant)s, account_tag: %(account_tag)s) {
+        account_tag
+        active
+        %(destination_rate)s
+        linked_accounts {
+            account_tag
+            %(destination_rate)s
+        }
+    }
+"""
+
+    QUERY_GET_ACCOUNT_BY_ID_FOR_END = """Account(tenant: %(tenant)s, account_tag: %(account_tag)s) {
+        account_tag
+        linked_accounts {
+            account_tag
+            tags
+        }
+        tags
+    }
+"""
+
+    QUERY_GET_ACCOUNT_BY_ID_FOR_RECORD = """Account(tenant: %(tenant)s, account_tag: %(account_tag)s) {
+        account_tag
+        active
+        %(destination_rate)s
+        linked_accounts {
+            account_tag
+            tags
+            %(destination_rate)s
+        }
+        tags
+    }
+"""
+
+    # fields of the accounts, without and with the destination
+    ACCOUNT_FIELDS = {
+        AccountProfile.FULL: _parse_account_fields(
+            QUERY_GET_ACCOUNT_BY_ID,
+            QUERY_GET_ACCOUNT_BY_ID_DESTINATION_RATE,
+            QUERY_GET_ACCOUNT_BY_ID_LEAST_COST_ROUTING,
+        ),
+        AccountProfile.AUTHORIZATION: _parse_account_fields(
+            QUERY_GET_ACCOUNT_BY_ID_FOR_AUTHORIZATION,
+            QUERY_GET_ACCOUNT_BY_ID_DESTINATION_RATE,
+            QUERY_GET_ACCOUNT_BY_ID_LEAST_COST_ROUTING,
+        ),
+        AccountProfile.BEGIN: _parse_account_fields(
+            QUERY_GET_ACCOUNT_BY_ID_FOR_BEGIN,
+            QUERY_GET_ACCOUNT_BY_ID_DESTINATION_RATE,
+            QUERY_GET_ACCOUNT_BY_ID_LEAST_COST_ROUTING,
+        ),
+        AccountProfile.END: _parse_account_fields(
+            QUERY_GET_ACCOUNT_BY_ID_FOR_END,
+            QUERY_GET_ACCOUNT_BY_ID_DESTINATION_RATE,
+            QUERY_GET_ACCOUNT_BY_ID_LEAST_COST_ROUTING,
+        ),
+        AccountProfile.RECORD: _parse_account_fields(
+            QUERY_GET_ACCOUNT_BY_ID_FOR_RECORD,
+            QUERY_GET_ACCOUNT_BY_ID_DESTINATION_RATE,
+            QUERY_GET_ACCOUNT_BY_ID_LEAST_COST_ROUTING,
+        ),
+    }
+    FIELD_BEGIN_ACCOUNT_TRANSACTION = Field.parse(
+        'mutation',
+        QUERY_BEGIN_ACCOUNT_TRANSACTION.replace('%(destination_rate)s', ''),
+        VARIABLE_TYPES,
+    )
+    FIELD_BEGIN_ACCOUNT_TRANSACTION_WITH_DESTINATION_RATE = Field.parse(
+        'mutation',
+        QUERY_BEGIN_ACCOUNT_TRANSACTION.replace(
+            '%(destination_rate)s', QUERY_DESTINATION_RATE
+        ),
+        VARIABLE_TYPES,
+    )
+    FIELD_ROLLBACK_ACCOUNT_TRANSACTION = Field.parse(
+        'mutation', QUERY_ROLLBACK_ACCOUNT_TRANSACTION, VARIABLE_TYPES
+    )
+    FIELD_END_ACCOUNT_TRANSACTION = Field.parse(
+        'mutation', QUERY_END_ACCOUNT_TRANSACTION, VARIABLE_TYPES
+    )
+    FIELD_COMMIT_ACCOUNT_TRANSACTION = Field.parse(
+        'mutation', QUERY_COMMIT_ACCOUNT_TRANSACTION, VARIABLE_TYPES
+    )
+    FIELD_GET_PRIMARY_TRANSACTIONS_BY_TENANT_AND_TAG = Field.parse(
+        'query', QUERY_GET_PRIMARY_TRANSACTIONS_BY_TENANT_AND_TAG, VARIABLE_TYPES
+    )
+    FIELD_UPSERT_TRANSACTION = Field.parse(
+        'mutation',
+        QUERY_UPSERT_TRANSACTION.replace('%(destination_rate)s', ''),
+        VARIABLE_TYPES,
+    )
+    FIELD_UPSERT_TRANSACTION_WITH_DESTINATION_RATE = Field.parse(
+        'mutation',
+        QUERY_UPSERT_TRANSACTION.replace(
+            '%(destination_rate)s', QUERY_DESTINATION_RATE
+        ),
+        VARIABLE_TYPES,
+    )
+    FIELD_UPSERT_AUTHORIZATION_TRANSACTION = Field.parse(
+        'mutation', QUERY_UPSERT_AUTHORIZATION_TRANSACTION, VARIABLE_TYPES
+    )
 
     def __init__(
         self,
         api_url: str,
         api_username: Optional[str] = None,
         api_password: Optional[str] = None,
+        account_cache: Optional[AccountCache] = None,
+        batch_mutations: bool = False,
+        lookup_window: float = 0,
+        variables: bool = False,
+        persisted_queries: bool = False,
+        max_connections: int = 100,
+        max_connections_per_host: int = 0,
+        keepalive_timeout: float = 15,
+        dns_cache_ttl: Optional[int] = 10,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        unix_socket: Optional[str] = None,
+        codec: Optional[Codec] = None,
     ):
         self._api_url = api_url
         self._api_username = api_username
         self._api_password = api_password
         self._session = None
+        self._account_cache = account_cache
+        self._batch_mutations = batch_mutations
+        self._pending_mutations = []
+        self._lookup_window = lookup_window
+        self._lookups = {}
+        self._pending_lookups = []
+        self._generation = 0
+        self._variables = variables or persisted_queries
+        self._persisted_queries = persisted_queries
+        self.lookup_stats = dict(lookups=0, shared=0, batched=0, queries=0)
+        self._max_connections = max_connections
+        self._max_connections_per_host = max_connections_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._unix_socket = unix_socket
+        self._codec = codec or JsonCodec()
+        self._in_flight = 0
+        self.pool_stats = dict(
+            requests=0, max_in_flight=0, waiting=0, errors=0, timeouts=0
+        )
 
-    async def _query(self, query: str) -> Optional[dict]:
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Session kept open for the lifetime of the service, on a pool of
+        keep-alive connections to the API, or to its Unix socket"""
         if self._session is None:
-            self._session = aiohttp.ClientSession()
-        json = {'query': query}
+            connector: aiohttp.BaseConnector
+            if self._unix_socket is not None:
+                connector = aiohttp.UnixConnector(
+                    path=self._unix_socket,
+                    limit=self._max_connections,
+                    limit_per_host=self._max_connections_per_host,
+                    keepalive_timeout=self._keepalive_timeout,
+                )
+            else:
+                connector = aiohttp.TCPConnector(
+                    use_dns_cache=self._dns_cache_ttl != 0,
+                    ttl_dns_cache=self._dns_cache_ttl or None,
+                    limit=self._max_connections,
+                    limit_per_host=self._max_connections_per_host,
+                    keepalive_timeout=self._keepalive_timeout,
+                )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self._connect_timeout,
+                    sock_read=self._read_timeout,
+                ),
+            )
+        return self._session
+
+    async def _query(self, payload: dict) -> Optional[dict]:
+        session = self._get_session()
+        stats = self.pool_stats
+        stats['requests'] += 1
+        self._in_flight += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], self._in_flight)
+        if self._max_connections and self._in_flight > self._max_connections:
+            # no connection left, the request waits for one to be released
+            stats['waiting'] += 1
         try:
-            async with self._session.post(self._api_url, json=json) as r:
+            async with session.post(
+                self._api_url, data=self._codec.dumps(payload), headers=self.HEADERS
+            ) as r:
                 if r.status == 200:
-                    return await r.json()
+                    return self._codec.loads(await r.read())
+                stats['errors'] += 1
+        except asyncio.TimeoutError:
+            stats['timeouts'] += 1
         except aiohttp.ClientError:  # pragma: no cover
-            pass
+            stats['errors'] += 1
+        finally:
+            self._in_flight -= 1
         return None
 
+    def get_pool_stats(self) -> dict:
+        """Request counters of the connection pool, waiting counts the requests
+        which found all the connections in use"""
+        return dict(
+            self.pool_stats,
+            in_flight=self._in_flight,
+            limit=self._max_connections,
+            saturation=(
+                round(self._in_flight / self._max_connections, 3)
+                if self._max_connections
+                else 0
+            ),
+        )
+
+    async def _execute(self, selections: List[Selection]) -> Optional[dict]:
+        """Send the fields in one document, with the values written inline, as
+        variables of a document compiled once or as variables of a persisted query"""
+        selections = [
+            (field, alias, _get_values(field, values))
+            for field, alias, values in selections
+        ]
+        if not self._variables:
+            return await self._query({'query': render_document(selections)})
+        document = get_document(selections)
+        variables = get_variables(selections)
+        if not self._persisted_queries:
+            return await self._query({'query': document.text, 'variables': variables})
+        extensions = {'persistedQuery': {'version': 1, 'sha256Hash': document.sha256}}
+        result = await self._query({'variables': variables, 'extensions': extensions})
+        if result is not None and _is_persisted_query_not_found(result):
+            # first use of the document, register it
+            result = await self._query(
+                {
+                    'query': document.text,
+                    'variables': variables,
+                    'extensions': extensions,
+                }
+            )
+        return result
+
+    async def _mutation(self, field: Field, values: dict) -> Optional[dict]:
+        """Run a mutation; in batching mode, the mutations issued while
+        the event loop is busy are sent as aliased fields of one document"""
+        if not self._batch_mutations:
+            return await self._execute([(field, '', values)])
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending_mutations.append(((field, '', values), future))
+        if len(self._pending_mutations) == 1:
+            loop.call_soon(self._flush_mutations)
+        return await future
+
+    def _flush_mutations(self):
+        mutations, self._pending_mutations = self._pending_mutations, []
+        asyncio.ensure_future(self._send_mutations(mutations))
+
+    async def _send_mutations(self, mutations: List[Tuple[Selection, asyncio.Future]]):
+        try:
+            if len(mutations) == 1:
+                results = [await self._execute([mutations[0][0]])]
+            else:
+                results = await self._execute_aliased(
+                    [selection for selection, _ in mutations]
+                )
+        except Exception as e:  # pragma: no cover
+            for _, future in mutations:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(mutations, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _execute_aliased(
+        self, selections: List[Selection]
+    ) -> List[Optional[dict]]:
+        """Send the fields as one document, the n-th aliased as a<n>, and split
+        the result back into one result per field"""
+        result = await self._execute(
+            [
+                (field, 'a%d' % n, values)
+                for n, (field, _, values) in enumerate(selections)
+            ]
+        )
+        if result is None:
+            return [None] * len(selections)
+        data = result.get('data') or {}
+        return [
+            dict(result, data={field.name: data.get('a%d' % n)})
+            for n, (field, _, _) in enumerate(selections)
+        ]
+
     async def close(self):
         if self._session is not None:
             await self._session.close()
 
+    @property
+    def account_cache(self) -> Optional[AccountCache]:
+        return self._account_cache
+
+    @property
+    def batch_mutations(self) -> bool:
+        return self._batch_mutations
+
+    def _invalidate_account(self, tenant: str, account_tag: Optional[str]):
+        self._generation += 1
+        if self._account_cache is not None:
+            self._account_cache.invalidate_account(tenant, account_tag)
+
+    def _destination_rate_values(self, destination_rate: Any) -> Optional[dict]:
+        rate_plan = RatePlan.from_destination_rate(destination_rate)
+        if rate_plan is None:
+            return None
+        return dict(
+            destination_rate_pricelist_tag=rate_plan.pricelist_tag,
+            destination_rate_carrier_tag=rate_plan.carrier_tag,
+            destination_rate_prefix=rate_plan.prefix,
+            destination_rate_description=rate_plan.description,
+            destination_rate_connect_fee=rate_plan.connect_fee,
+            destination_rate_rate=rate_plan.rate,
+            destination_rate_rate_increment=rate_plan.rate_increment,
+            destination_rate_interval_start=rate_plan.interval_start,
+        )
+
     async def get_account_and_destination_account_by_id(
         self,
         tenant: str,
         account_tag: Optional[str] = None,
         destination: Optional[str] = None,
         destination_account_tag: Optional[str] = None,
+        profile: AccountProfile = AccountProfile.FULL,
     ) -> Tuple[Optional[dict], Optional[dict]]:
-        destination_rate = (
-            self.QUERY_GET_ACCOUNT_BY_ID_DESTINATION_RATE
-            % dict(destination=_dumps(destination))
-            if destination is not None
-            else ''
-        )
-        least_cost_routing = (
-            self.QUERY_GET_ACCOUNT_BY_ID_LEAST_COST_ROUTING
-            % dict(destination=_dumps(destination))
-            if destination is not None
-            else ''
+        """The account and destination account, with the fields of the profile"""
+        key = AccountCache.get_key(
+            tenant, account_tag, destination, destination_account_tag, profile
         )
-        account = (
-            self.QUERY_GET_ACCOUNT_BY_ID
-            % dict(
-                tenant=_dumps(tenant),
-                account_tag=_dumps(account_tag),
-                destination_rate=destination_rate,
-                least_cost_routing=least_cost_routing,
+        self.lookup_stats['lookups'] += 1
+        cache = self._account_cache
+        if cache is not None:
+            cached = cache.get_accounts(key)
+            if cached is not None:
+                return cached
+        # single-flight, share an identical look-up unless a mutation ran since
+        lookup = self._lookups.get(key)
+        if lookup is not None and lookup[0] == self._generation:
+            self.lookup_stats['shared'] += 1
+            future = lookup[1]
+        else:
+            future = asyncio.ensure_future(self._lookup_accounts(key))
+            self._lookups[key] = (self._generation, future)
+            future.add_done_callback(partial(self._lookup_done, key))
+        accounts = await asyncio.shield(future)
+        return AccountCache.copy_accounts(accounts)
+
+    def _lookup_done(self, key: LookupKey, future: asyncio.Future):
+        lookup = self._lookups.get(key)
+        if lookup is not None and lookup[1] is future:
+            del self._lookups[key]
+
+    async def _lookup_accounts(
+        self, key: LookupKey
+    ) -> Tuple[Optional[dict], Optional[dict]]:
+        cache = self._account_cache
+        generation = cache.generation if cache is not None else 0
+        if self._lookup_window:
+            accounts = await self._get_accounts_in_window(key)
+        else:
+            self.lookup_stats['queries'] += 1
+            accounts = await self._get_account_and_destination_account_by_id(*key)
+        account, destination_account = accounts
+        _, account_tag, _, destination_account_tag, _ = key
+        # only cache complete look-ups, not the accounts missing or failed
+        if (
+            cache is not None
+            and (account is not None or account_tag is None)
+            and (destination_account is not None or destination_account_tag is None)
+        ):
+            cache.put_accounts(key, accounts, generation)
+        return accounts
+
+    async def _get_accounts_in_window(
+        self, key: LookupKey
+    ) -> Tuple[Optional[dict], Optional[dict]]:
+        """Look-ups arriving within lookup_window seconds are sent as one query"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending_lookups.append((key, future))
+        if len(self._pending_lookups) == 1:
+            loop.call_later(self._lookup_window, self._flush_lookups)
+        return await future
+
+    def _flush_lookups(self):
+        lookups, self._pending_lookups = self._pending_lookups, []
+        asyncio.ensure_future(self._send_lookups(lookups))
+
+    async def _send_lookups(self, lookups: List[Tuple[LookupKey, asyncio.Future]]):
+        self.lookup_stats['queries'] += 1
+        try:
+            if len(lookups) == 1:
+                results = [
+                    await self._get_account_and_destination_account_by_id(
+                        *lookups[0][0]
+                    )
+                ]
+            else:
+                self.lookup_stats['batched'] += len(lookups)
+                results = await self._get_accounts_aliased([key for key, _ in lookups])
+        except Exception as e:  # pragma: no cover
+            for _, future in lookups:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), accounts in zip(lookups, results):
+            if not future.done():
+                future.set_result(accounts)
+
+    def _get_account_selections(
+        self,
+        tenant: str,
+        account_tag: Optional[str],
+        destination: Optional[str],
+        destination_account_tag: Optional[str],
+        profile: AccountProfile,
+        account_alias: str = '',
+        destination_account_alias: str = 'DestinationAccount',
+    ) -> List[Selection]:
+        fields = self.ACCOUNT_FIELDS[profile]
+        selections = []
+        if account_tag is not None:
+            field = fields[1] if destination is not None else fields[0]
+            selections.append(
+                (
+                    field,
+                    account_alias,
+                    dict(
+                        tenant=tenant, account_tag=account_tag, destination=destination
+                    ),
+                )
             )
-            if account_tag is not None
-            else None
-        )
-        destination_account = (
-            'DestinationAccount:'
-            + self.QUERY_GET_ACCOUNT_BY_ID
-            % dict(
-                tenant=_dumps(tenant),
-                account_tag=_dumps(destination_account_tag),
-                destination_rate='',
-                least_cost_routing='',
-                destination_account='',
+        if destination_account_tag is not None:
+            selections.append(
+                (
+                    fields[0],
+                    destination_account_alias,
+                    dict(tenant=tenant, account_tag=destination_account_tag),
+                )
             )
-            if destination_account_tag is not None
-            else None
-        )
-        query = self.QUERY_GET_ACCOUNT_BY_ID_WRAPPER % dict(
-            query='\n'.join(filter(None, (account, destination_account)))
+        return selections
+
+    async def _get_account_and_destination_account_by_id(
+        self,
+        tenant: str,
+        account_tag: Optional[str],
+        destination: Optional[str],
+        destination_account_tag: Optional[str],
+        profile: AccountProfile = AccountProfile.FULL,
+    ) -> Tuple[Optional[dict], Optional[dict]]:
+        selections = self._get_account_selections(
+            tenant, account_tag, destination, destination_account_tag, profile
         )
-        result = await self._query(query=query)
+        if not selections:
+            return None, None
+        result = await self._execute(selections)
         return (
-            (result['data'].get('Account'), result['data'].get('DestinationAccount'))
+            (
+                _load_rate_plans(result['data'].get('Account')),
+                _load_rate_plans(result['data'].get('DestinationAccount')),
+            )
             if result is not None
             else (None, None)
         )
 
+    async def _get_accounts_aliased(
+        self, keys: List[LookupKey]
+    ) -> List[Tuple[Optional[dict], Optional[dict]]]:
+        """Several look-ups in one query, the accounts of the n-th aliased
+        as a<n> and d<n>"""
+        selections = [
+            selection
+            for n, key in enumerate(keys)
+            for selection in self._get_account_selections(*key, 'a%d' % n, 'd%d' % n)
+        ]
+        result = await self._execute(selections)
+        if result is None:
+            return [(None, None)] * len(keys)
+        data = result['data'] or {}
+        return [
+            (
+                _load_rate_plans(data.get('a%d' % n)),
+                _load_rate_plans(data.get('d%d' % n)),
+            )
+            for n in range(len(keys))
+        ]
+
     async def begin_account_transaction(
         self,
         tenant: str,
         account_tag: str,
-        destination_rate: dict,
+        destination_rate: Optional[RatePlan],
         transaction_tag: str,
         source: Optional[str],
         source_ip: Optional[str],
@@ -386,43 +964,31 @@ class APIService(object):
         primary: bool = False,
         inbound: bool = False,
     ) -> Optional[dict]:
-        query_destination_rate = (
-            self.QUERY_DESTINATION_RATE
-            % dict(
-                destination_rate_pricelist_tag=_dumps(
-                    destination_rate['pricelist_tag']
-                ),
-                destination_rate_carrier_tag=_dumps(destination_rate['carrier_tag']),
-                destination_rate_prefix=_dumps(destination_rate['prefix']),
-                destination_rate_description=_dumps(destination_rate['description']),
-                destination_rate_connect_fee=_dumps(destination_rate['connect_fee'], 0),
-                destination_rate_rate=_dumps(destination_rate['rate'], 0),
-                destination_rate_rate_increment=_dumps(
-                    destination_rate['rate_increment'], 0
-                ),
-                destination_rate_interval_start=_dumps(
-                    destination_rate['interval_start'], 0
-                ),
-            )
-            if destination_rate
-            else ''
+        destination_rate_values = self._destination_rate_values(destination_rate)
+        field = (
+            self.FIELD_BEGIN_ACCOUNT_TRANSACTION_WITH_DESTINATION_RATE
+            if destination_rate_values is not None
+            else self.FIELD_BEGIN_ACCOUNT_TRANSACTION
         )
-        query = self.QUERY_BEGIN_ACCOUNT_TRANSACTION % dict(
-            tenant=_dumps(tenant),
-            account_tag=_dumps(account_tag),
-            transaction_tag=_dumps(transaction_tag),
-            source=_dumps(source),
-            source_ip=_dumps(source_ip),
-            destination=_dumps(destination),
-            carrier_ip=_dumps(carrier_ip),
-            timestamp_begin=_dumps(timestamp_begin),
-            destination_rate=query_destination_rate,
-            primary='true' if primary else 'false',
-            inbound='true' if inbound else 'false',
+        result = await self._mutation(
+            field,
+            dict(
+                destination_rate_values or {},
+                tenant=tenant,
+                account_tag=account_tag,
+                transaction_tag=transaction_tag,
+                source=source,
+                source_ip=source_ip,
+                destination=destination,
+                carrier_ip=carrier_ip,
+                timestamp_begin=timestamp_begin,
+                primary=primary,
+                inbound=inbound,
+            ),
         )
-        result = await self._query(query=query)
+        self._invalidate_account(tenant, account_tag)
         return (
-            result['data']['beginAccountTransaction']['transaction']
+            _load_rate_plans(result['data']['beginAccountTransaction']['transaction'])
             if result is not None
             else None
         )
@@ -430,12 +996,13 @@ class APIService(object):
     async def rollback_account_transaction(
         self, tenant: str, account_tag: Optional[str], transaction_tag: str,
     ) -> Optional[dict]:
-        query = self.QUERY_ROLLBACK_ACCOUNT_TRANSACTION % dict(
-            tenant=_dumps(tenant),
-            account_tag=_dumps(account_tag),
-            transaction_tag=_dumps(transaction_tag),
+        result = await self._mutation(
+            self.FIELD_ROLLBACK_ACCOUNT_TRANSACTION,
+            dict(
+                tenant=tenant, account_tag=account_tag, transaction_tag=transaction_tag
+            ),
         )
-        result = await self._query(query=query)
+        self._invalidate_account(tenant, account_tag)
         return (
             result['data']['rollbackAccountTransaction']['ok']
             if result is not None
@@ -449,15 +1016,18 @@ class APIService(object):
         transaction_tag: str,
         timestamp_end: datetime,
     ) -> Optional[dict]:
-        query = self.QUERY_END_ACCOUNT_TRANSACTION % dict(
-            tenant=_dumps(tenant),
-            account_tag=_dumps(account_tag),
-            transaction_tag=_dumps(transaction_tag),
-            timestamp_end=_dumps(timestamp_end),
+        result = await self._mutation(
+            self.FIELD_END_ACCOUNT_TRANSACTION,
+            dict(
+                tenant=tenant,
+                account_tag=account_tag,
+                transaction_tag=transaction_tag,
+                timestamp_end=timestamp_end,
+            ),
         )
-        result = await self._query(query=query)
+        self._invalidate_account(tenant, account_tag)
         return (
-            result['data']['endAccountTransaction']['transaction']
+            _load_rate_plans(result['data']['endAccountTransaction']['transaction'])
             if result is not None
             else None
         )
@@ -465,10 +1035,15 @@ class APIService(object):
     async def get_primary_transactions_by_tenant_and_tag(
         self, tenant: str, transaction_tag: str,
     ) -> List[dict]:
-        query = self.QUERY_GET_PRIMARY_TRANSACTIONS_BY_TENANT_AND_TAG % dict(
-            tenant=_dumps(tenant), transaction_tag=_dumps(transaction_tag),
+        result = await self._execute(
+            [
+                (
+                    self.FIELD_GET_PRIMARY_TRANSACTIONS_BY_TENANT_AND_TAG,
+                    '',
+                    dict(tenant=tenant, transaction_tag=transaction_tag),
+                )
+            ]
         )
-        result = await self._query(query=query)
         return list(result['data']['allTransactions']) if result is not None else []
 
     async def upsert_transaction(
@@ -479,46 +1054,34 @@ class APIService(object):
         duration: int = 0,
         fee: int = 0,
     ) -> Optional[bool]:
-        destination_rate = transaction['destination_rate']
-        query_destination_rate = (
-            self.QUERY_DESTINATION_RATE
-            % dict(
-                destination_rate_pricelist_tag=_dumps(
-                    destination_rate['pricelist_tag']
-                ),
-                destination_rate_carrier_tag=_dumps(destination_rate['carrier_tag']),
-                destination_rate_prefix=_dumps(destination_rate['prefix']),
-                destination_rate_description=_dumps(destination_rate['description']),
-                destination_rate_connect_fee=_dumps(destination_rate['connect_fee'], 0),
-                destination_rate_rate=_dumps(destination_rate['rate'], 0),
-                destination_rate_rate_increment=_dumps(
-                    destination_rate['rate_increment'], 0
-                ),
-                destination_rate_interval_start=_dumps(
-                    destination_rate['interval_start'], 0
-                ),
-            )
-            if destination_rate
-            else ''
+        destination_rate_values = self._destination_rate_values(
+            transaction['destination_rate']
+        )
+        field = (
+            self.FIELD_UPSERT_TRANSACTION_WITH_DESTINATION_RATE
+            if destination_rate_values is not None
+            else self.FIELD_UPSERT_TRANSACTION
         )
-        query = self.QUERY_UPSERT_TRANSACTION % dict(
-            tenant=_dumps(tenant),
-            account_tag=_dumps(account_tag),
-            transaction_tag=_dumps(transaction['transaction_tag']),
-            source=_dumps(transaction['source']),
-            source_ip=_dumps(transaction.get('source_ip')),
-            carrier_ip=_dumps(transaction.get('carrier_ip')),
-            destination=_dumps(transaction['destination']),
-            destination_rate=query_destination_rate,
-            tags=_dumps(transaction['tags'] or []),
-            timestamp_begin=_dumps(transaction['timestamp_begin']),
-            timestamp_end=_dumps(transaction['timestamp_end']),
-            primary='true' if transaction.get('primary') else 'false',
-            inbound='true' if transaction.get('inbound') else 'false',
-            duration=_dumps(duration, 0),
-            fee=_dumps(fee),
+        result = await self._mutation(
+            field,
+            dict(
+                destination_rate_values or {},
+                tenant=tenant,
+                account_tag=account_tag,
+                transaction_tag=transaction['transaction_tag'],
+                source=transaction['source'],
+                source_ip=transaction.get('source_ip'),
+                carrier_ip=transaction.get('carrier_ip'),
+                destination=transaction['destination'],
+                tags=transaction['tags'],
+                timestamp_begin=transaction['timestamp_begin'],
+                timestamp_end=transaction['timestamp_end'],
+                primary=bool(transaction.get('primary')),
+                inbound=bool(transaction.get('inbound')),
+                duration=duration,
+                fee=fee,
+            ),
         )
-        result = await self._query(query=query)
         return (
             result['data']['upsertTransaction']['id'] is not None
             if result is not None
@@ -528,22 +1091,24 @@ class APIService(object):
     async def upsert_authorization_transaction(
         self, tenant: str, account_tag: str, transaction: dict
     ) -> Optional[bool]:
-        query = self.QUERY_UPSERT_AUTHORIZATION_TRANSACTION % dict(
-            tenant=_dumps(tenant),
-            account_tag=_dumps(account_tag),
-            transaction_tag=_dumps(transaction['transaction_tag']),
-            source=_dumps(transaction['source']),
-            source_ip=_dumps(transaction['source_ip']),
-            destination=_dumps(transaction['destination']),
-            carrier_ip=_dumps(transaction['carrier_ip']),
-            tags=_dumps(transaction['tags'] or []),
-            timestamp_auth=_dumps(transaction['timestamp_auth']),
-            authorized=_dumps(transaction['authorized']),
-            unauthorized_reason=_dumps(transaction['unauthorized_reason']),
-            primary='true' if transaction.get('primary') else 'false',
-            inbound='true' if transaction.get('inbound') else 'false',
+        result = await self._mutation(
+            self.FIELD_UPSERT_AUTHORIZATION_TRANSACTION,
+            dict(
+                tenant=tenant,
+                account_tag=account_tag,
+                transaction_tag=transaction['transaction_tag'],
+                source=transaction['source'],
+                source_ip=transaction['source_ip'],
+                destination=transaction['destination'],
+                carrier_ip=transaction['carrier_ip'],
+                tags=transaction['tags'],
+                timestamp_auth=transaction['timestamp_auth'],
+                authorized=transaction['authorized'],
+                unauthorized_reason=transaction['unauthorized_reason'],
+                primary=bool(transaction.get('primary')),
+                inbound=bool(transaction.get('inbound')),
+            ),
         )
-        result = await self._query(query=query)
         return (
             result['data']['upsertTransaction']['id'] is not None
             if result is not None
@@ -553,13 +1118,16 @@ class APIService(object):
     async def commit_account_transaction(
         self, tenant: str, account_tag: str, transaction_tag: str, fee: int
     ) -> Optional[dict]:
-        query = self.QUERY_COMMIT_ACCOUNT_TRANSACTION % dict(
-            tenant=_dumps(tenant),
-            account_tag=_dumps(account_tag),
-            transaction_tag=_dumps(transaction_tag),
-            fee=_dumps(fee, 0),
+        result = await self._mutation(
+            self.FIELD_COMMIT_ACCOUNT_TRANSACTION,
+            dict(
+                tenant=tenant,
+                account_tag=account_tag,
+                transaction_tag=transaction_tag,
+                fee=fee,
+            ),
         )
-        result = await self._query(query=query)
+        self._invalidate_account(tenant, account_tag)
         return (
             result['data']['commitAccountTransaction']['ok']
             if result is not None
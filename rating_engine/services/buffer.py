@@ -0,0 +1,98 @@
+import asyncio
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+
+class WriteBehindBuffer(object):
+    """Items are handed over to flush in batches, as soon as max_size of them
+    are pending or max_delay seconds after the first of them was added
+
+    A batch whose flush fails is retried max_retries times, retry_delay seconds
+    later and twice as late every time after, then handed over to fallback
+    if any; it is only dropped when the fallback fails too.
+    """
+
+    _items: List[Any]
+    _timer: Optional[asyncio.TimerHandle]
+    _flushing: Set[asyncio.Future]
+
+    def __init__(
+        self,
+        flush: Callable[[List[Any]], Awaitable[Any]],
+        max_size: int = 100,
+        max_delay: float = 0.2,
+        max_retries: int = 2,
+        retry_delay: float = 0.1,
+        fallback: Optional[Callable[[List[Any]], Awaitable[Any]]] = None,
+    ):
+        self._flush = flush
+        self._fallback = fallback
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._items = []
+        self._timer = None
+        self._flushing = set()
+        self._stats = dict(
+            items=0, flushes=0, size_flushes=0, retries=0, fallbacks=0, errors=0
+        )
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, item: Any):
+        self._items.append(item)
+        self._stats['items'] += 1
+        if len(self._items) >= self.max_size:
+            self._stats['size_flushes'] += 1
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.max_delay, self.flush
+            )
+
+    def flush(self) -> Optional[asyncio.Future]:
+        """Hand the pending items over, without waiting for flush to complete"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._items:
+            return None
+        items, self._items = self._items, []
+        self._stats['flushes'] += 1
+        future = asyncio.ensure_future(self._flush_with_retries(items))
+        self._flushing.add(future)
+        future.add_done_callback(self._flushed)
+        return future
+
+    async def _flush_with_retries(self, items: List[Any]) -> Any:
+        delay = self.retry_delay
+        for _ in range(self.max_retries):
+            try:
+                return await self._flush(items)
+            except Exception:
+                self._stats['retries'] += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+        try:
+            return await self._flush(items)
+        except Exception:
+            if self._fallback is None:
+                raise
+        self._stats['fallbacks'] += 1
+        return await self._fallback(items)
+
+    def _flushed(self, future: asyncio.Future):
+        self._flushing.discard(future)
+        if future.cancelled() or future.exception() is not None:
+            self._stats['errors'] += 1
+
+    async def close(self):
+        """Flush the pending items and wait for all the flushes to complete"""
+        self.flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats, pending=len(self._items), flushing=len(self._flushing))
@@ -1,40 +1,335 @@
-import json
+import asyncio
+import heapq
 
+from collections import deque
+from contextvars import ContextVar
 from datetime import datetime
-from pytz import timezone
+from functools import wraps
+from itertools import count
 from time import time
-from typing import Any, Callable, Optional
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
 
-from aio_pika import connect_robust, Channel, Connection
-from aio_pika.message import Message
+from aio_pika import connect_robust, Channel, Connection, DeliveryMode
+from aio_pika.exceptions import ChannelPreconditionFailed
+from aio_pika.message import IncomingMessage, Message
 from aio_pika.patterns import RPC
 from aio_pika.patterns.rpc import RPCMessageTypes
 from pamqp.specification import Basic  # type: ignore
 
 from ..enums import RPCCallPriority
+from .codec import (
+    COMPRESSIONS,
+    Codec,
+    JsonCodec,
+    MsgpackCodec,
+    compress,
+    decompress,
+    encode_datetime,
+    get_available_compressions,
+    get_content_codecs,
+)
 
 
-UTC = timezone('UTC')
+# AMQP priority of the calls, RabbitMQ keeps a sub-queue per priority level
+AMQP_PRIORITIES = {
+    RPCCallPriority.LOW: 1,
+    RPCCallPriority.MEDIUM: 2,
+    RPCCallPriority.HIGH: 3,
+}
+
+MAX_PRIORITY = max(AMQP_PRIORITIES.values())
+
+# the priorities published before, the RPCCallPriority values themselves
+LEGACY_PRIORITIES = {
+    priority.value: amqp_priority for priority, amqp_priority in AMQP_PRIORITIES.items()
+}
+
+
+def get_call_priority(priority: Optional[int]) -> int:
+    """Priority of an incoming call from 0 to MAX_PRIORITY, the legacy ones
+    mapped onto it and any other clamped, as RabbitMQ does"""
+    priority = priority or 0
+    return max(0, min(LEGACY_PRIORITIES.get(priority, priority), MAX_PRIORITY))
+
+
+QUEUE_MIGRATIONS = ('recreate', 'keep', 'fail')
+
+# priority of the RPC call being handled, in the task handling it
+call_priority: ContextVar[int] = ContextVar('call_priority', default=0)
+
+# codec and content encoding of the RPC message being handled
+message_format: ContextVar[Optional[Tuple[Codec, Optional[str]]]] = ContextVar(
+    'message_format', default=None
+)
+
+
+class PriorityLimiter(object):
+    """Lets at most concurrency callers through at once, the waiting ones by
+    priority, the highest first, then in arrival order"""
+
+    _waiters: List[Tuple[int, int, asyncio.Future]]
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        self._waiters = []
+        self._counter = count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0):
+        if self.running < self.concurrency and not self._waiters:
+            self.running += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled after being handed the slot over, pass it on
+            if not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # the slot is handed over, running stays the same
+                future.set_result(None)
+                return
+        self.running -= 1
+
+
+class ConfirmTracker(object):
+    """Publishes in the background, with at most window publishes waiting for
+    their broker confirm; the failed ones are kept in a retry buffer of up to
+    retry_size and published again retry_delay seconds later, up to retries
+    times, then dropped"""
+
+    _retries: Deque[Tuple[str, Message, int]]
+    _pending: Set[asyncio.Future]
+    _timer: Optional[asyncio.TimerHandle]
+
+    def __init__(
+        self,
+        publish: Callable[[str, Message], Awaitable[bool]],
+        window: int,
+        retries: int = 3,
+        retry_size: int = 10000,
+        retry_delay: float = 1,
+    ):
+        self._publish = publish
+        self.window = window
+        self.retries = retries
+        self.retry_size = retry_size
+        self.retry_delay = retry_delay
+        self._window = asyncio.Semaphore(window)
+        self._retries = deque()
+        self._pending = set()
+        self._timer = None
+        self._outstanding = 0
+        self._stats = dict(
+            published=0, confirmed=0, failed=0, retried=0, dropped=0, max_outstanding=0
+        )
+
+    async def submit(self, routing_key: str, message: Message, attempt: int = 0):
+        """Wait for room in the window only, not for the confirm"""
+        await self._window.acquire()
+        self._outstanding += 1
+        self._stats['published'] += 1
+        self._stats['max_outstanding'] = max(
+            self._stats['max_outstanding'], self._outstanding
+        )
+        future = asyncio.ensure_future(self._confirm(routing_key, message, attempt))
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    async def _confirm(self, routing_key: str, message: Message, attempt: int):
+        try:
+            confirmed = await self._publish(routing_key, message)
+        except Exception:
+            confirmed = False
+        finally:
+            self._outstanding -= 1
+            self._window.release()
+        if confirmed:
+            self._stats['confirmed'] += 1
+            return
+        self._stats['failed'] += 1
+        if attempt >= self.retries or len(self._retries) >= self.retry_size:
+            self._stats['dropped'] += 1
+            return
+        self._retries.append((routing_key, message, attempt + 1))
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.retry_delay, self._retry
+            )
+
+    def _retry(self) -> asyncio.Future:
+        self._timer = None
+        future = asyncio.ensure_future(self._resubmit())
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    async def _resubmit(self):
+        while self._retries:
+            routing_key, message, attempt = self._retries.popleft()
+            self._stats['retried'] += 1
+            await self.submit(routing_key, message, attempt)
+
+    async def close(self):
+        """Wait for the outstanding confirms, publishing the buffered retries
+        at once; the publishes failing meanwhile are dropped"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._retry()
+        while self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+                self._stats['dropped'] += len(self._retries)
+                self._retries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            self._stats, outstanding=self._outstanding, retry_pending=len(self._retries)
+        )
 
 
 class JsonRPC(RPC):
-    SERIALIZER = json
-    CONTENT_TYPE = 'application/json'
+    """RPC with JSON messages, or the content type of codec, compressed with
+    compression when at least compression_threshold bytes long; the calls
+    are decoded by their content type and encoding, JSON by default, and
+    answered in the same content type, uncompressed"""
+
+    codec: Codec
+    codecs: Dict[str, Codec]
+    compression: Optional[str]
+    compression_threshold: int
+
+    def __init__(
+        self,
+        channel: Channel,
+        codec: Optional[Codec] = None,
+        codecs: Optional[Dict[str, Codec]] = None,
+        compression: Optional[str] = None,
+        compression_threshold: int = 1024,
+    ):
+        super().__init__(channel)
+        self.codec = codec or JsonCodec()
+        self.codecs = codecs or {JsonCodec.content_type: JsonCodec()}
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    @classmethod
+    async def create(
+        cls,
+        channel: Channel,
+        *,
+        codec: Optional[Codec] = None,
+        codecs: Optional[Dict[str, Codec]] = None,
+        compression: Optional[str] = None,
+        compression_threshold: int = 1024,
+        **kwargs,
+    ) -> 'JsonRPC':
+        rpc = cls(
+            channel,
+            codec=codec,
+            codecs=codecs,
+            compression=compression,
+            compression_threshold=compression_threshold,
+        )
+        await rpc.initialize(**kwargs)
+        return rpc
+
+    @property  # type: ignore
+    def CONTENT_TYPE(self) -> str:  # type: ignore
+        return self._get_message_format()[0].content_type
+
+    def _get_message_format(self) -> Tuple[Codec, Optional[str]]:
+        return message_format.get() or (self.codec, None)
+
+    def _set_message_format(self, message: IncomingMessage):
+        codec = self.codecs.get(message.content_type or '')
+        if codec is None:
+            codec = self.codecs[JsonCodec.content_type]
+        # other encodings, e.g. utf-8, are the ones of plain JSON clients
+        content_encoding: Optional[str] = message.content_encoding
+        if content_encoding not in COMPRESSIONS:
+            content_encoding = None
+        message_format.set((codec, content_encoding))
+
+    async def on_call_message(self, method_name: str, message: IncomingMessage):
+        call_priority.set(get_call_priority(message.priority))
+        self._set_message_format(message)
+        await super().on_call_message(method_name, message)
+
+    async def on_result_message(self, message: IncomingMessage):
+        self._set_message_format(message)
+        await super().on_result_message(message)
+
+    def create_message(self, kwargs: Optional[dict], **properties) -> Message:
+        """Call message of the kwargs, encoded by codec"""
+        body = self.codec.dumps(kwargs or {}, default=self.serialize_default)
+        if self.compression and len(body) >= self.compression_threshold:
+            body = compress(body, self.compression)
+            properties['content_encoding'] = self.compression
+        return Message(
+            body=body,
+            content_type=self.codec.content_type,
+            type=RPCMessageTypes.call.value,
+            timestamp=time(),
+            **properties,
+        )
+
+    async def call(
+        self,
+        method_name: str,
+        kwargs: Optional[dict] = None,
+        *,
+        expiration: Optional[int] = None,
+        priority: int = 5,
+        delivery_mode: DeliveryMode = RPC.DELIVERY_MODE,
+    ) -> Any:
+        result_queue = self.result_queue
+        assert result_queue is not None, "the RPC is not initialized"
+        future = self.create_future()
+        message = self.create_message(
+            kwargs,
+            priority=priority,
+            correlation_id=id(future),
+            delivery_mode=delivery_mode,
+            reply_to=result_queue.name,
+            headers={'From': result_queue.name},
+        )
+        if expiration is not None:
+            message.expiration = expiration
+        await self.channel.default_exchange.publish(
+            message, routing_key=method_name, mandatory=True
+        )
+        return await future
 
     def deserialize(self, data: bytes) -> Any:
-        value = self.SERIALIZER.loads(data.decode('utf-8'))
-        if type(value) == dict and value.get('error'):
+        codec, content_encoding = self._get_message_format()
+        if content_encoding:
+            data = decompress(data, content_encoding)
+        value = codec.loads(data)
+        if isinstance(value, dict) and value.get('error'):
             return RuntimeError(value['error']['message'])
         return value
 
     def serialize(self, data: Any) -> bytes:
-        return self.SERIALIZER.dumps(
-            data, ensure_ascii=False, default=self.serialize_default
-        ).encode('utf-8')
+        codec = self._get_message_format()[0]
+        return codec.dumps(data, default=self.serialize_default)
 
     def serialize_default(self, v: Any):
         if isinstance(v, datetime):
-            return v.astimezone(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+            return encode_datetime(v)
         return repr(v)
 
     def serialize_exception(self, exception: Exception) -> bytes:
@@ -50,19 +345,106 @@ class JsonRPC(RPC):
 
 
 class BusService(object):
+    """RPC over RabbitMQ; prefetch_count bounds the unacknowledged calls
+    delivered to the engine, 0 for no bound, and method_concurrency the calls
+    of a method handled at once, optionally each method on its own channel
+    with the concurrency of the method as prefetch; concurrency bounds the
+    calls of all the methods handled at once.
+
+    The method queues are priority queues up to max_priority, 0 for plain
+    ones, and the calls waiting for a concurrency limit are handled by
+    priority too. An existing queue declared without the same priority is
+    deleted and declared again if empty, with queue_migration recreate,
+    otherwise consumed as it is, or with queue_migration fail not at all.
+
+    rpc_call_async waits for the broker confirm of each call, unless
+    publish_window is set: the confirms are then awaited in the background
+    by a ConfirmTracker, which retries the failed publishes.
+
+    The calls are sent in payload_format, json with codec or msgpack, and
+    compressed with compression above compression_threshold bytes"""
+
     connection: Connection
     channel: Channel
     rpc: JsonRPC
+    _method_rpcs: Dict[str, JsonRPC]
+    _limiter: Optional[PriorityLimiter]
+    confirms: Optional[ConfirmTracker] = None
 
-    def __init__(self, messagebus_uri: str):
+    def __init__(
+        self,
+        messagebus_uri: str,
+        codec: Optional[Codec] = None,
+        prefetch_count: int = 0,
+        method_concurrency: Optional[Dict[str, int]] = None,
+        channel_per_method: bool = False,
+        concurrency: int = 0,
+        max_priority: int = MAX_PRIORITY,
+        queue_migration: str = 'recreate',
+        publish_window: int = 0,
+        publish_retries: int = 3,
+        publish_retry_size: int = 10000,
+        publish_retry_delay: float = 1,
+        payload_format: str = 'json',
+        compression: Optional[str] = None,
+        compression_threshold: int = 1024,
+    ):
+        if queue_migration not in QUEUE_MIGRATIONS:
+            raise ValueError("unknown queue migration %s" % queue_migration)
+        self._codecs = get_content_codecs(codec or JsonCodec())
+        content_type = dict(
+            json=JsonCodec.content_type, msgpack=MsgpackCodec.content_type
+        ).get(payload_format)
+        if content_type not in self._codecs:
+            raise ValueError("payload format %s is not installed" % payload_format)
+        if compression and compression not in get_available_compressions():
+            raise ValueError("compression %s is not installed" % compression)
         self._messagebus_uri = messagebus_uri
+        self._codec = self._codecs[content_type]
+        self._compression = compression or None
+        self._compression_threshold = compression_threshold
+        self._prefetch_count = prefetch_count
+        self._method_concurrency = method_concurrency or {}
+        self._channel_per_method = channel_per_method
+        self._limiter = PriorityLimiter(concurrency) if concurrency else None
+        self.max_priority = max_priority
+        self._queue_migration = queue_migration
+        self._publish_window = publish_window
+        self._publish_retries = publish_retries
+        self._publish_retry_size = publish_retry_size
+        self._publish_retry_delay = publish_retry_delay
+        self._method_rpcs = {}
+        self.method_stats: Dict[str, Dict[str, int]] = {}
+        self.queue_priorities: Dict[str, int] = {}
+        self.queue_migrations: Dict[str, str] = {}
+
+    async def _create_rpc(self, channel: Channel, prefetch_count: int) -> JsonRPC:
+        if prefetch_count:
+            await channel.set_qos(prefetch_count=prefetch_count)
+        return await JsonRPC.create(
+            channel,
+            codec=self._codec,
+            codecs=self._codecs,
+            compression=self._compression,
+            compression_threshold=self._compression_threshold,
+        )
 
     async def connect(self):
         self.connection = await connect_robust(self._messagebus_uri)
         self.channel = await self.connection.channel()
-        self.rpc = await JsonRPC.create(self.channel)
+        self.rpc = await self._create_rpc(self.channel, self._prefetch_count)
+        if self._publish_window:
+            self.confirms = ConfirmTracker(
+                self._publish,
+                window=self._publish_window,
+                retries=self._publish_retries,
+                retry_size=self._publish_retry_size,
+                retry_delay=self._publish_retry_delay,
+            )
 
     async def close(self):
+        if self.confirms is not None:
+            await self.confirms.close()
         await self.connection.close()
 
     async def rpc_call(
@@ -73,7 +455,10 @@ class BusService(object):
         priority: RPCCallPriority = RPCCallPriority.MEDIUM,
     ) -> Optional[dict]:
         return await self.rpc.call(
-            method, kwargs=kwargs, expiration=expiration, priority=priority.value
+            method,
+            kwargs=kwargs,
+            expiration=expiration,
+            priority=AMQP_PRIORITIES[priority],
         )
 
     async def rpc_call_async(
@@ -83,19 +468,114 @@ class BusService(object):
         expiration: int = 10,
         priority: RPCCallPriority = RPCCallPriority.MEDIUM,
     ) -> bool:
-        message = Message(
-            body=self.rpc.serialize(kwargs or {}),
-            type=RPCMessageTypes.call.value,
-            timestamp=time(),
-            priority=priority.value,
+        message = self.rpc.create_message(
+            kwargs,
+            priority=AMQP_PRIORITIES[priority],
             delivery_mode=self.rpc.DELIVERY_MODE,
         )
         if expiration is not None:
             message.expiration = expiration
+        if self.confirms is not None:
+            await self.confirms.submit(method, message)
+            return True
+        return await self._publish(method, message)
+
+    async def _publish(self, routing_key: str, message: Message) -> bool:
         response = await self.channel.default_exchange.publish(
-            message, routing_key=method, mandatory=True,
+            message, routing_key=routing_key, mandatory=True,
         )
         return isinstance(response, Basic.Ack)
 
     async def rpc_register(self, method: str, func: Callable, auto_delete: bool = True):
-        await self.rpc.register(method, func, auto_delete=auto_delete)
+        # the calls wait for the method limit before taking a shared slot
+        if self._limiter is not None:
+            func = self._limit_concurrency('*', func, self._limiter)
+        concurrency = self._method_concurrency.get(method)
+        if concurrency:
+            func = self._limit_concurrency(method, func, concurrency)
+        rpc = self.rpc
+        if self._channel_per_method:
+            rpc = self._method_rpcs[method] = await self._create_rpc(
+                await self.connection.channel(),
+                concurrency or self._prefetch_count,
+            )
+        arguments = await self._queue_arguments(method, auto_delete)
+        await rpc.register(method, func, auto_delete=auto_delete, arguments=arguments)
+
+    async def _declare_queue(self, method: str, auto_delete: bool, arguments: dict):
+        # on a channel of its own, a failed declaration closes the channel
+        channel = await self.connection.channel()
+        try:
+            arguments = dict(arguments, **{'x-dead-letter-exchange': JsonRPC.DLX_NAME})
+            await channel.declare_queue(
+                method, auto_delete=auto_delete, arguments=arguments
+            )
+        finally:
+            if not channel.is_closed:
+                await channel.close()
+
+    async def _delete_empty_queue(self, method: str) -> bool:
+        channel = await self.connection.channel()
+        try:
+            await channel.queue_delete(method, if_empty=True)
+            return True
+        except ChannelPreconditionFailed:
+            return False
+        finally:
+            if not channel.is_closed:
+                await channel.close()
+
+    async def _queue_arguments(self, method: str, auto_delete: bool) -> dict:
+        """The declaration arguments of the method queue, with x-max-priority
+        unless an existing queue without it cannot be migrated"""
+        if not self.max_priority:
+            self.queue_priorities[method] = 0
+            return {}
+        arguments = {'x-max-priority': self.max_priority}
+        try:
+            await self._declare_queue(method, auto_delete, arguments)
+        except ChannelPreconditionFailed:
+            if self._queue_migration == 'fail':
+                raise
+            if self._queue_migration == 'recreate' and await self._delete_empty_queue(
+                method
+            ):
+                self.queue_migrations[method] = 'recreated'
+            else:
+                self.queue_migrations[method] = 'kept'
+                self.queue_priorities[method] = 0
+                return {}
+        self.queue_priorities[method] = self.max_priority
+        return arguments
+
+    def _limit_concurrency(
+        self, method: str, func: Callable, concurrency: Any
+    ) -> Callable:
+        """Handle at most concurrency calls of the method at once, the other
+        ones wait their turn, by priority; concurrency is either a number or a
+        limiter shared with other methods"""
+        if isinstance(concurrency, PriorityLimiter):
+            limiter = concurrency
+        else:
+            limiter = PriorityLimiter(concurrency)
+        stats = self.method_stats.setdefault(
+            method,
+            dict(concurrency=limiter.concurrency, running=0, waiting=0, max_waiting=0),
+        )
+
+        @wraps(func)
+        async def limited(**kwargs):
+            stats['waiting'] += 1
+            stats['max_waiting'] = max(stats['max_waiting'], stats['waiting'])
+            try:
+                await limiter.acquire(call_priority.get())
+            finally:
+                stats['waiting'] -= 1
+            stats['running'] += 1
+            try:
+                return await func(**kwargs)
+            finally:
+                stats['running'] -= 1
+                limiter.release()
+
+        return limited
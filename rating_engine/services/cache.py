@@ -0,0 +1,219 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from ..enums import AccountProfile
+
+
+# tenant, account_tag, destination, destination_account_tag and profile
+LookupKey = Tuple[str, Optional[str], Optional[str], Optional[str], AccountProfile]
+
+
+class TTLCache(object):
+    """Least recently used cache whose entries expire ttl seconds after insertion"""
+
+    _entries: 'OrderedDict[Hashable, Tuple[float, Any]]'
+
+    def __init__(
+        self,
+        ttl: float,
+        maxsize: int = 10000,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > self._clock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires <= self._clock():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self._entries[key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            oldest, _ = self._entries.popitem(last=False)
+            self._removed(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        if key in self._entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        for key in tuple(self._entries):
+            self._remove(key)
+
+    def _remove(self, key: Hashable):
+        del self._entries[key]
+        self._removed(key)
+
+    def _removed(self, key: Hashable):
+        """Called whenever an entry leaves the cache"""
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return dict(
+            size=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=round(self.hits / lookups, 4) if lookups else 0.0,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+
+class AccountCache(TTLCache):
+    """Account and destination account snapshots of the API, by tenant,
+    account_tag, destination and destination_account_tag
+
+    A snapshot is dropped whenever a transaction of any of the accounts it
+    holds, linked accounts included, is changed through this engine; the
+    changes made by other engines are seen at the latest after ttl seconds.
+
+    Each invalidation bumps generation and is recorded against its account,
+    so a look-up is not cached if one of its accounts changed while it ran.
+    Only the latest maxsize invalidations are kept, look-ups started before
+    the older ones are not cached.
+    """
+
+    _keys_by_account: Dict[Tuple[str, Optional[str]], Set[Hashable]]
+    _accounts_by_key: Dict[Hashable, Tuple[Tuple[str, Optional[str]], ...]]
+    _invalidations: 'OrderedDict[Tuple[str, Optional[str]], int]'
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._keys_by_account = {}
+        self._accounts_by_key = {}
+        self._invalidations = OrderedDict()
+        self._forgotten = 0
+        self.generation = 0
+
+    @staticmethod
+    def get_key(
+        tenant: str,
+        account_tag: Optional[str],
+        destination: Optional[str],
+        destination_account_tag: Optional[str],
+        profile: AccountProfile = AccountProfile.FULL,
+    ) -> LookupKey:
+        return (tenant, account_tag, destination, destination_account_tag, profile)
+
+    def get_accounts(
+        self, key: LookupKey
+    ) -> Optional[Tuple[Optional[dict], Optional[dict]]]:
+        """Copies of the cached accounts, callers may pop their attributes"""
+        value = self.get(key)
+        return self.copy_accounts(value) if value is not None else None
+
+    @staticmethod
+    def copy_accounts(
+        accounts: Tuple[Optional[dict], Optional[dict]]
+    ) -> Tuple[Optional[dict], Optional[dict]]:
+        return (
+            dict(accounts[0]) if accounts[0] is not None else None,
+            dict(accounts[1]) if accounts[1] is not None else None,
+        )
+
+    def put_accounts(
+        self,
+        key: LookupKey,
+        accounts: Tuple[Optional[dict], Optional[dict]],
+        generation: int,
+    ):
+        """Cache the accounts looked up at generation, unless one of them has
+        been invalidated in the meantime"""
+        if generation < self._forgotten:
+            return
+        tenant = key[0]
+        account_tags = {
+            (tenant, item['account_tag'])
+            for account in accounts
+            if account is not None
+            for item in [account] + list(account.get('linked_accounts') or ())
+        }
+        if any(
+            self._invalidations.get(account_tag, -1) >= generation
+            for account_tag in account_tags
+        ):
+            return
+        if key in self._entries:
+            self._removed(key)
+        self.put(key, accounts)
+        self._accounts_by_key[key] = tuple(account_tags)
+        for account_tag in account_tags:
+            self._keys_by_account.setdefault(account_tag, set()).add(key)
+
+    def invalidate_account(self, tenant: str, account_tag: Optional[str]):
+        account = (tenant, account_tag)
+        self._invalidations[account] = self.generation
+        self._invalidations.move_to_end(account)
+        while len(self._invalidations) > self.maxsize:
+            _, generation = self._invalidations.popitem(last=False)
+            self._forgotten = generation + 1
+        self.generation += 1
+        for key in tuple(self._keys_by_account.get(account, ())):
+            self.invalidate(key)
+
+    def _removed(self, key: Hashable):
+        for account_tag in self._accounts_by_key.pop(key, ()):
+            keys = self._keys_by_account.get(account_tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_account[account_tag]
+
+
+class TransactionStateCache(TTLCache):
+    """Accounts, source, destination and carrier of the transactions authorized
+    or begun through this engine, by tenant and transaction_tag
+
+    The state of a transaction does not change once authorized, so entries
+    are only dropped at its end, on expiry or when the cache is full.
+    """
+
+    FIELDS = (
+        'account_tag',
+        'destination_account_tag',
+        'source',
+        'source_ip',
+        'destination',
+        'carrier_ip',
+    )
+
+    def get_state(self, tenant: str, transaction_tag: str) -> Optional[dict]:
+        state = self.get((tenant, transaction_tag))
+        return dict(state) if state is not None else None
+
+    def put_state(self, tenant: str, transaction_tag: str, state: dict):
+        """Keep the FIELDS of the state, unless it has no account"""
+        state = {field: state.get(field) for field in self.FIELDS}
+        if state['account_tag'] is None and state['destination_account_tag'] is None:
+            return
+        self.put((tenant, transaction_tag), state)
+
+    def invalidate_state(self, tenant: str, transaction_tag: str):
+        self.invalidate((tenant, transaction_tag))
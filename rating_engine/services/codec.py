@@ -0,0 +1,208 @@
+import json
+import zlib
+
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pytz import timezone
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+try:
+    import msgspec  # type: ignore
+except ImportError:  # pragma: no cover
+    msgspec = None  # type: ignore
+
+try:
+    import msgpack  # type: ignore
+except ImportError:  # pragma: no cover
+    msgpack = None  # type: ignore
+
+try:
+    import zstandard  # type: ignore
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+
+UTC = timezone('UTC')
+
+
+def encode_datetime(v: datetime) -> str:
+    return v.astimezone(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def default(v: Any) -> Any:
+    """Fallback of the encoders, for the values JSON has no type for"""
+    if isinstance(v, datetime):
+        return encode_datetime(v)
+    return repr(v)
+
+
+class Codec(ABC):
+    """JSON encoder and decoder working on UTF-8 bytes"""
+
+    name: str = ''
+    content_type: str = 'application/json'
+
+    @abstractmethod
+    def dumps(self, value: Any, default: Callable[[Any], Any] = default) -> bytes:
+        pass
+
+    @abstractmethod
+    def loads(self, data: bytes) -> Any:
+        pass
+
+
+class JsonCodec(Codec):
+    """Standard library json, the reference wire format"""
+
+    name = 'json'
+
+    def dumps(self, value: Any, default: Callable[[Any], Any] = default) -> bytes:
+        return json.dumps(value, ensure_ascii=False, default=default).encode('utf-8')
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data.decode('utf-8'))
+
+
+class OrjsonCodec(Codec):
+    """orjson, without the spaces after the separators; the datetimes are passed
+    to default, so they are converted to UTC as by the standard library codec"""
+
+    name = 'orjson'
+
+    OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME if orjson is not None else 0
+
+    def dumps(self, value: Any, default: Callable[[Any], Any] = default) -> bytes:
+        return orjson.dumps(value, default=default, option=self.OPTIONS)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+_SCALARS = frozenset((str, int, float, bool, type(None)))
+
+
+def _encode_datetimes(value: Any, default: Callable[[Any], Any]) -> Any:
+    """Copy of value with the datetimes passed to default, for the encoders
+    that would format them natively; the scalars are not walked into"""
+    kind = type(value)
+    if kind is dict:
+        return {
+            k: v if type(v) in _SCALARS else _encode_datetimes(v, default)
+            for k, v in value.items()
+        }
+    if kind is list or kind is tuple:
+        return [
+            v if type(v) in _SCALARS else _encode_datetimes(v, default) for v in value
+        ]
+    if isinstance(value, datetime):
+        return default(value)
+    return value
+
+
+class MsgspecCodec(Codec):
+    """msgspec, without the spaces after the separators; it would format the
+    datetimes natively, so they are passed to default before encoding and
+    converted to UTC as by the standard library codec"""
+
+    name = 'msgspec'
+
+    def __init__(self):
+        self._decoder = msgspec.json.Decoder()
+        self._encoders: Dict[Callable[[Any], Any], Any] = {}
+
+    def dumps(self, value: Any, default: Callable[[Any], Any] = default) -> bytes:
+        encoder = self._encoders.get(default)
+        if encoder is None:
+            encoder = self._encoders[default] = msgspec.json.Encoder(enc_hook=default)
+        return encoder.encode(_encode_datetimes(value, default))
+
+    def loads(self, data: bytes) -> Any:
+        return self._decoder.decode(data)
+
+
+class MsgpackCodec(Codec):
+    """msgpack, for the bus only; the datetimes are encoded as timestamp
+    extensions, the naive ones taken as UTC, and decoded as UTC datetimes"""
+
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def dumps(self, value: Any, default: Callable[[Any], Any] = default) -> bytes:
+        def encode(v: Any) -> Any:
+            if isinstance(v, datetime) and v.tzinfo is None:
+                return UTC.localize(v)
+            return default(v)
+
+        return msgpack.packb(value, datetime=True, default=encode)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, timestamp=3)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'msgspec': MsgspecCodec,
+}
+
+
+def get_available_codecs() -> Dict[str, Any]:
+    return {
+        name: codec
+        for name, codec in CODECS.items()
+        if dict(orjson=orjson, msgspec=msgspec).get(name, json) is not None
+    }
+
+
+FORMATS = ('json', 'msgpack')
+
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+COMPRESSIONS = ('deflate', 'zstd')
+
+
+def get_content_codecs(json_codec: Codec) -> Dict[str, Codec]:
+    """Codecs of the bus messages by content type, msgpack if installed"""
+    codecs = {json_codec.content_type: json_codec}
+    if msgpack is not None:
+        codecs.update(dict.fromkeys(MSGPACK_CONTENT_TYPES, MsgpackCodec()))
+    return codecs
+
+
+def get_available_compressions() -> Tuple[str, ...]:
+    return tuple(
+        name for name in COMPRESSIONS if name != 'zstd' or zstandard is not None
+    )
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress as content encoding deflate, that is zlib, or zstd"""
+    if encoding == 'deflate':
+        return zlib.compress(data)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError("unsupported content encoding %s" % encoding)
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'deflate':
+        return zlib.decompress(data)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("unsupported content encoding %s" % encoding)
+
+
+def get_codec(name: Optional[str] = 'json') -> Codec:
+    """Codec by name; auto picks the fastest one installed, json always is"""
+    name = name or 'json'
+    available = get_available_codecs()
+    if name == 'auto':
+        name = next(n for n in ('orjson', 'msgspec', 'json') if n in available)
+    if name not in available:
+        raise ValueError("codec %s is not installed" % name)
+    return available[name]()
@@ -1,11 +1,16 @@
+import asyncio
+
 from datetime import datetime
 from pytz import timezone
-from typing import Optional, List
+from typing import Any, Awaitable, Iterable, Optional, List, Tuple
 
 from ..schema import engine as schema
-from ..enums import MethodName, RPCCallPriority
+from ..enums import AccountProfile, MethodName, RPCCallPriority
+from . import accumulator as accumulator_service
 from . import api as api_service
+from . import buffer as buffer_service
 from . import bus as bus_service
+from . import cache as cache_service
 from . import rater as rater_service
 
 
@@ -16,13 +21,38 @@ class EngineService(object):
     _api: api_service.APIService
     _bus: bus_service.BusService
     _rater: rater_service.RaterService
+    _pending_cost: accumulator_service.PendingCostService
+
+    MAX_CONCURRENT_MUTATIONS = 8
 
     def __init__(
-        self, api: api_service.APIService, bus: bus_service.BusService, tz=None
+        self,
+        api: api_service.APIService,
+        bus: bus_service.BusService,
+        tz=None,
+        max_concurrent_mutations: Optional[int] = None,
+        transaction_states: Optional[cache_service.TransactionStateCache] = None,
+        authorization_batch_size: int = 0,
+        authorization_batch_delay: float = 0.2,
     ):
         self._api = api
         self._bus = bus
+        self._transaction_states = transaction_states
+        self._authorization_records = (
+            buffer_service.WriteBehindBuffer(
+                self._publish_authorization_transactions,
+                max_size=authorization_batch_size,
+                max_delay=authorization_batch_delay,
+                fallback=self._write_authorization_transactions,
+            )
+            if authorization_batch_size
+            else None
+        )
+        self._max_concurrent_mutations = (
+            max_concurrent_mutations or self.MAX_CONCURRENT_MUTATIONS
+        )
         self._rater = rater_service.RaterService(tz=tz)
+        self._pending_cost = accumulator_service.PendingCostService(self._rater)
 
     def get_api(self) -> api_service.APIService:
         return self._api
@@ -30,6 +60,62 @@ class EngineService(object):
     def set_api(self, api: api_service.APIService):
         self._api = api
 
+    @property
+    def authorization_records(self) -> Optional[buffer_service.WriteBehindBuffer]:
+        return self._authorization_records
+
+    async def close(self):
+        """Publish the authorization transactions still buffered"""
+        if self._authorization_records is not None:
+            await self._authorization_records.close()
+
+    @property
+    def transaction_states(self) -> Optional[cache_service.TransactionStateCache]:
+        return self._transaction_states
+
+    def _keep_transaction_state(self, request: Any):
+        if self._transaction_states is not None:
+            self._transaction_states.put_state(
+                request.tenant,
+                request.transaction_tag,
+                {
+                    field: getattr(request, field)
+                    for field in self._transaction_states.FIELDS
+                },
+            )
+
+    def _drop_transaction_state(self, tenant: str, transaction_tag: str):
+        if self._transaction_states is not None:
+            self._transaction_states.invalidate_state(tenant, transaction_tag)
+
+    async def _gather(self, awaitables: Iterable[Awaitable]) -> List[Any]:
+        """Await concurrently, at most max_concurrent_mutations at a time;
+        results and exceptions are returned in order"""
+        semaphore = asyncio.Semaphore(self._max_concurrent_mutations)
+
+        async def bounded(awaitable: Awaitable) -> Any:
+            async with semaphore:
+                return await awaitable
+
+        return await asyncio.gather(
+            *(bounded(awaitable) for awaitable in awaitables), return_exceptions=True
+        )
+
+    async def _gather_mutations(self, awaitables: Iterable[Awaitable]) -> List[Any]:
+        """Await the mutations of several accounts; gathered when the API
+        batches them into one document, which may leave the accounts other than
+        the failing one written, otherwise awaited in order up to the first
+        failure so the accounts after it are left untouched"""
+        if self._api.batch_mutations:
+            return await self._gather(awaitables)
+        results = []
+        for awaitable in awaitables:
+            result = await awaitable
+            results.append(result)
+            if result is None:
+                break
+        return results
+
     async def authorization(
         self, request: schema.AuthorizationRequest
     ) -> schema.AuthorizationResponse:
@@ -48,6 +134,7 @@ class EngineService(object):
             account_tag=request.account_tag,
             destination_account_tag=request.destination_account_tag,
             destination=request.destination,
+            profile=AccountProfile.AUTHORIZATION,
         )
         # check the account
         if request.account_tag and account is None:
@@ -114,11 +201,9 @@ class EngineService(object):
             linked_accounts = account_object.pop('linked_accounts', [])
             for _, item in enumerate([account_object] + linked_accounts):
                 # apply pending transactions to balance
-                balance = item['balance']
-                for pending_transaction in item['running_transactions']:
-                    balance -= self._rater.get_transaction_fee(
-                        transaction=pending_transaction
-                    )
+                balance = item['balance'] - self._pending_cost.get_pending_cost(
+                    request.tenant, item['account_tag'], item['running_transactions']
+                )
                 # verify the max_concurrent_transactions attribute
                 if item['max_concurrent_transactions'] is not None:
                     account_authorized = item['max_concurrent_transactions'] > len(
@@ -164,7 +249,7 @@ class EngineService(object):
                 if not inbound and item['type'] == 'PREPAID':
                     destination_rate = item['destination_rate']
                     res = self._rater.get_maximum_allowed_units_for_transaction(
-                        balance, destination_rate
+                        balance, destination_rate, request.timestamp_auth
                     )
                     account_authorized, max_units = res
                     max_available_units = min(max_available_units, max_units)
@@ -204,29 +289,41 @@ class EngineService(object):
             carriers=authorization_response.carriers,
             max_available_units=authorization_response.max_available_units,
         )
-        await self._bus.rpc_call_async(
-            MethodName.AUTHORIZATION_TRANSACTION.value,
-            dict(request=auth_tx_request.dict()),
-            priority=RPCCallPriority.LOW,
-        )
+        if self._authorization_records is not None:
+            self._authorization_records.add(auth_tx_request.dict())
+        else:
+            await self._bus.rpc_call_async(
+                MethodName.AUTHORIZATION_TRANSACTION.value,
+                dict(request=auth_tx_request.dict()),
+                priority=RPCCallPriority.LOW,
+            )
+        # the transaction may begin and end without its accounts
+        if (
+            authorization_response.authorized
+            or authorization_response.authorized_destination
+        ):
+            self._keep_transaction_state(request)
         # return the response
         return authorization_response
 
     async def authorization_transaction(
         self, request: schema.AuthorizationTransactionRequest
     ) -> schema.AuthorizationTransactionResponse:
-        for (account_tag, authorized, inbound, account_tags) in (
-            (request.account_tag, request.authorized, False, request.account_tags),
-            (
-                request.destination_account_tag,
-                request.authorized_destination,
-                True,
-                request.destination_account_tags,
-            ),
-        ):
-            if account_tag is None:
-                continue
-            response = await self._api.upsert_authorization_transaction(
+        items = [
+            (account_tag, authorized, inbound, account_tags)
+            for (account_tag, authorized, inbound, account_tags) in (
+                (request.account_tag, request.authorized, False, request.account_tags),
+                (
+                    request.destination_account_tag,
+                    request.authorized_destination,
+                    True,
+                    request.destination_account_tags,
+                ),
+            )
+            if account_tag is not None
+        ]
+        responses = await self._gather(
+            self._api.upsert_authorization_transaction(
                 tenant=request.tenant,
                 account_tag=account_tag,
                 transaction=dict(
@@ -245,16 +342,52 @@ class EngineService(object):
                     primary=True,
                 ),
             )
+            for (account_tag, authorized, inbound, account_tags) in items
+        )
+        for (account_tag, _, _, _), response in zip(items, responses):
+            if isinstance(response, BaseException):
+                raise response
             if response is None:
                 return schema.AuthorizationTransactionResponse(
                     failed_account_tag=account_tag, failed_reason='INTERNAL_ERROR',
                 )
         return schema.AuthorizationTransactionResponse(ok=True)
 
+    async def _publish_authorization_transactions(self, requests: List[dict]):
+        await self._bus.rpc_call_async(
+            MethodName.AUTHORIZATION_TRANSACTIONS.value,
+            dict(request=requests),
+            priority=RPCCallPriority.LOW,
+        )
+
+    async def _write_authorization_transactions(self, requests: List[dict]):
+        """Write the buffered authorization transactions the bus would not
+        take to the API directly"""
+        await self.authorization_transactions(
+            [schema.AuthorizationTransactionRequest(**request) for request in requests]
+        )
+
+    async def authorization_transactions(
+        self, requests: List[schema.AuthorizationTransactionRequest]
+    ) -> List[schema.AuthorizationTransactionResponse]:
+        """Record a batch of authorization transactions, all at once"""
+        responses = await self._gather(
+            self.authorization_transaction(request) for request in requests
+        )
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+        return responses
+
     async def _restore_transaction_state_from_auth_request(
         self, tenant: str, transaction_tag: str
     ) -> Optional[dict]:
-        state: dict = {}
+        # kept at authorization or begin, look the primary transactions up if not
+        if self._transaction_states is not None:
+            state = self._transaction_states.get_state(tenant, transaction_tag)
+            if state is not None:
+                return state
+        state = {}
         txs = await self._api.get_primary_transactions_by_tenant_and_tag(
             tenant, transaction_tag
         )
@@ -269,7 +402,11 @@ class EngineService(object):
             state.setdefault('source_ip', tx['source_ip'])
             state.setdefault('destination', tx['destination'])
             state.setdefault('carrier_ip', tx['carrier_ip'])
-        return state if state != {} else None
+        if state == {}:
+            return None
+        if self._transaction_states is not None:
+            self._transaction_states.put_state(tenant, transaction_tag, state)
+        return state
 
     async def begin_transaction(
         self, request: schema.BeginTransactionRequest
@@ -300,6 +437,7 @@ class EngineService(object):
             account_tag=request.account_tag,
             destination_account_tag=request.destination_account_tag,
             destination=request.destination,
+            profile=AccountProfile.BEGIN,
         )
         # check the account
         if request.account_tag and account is None:
@@ -325,32 +463,57 @@ class EngineService(object):
                 failed_account_tag=request.destination_account_tag,
                 failed_reason='NOT_ACTIVE',
             )
-        # write the db with the transaction
+        # write the db with the transaction, all the accounts at once
+        items: List[Tuple[dict, bool, bool]] = []
         for account, inbound in ((account, False), (destination_account, True)):
             if account is None:
                 continue
             linked_accounts = account.pop('linked_accounts', [])
             for n, item in enumerate([account] + linked_accounts):
-                response = await self._api.begin_account_transaction(
+                items.append((item, inbound, n == 0))
+        responses = await self._gather(
+            self._api.begin_account_transaction(
+                tenant=request.tenant,
+                account_tag=item['account_tag'],
+                destination_rate=item.get('destination_rate') if not inbound else None,
+                transaction_tag=request.transaction_tag,
+                source=request.source,
+                source_ip=request.source_ip,
+                destination=request.destination,
+                carrier_ip=request.carrier_ip,
+                timestamp_begin=request.timestamp_begin,
+                inbound=inbound,
+                primary=primary,
+            )
+            for item, inbound, primary in items
+        )
+        failed = [
+            (item, response)
+            for (item, _, _), response in zip(items, responses)
+            if response is None or isinstance(response, BaseException)
+        ]
+        if failed:
+            # roll back the accounts which began the transaction
+            await self._gather(
+                self._api.rollback_account_transaction(
                     tenant=request.tenant,
                     account_tag=item['account_tag'],
-                    destination_rate=item.get('destination_rate')
-                    if not inbound
-                    else None,
                     transaction_tag=request.transaction_tag,
-                    source=request.source,
-                    source_ip=request.source_ip,
-                    destination=request.destination,
-                    carrier_ip=request.carrier_ip,
-                    timestamp_begin=request.timestamp_begin,
-                    inbound=inbound,
-                    primary=(n == 0),
                 )
-                if response is None:
-                    return schema.BeginTransactionResponse(
-                        failed_account_tag=item['account_tag'],
-                        failed_reason='INTERNAL_ERROR',
-                    )
+                for (item, _, _), response in zip(items, responses)
+                if response is not None and not isinstance(response, BaseException)
+            )
+            item, response = failed[0]
+            if isinstance(response, BaseException):
+                raise response
+            return schema.BeginTransactionResponse(
+                failed_account_tag=item['account_tag'], failed_reason='INTERNAL_ERROR',
+            )
+        for (item, _, _), response in zip(items, responses):
+            self._pending_cost.begin_transaction(
+                request.tenant, item['account_tag'], response
+            )
+        self._keep_transaction_state(request)
 
         return schema.BeginTransactionResponse(ok=True)
 
@@ -378,6 +541,12 @@ class EngineService(object):
                     transaction_tag=request.transaction_tag,
                 )
                 ok = ok and bool(response)
+                if response:
+                    self._pending_cost.end_transaction(
+                        request.tenant, account_tag, request.transaction_tag
+                    )
+        if ok:
+            self._drop_transaction_state(request.tenant, request.transaction_tag)
         # return ok
         return schema.RollbackTransactionResponse(ok=ok)
 
@@ -405,6 +574,7 @@ class EngineService(object):
             request.tenant,
             account_tag=request.account_tag,
             destination_account_tag=request.destination_account_tag,
+            profile=AccountProfile.END,
         )
         # check the account
         if request.account_tag and account is None:
@@ -417,48 +587,67 @@ class EngineService(object):
                 failed_account_tag=request.destination_account_tag,
                 failed_reason='NOT_FOUND',
             )
-        # write the db with the end of transaction
+        # write the db with the end of transaction, all the accounts at once
+        items: List[dict] = []
         for account, _ in ((account, False), (destination_account, True)):
             if account is None:
                 continue
             linked_accounts = account.pop('linked_accounts', [])
-            for item in linked_accounts + [account]:
-                transaction = await self._api.end_account_transaction(
-                    tenant=request.tenant,
-                    account_tag=item['account_tag'],
-                    transaction_tag=request.transaction_tag,
-                    timestamp_end=request.timestamp_end,
-                )
-                if transaction is None:
-                    return schema.EndTransactionResponse(
-                        failed_account_tag=item['account_tag'],
-                        failed_reason='INTERNAL_ERROR',
-                    )
-                transaction['timestamp_end'] = request.timestamp_end
-                fee, duration = self._rater.get_transaction_fee_and_duration(
-                    transaction=transaction
-                )
-                tx = transaction.copy()
-                tx['tags'] = (transaction['tags'] or []) + (item['tags'] or [])
-                upsert_transaction = await self._api.upsert_transaction(
-                    request.tenant, item['account_tag'], tx, duration, fee
-                )
-                if upsert_transaction is None:
-                    return schema.EndTransactionResponse(
-                        failed_account_tag=item['account_tag'],
-                        failed_reason='INTERNAL_ERROR',
-                    )
-                commit_account_transaction = await self._api.commit_account_transaction(
-                    request.tenant, item['account_tag'], request.transaction_tag, fee
-                )
-                if commit_account_transaction is None:
-                    return schema.EndTransactionResponse(
-                        failed_account_tag=item['account_tag'],
-                        failed_reason='INTERNAL_ERROR',
-                    )
+            items.extend(linked_accounts + [account])
+        timestamp_end = request.timestamp_end
+        responses = await self._gather(
+            self._end_account_transaction(request, item, timestamp_end)
+            for item in items
+        )
+        # report the first failure, in the order the accounts used to be ended
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+            if response is not None:
+                return response
+        self._drop_transaction_state(request.tenant, request.transaction_tag)
         # return ok
         return schema.EndTransactionResponse(ok=True)
 
+    async def _end_account_transaction(
+        self, request: schema.EndTransactionRequest, item: dict, timestamp_end: datetime
+    ) -> Optional[schema.EndTransactionResponse]:
+        """End, record and commit the transaction of an account, in this order"""
+        transaction = await self._api.end_account_transaction(
+            tenant=request.tenant,
+            account_tag=item['account_tag'],
+            transaction_tag=request.transaction_tag,
+            timestamp_end=timestamp_end,
+        )
+        if transaction is None:
+            return schema.EndTransactionResponse(
+                failed_account_tag=item['account_tag'], failed_reason='INTERNAL_ERROR',
+            )
+        self._pending_cost.end_transaction(
+            request.tenant, item['account_tag'], request.transaction_tag
+        )
+        transaction['timestamp_end'] = timestamp_end
+        fee, duration = self._rater.get_transaction_fee_and_duration(
+            transaction=transaction
+        )
+        tx = transaction.copy()
+        tx['tags'] = (transaction['tags'] or []) + (item['tags'] or [])
+        upsert_transaction = await self._api.upsert_transaction(
+            request.tenant, item['account_tag'], tx, duration, fee
+        )
+        if upsert_transaction is None:
+            return schema.EndTransactionResponse(
+                failed_account_tag=item['account_tag'], failed_reason='INTERNAL_ERROR',
+            )
+        commit_account_transaction = await self._api.commit_account_transaction(
+            request.tenant, item['account_tag'], request.transaction_tag, fee
+        )
+        if commit_account_transaction is None:
+            return schema.EndTransactionResponse(
+                failed_account_tag=item['account_tag'], failed_reason='INTERNAL_ERROR',
+            )
+        return None
+
     async def record_transaction(
         self, request: schema.RecordTransactionRequest
     ) -> schema.RecordTransactionResponse:
@@ -478,6 +667,7 @@ class EngineService(object):
             account_tag=request.account_tag,
             destination_account_tag=request.destination_account_tag,
             destination=request.destination,
+            profile=AccountProfile.RECORD,
         )
         # check the account
         if request.account_tag and account is None:
@@ -504,6 +694,7 @@ class EngineService(object):
                 failed_reason='NOT_ACTIVE',
             )
         # write the db with the Record of transaction
+        items: List[Tuple[dict, dict, int, int]] = []
         for account, _ in ((account, False), (destination_account, True)):
             if account is None:
                 continue
@@ -527,13 +718,20 @@ class EngineService(object):
                 fee, duration = self._rater.get_transaction_fee_and_duration(
                     transaction=transaction
                 )
-                upsert_transaction = await self._api.upsert_transaction(
-                    request.tenant, item['account_tag'], transaction, duration, fee
+                items.append((item, transaction, duration, fee))
+        responses = await self._gather_mutations(
+            self._api.upsert_transaction(
+                request.tenant, item['account_tag'], transaction, duration, fee
+            )
+            for item, transaction, duration, fee in items
+        )
+        for (item, _, _, _), upsert_transaction in zip(items, responses):
+            if isinstance(upsert_transaction, BaseException):
+                raise upsert_transaction
+            if upsert_transaction is None:
+                return schema.RecordTransactionResponse(
+                    failed_account_tag=item['account_tag'],
+                    failed_reason='INTERNAL_ERROR',
                 )
-                if upsert_transaction is None:
-                    return schema.RecordTransactionResponse(
-                        failed_account_tag=item['account_tag'],
-                        failed_reason='INTERNAL_ERROR',
-                    )
         # return ok
         return schema.RecordTransactionResponse(ok=True)
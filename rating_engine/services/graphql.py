@@ -0,0 +1,91 @@
+import re
+
+from functools import lru_cache
+from hashlib import sha256
+from json import dumps
+from typing import Dict, List, NamedTuple, Tuple
+
+
+PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+
+class Field(NamedTuple):
+    """Top-level field of a query or mutation, its arguments written as
+    %(name)s placeholders, with the GraphQL type of each of them"""
+
+    kind: str
+    name: str
+    template: str
+    variables: Tuple[Tuple[str, str], ...]
+
+    @classmethod
+    def parse(cls, kind: str, template: str, types: Dict[str, str]) -> 'Field':
+        name = template.strip().split('(', 1)[0].strip()
+        names = dict.fromkeys(PLACEHOLDER.findall(template))
+        return cls(kind, name, template, tuple((n, types[n]) for n in names))
+
+
+class Document(NamedTuple):
+    text: str
+    sha256: str
+
+
+# a field, its alias ('' for none) and the values of its variables
+Selection = Tuple[Field, str, dict]
+
+
+def _get_suffix(n: int, count: int) -> str:
+    return '_%d' % n if count > 1 else ''
+
+
+def _get_alias(alias: str) -> str:
+    return '%s: ' % alias if alias else ''
+
+
+@lru_cache(maxsize=1024)
+def compile_document(fields: Tuple[Tuple[Field, str], ...]) -> Document:
+    """Document selecting the fields with their aliases, all of the same kind;
+    the variables of the n-th field are suffixed with _n when there are several"""
+    declarations: List[str] = []
+    body = []
+    for n, (field, alias) in enumerate(fields):
+        suffix = _get_suffix(n, len(fields))
+        declarations.extend(
+            '$%s%s: %s' % (name, suffix, type_) for name, type_ in field.variables
+        )
+        body.append(
+            _get_alias(alias)
+            + field.template
+            % {name: '$%s%s' % (name, suffix) for name, _ in field.variables}
+        )
+    text = '%s%s {\n%s\n}' % (
+        fields[0][0].kind,
+        ' (%s)' % ', '.join(declarations) if declarations else '',
+        '\n'.join(body),
+    )
+    return Document(text, sha256(text.encode()).hexdigest())
+
+
+def get_document(selections: List[Selection]) -> Document:
+    return compile_document(tuple((field, alias) for field, alias, _ in selections))
+
+
+def get_variables(selections: List[Selection]) -> dict:
+    return {
+        name + _get_suffix(n, len(selections)): values[name]
+        for n, (field, _, values) in enumerate(selections)
+        for name, _ in field.variables
+    }
+
+
+def render_document(selections: List[Selection]) -> str:
+    """Document with the values written inline as literals"""
+    return '%s {\n%s\n}' % (
+        selections[0][0].kind,
+        '\n'.join(
+            _get_alias(alias)
+            + field.template
+            % {name: dumps(values[name]) for name, _ in field.variables}
+            for field, alias, values in selections
+        ),
+    )
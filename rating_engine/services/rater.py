@@ -1,33 +1,309 @@
+from bisect import bisect_right
 from datetime import datetime
+from functools import lru_cache
 from math import ceil
-from typing import Tuple
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
 
 from dateutil import parser
 from pytz import timezone
 
+from ..enums import RateBandType
+
+try:
+    import numpy as np  # type: ignore
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+
+UTC = timezone('UTC')
+
+SECONDS_PER_DAY = 86400
+
+
+@lru_cache(maxsize=8192)
+def parse_timestamp(value: str) -> datetime:
+    """Parse a timestamp as emitted by the API, decoding the
+    %Y-%m-%dT%H:%M:%SZ format directly and falling back to dateutil"""
+    if (
+        len(value) == 20
+        and value[4] == '-'
+        and value[7] == '-'
+        and value[10] == 'T'
+        and value[13] == ':'
+        and value[16] == ':'
+        and value[19] == 'Z'
+    ):
+        try:
+            return datetime(
+                int(value[0:4]),
+                int(value[5:7]),
+                int(value[8:10]),
+                int(value[11:13]),
+                int(value[14:16]),
+                int(value[17:19]),
+                tzinfo=UTC,
+            )
+        except ValueError:
+            pass
+    return parser.parse(value)
+
+
+class RateBand(NamedTuple):
+    """Rate applied from start seconds into the transaction (DURATION bands)
+    or into the day (TIME_OF_DAY bands) up to the start of the next band"""
+
+    start: int
+    rate: int = 0
+    rate_increment: int = 0
+
+
+class RatePlan(NamedTuple):
+    """Rate plan, the immutable and hashable form of a destination_rate
+
+    Without bands the rate applies to the whole transaction. With bands,
+    the rate of the plan applies until the first band starts, and each
+    segment of the transaction is billed with the increments of its band.
+    """
+
+    carrier_tag: Optional[str] = None
+    pricelist_tag: Optional[str] = None
+    prefix: Optional[str] = None
+    description: Optional[str] = None
+    connect_fee: int = 0
+    rate: int = 0
+    rate_increment: int = 0
+    interval_start: int = 0
+    bands: Tuple[RateBand, ...] = ()
+    bands_type: RateBandType = RateBandType.DURATION
+
+    @classmethod
+    def from_destination_rate(cls, destination_rate: Any) -> Optional['RatePlan']:
+        if isinstance(destination_rate, RatePlan):
+            return destination_rate
+        if not destination_rate:
+            return None
+        return _intern_rate_plan(
+            destination_rate.get('carrier_tag'),
+            destination_rate.get('pricelist_tag'),
+            destination_rate.get('prefix'),
+            destination_rate.get('description'),
+            destination_rate.get('connect_fee') or 0,
+            destination_rate.get('rate') or 0,
+            destination_rate.get('rate_increment') or 0,
+            destination_rate.get('interval_start') or 0,
+            tuple(
+                sorted(
+                    RateBand(
+                        band['start'],
+                        band.get('rate') or 0,
+                        band.get('rate_increment') or 0,
+                    )
+                    for band in destination_rate.get('bands') or ()
+                )
+            ),
+            RateBandType(destination_rate.get('bands_type') or 'DURATION'),
+        )
+
+    def get_fee(self, duration: int, time_of_day: int = 0) -> int:
+        """Fee of a transaction lasting duration seconds; time_of_day, the
+        seconds since midnight it began at, only matters for TIME_OF_DAY bands"""
+        if self.bands:
+            free = self.interval_start * (self.rate_increment or 1)
+            if duration <= free:
+                return self.connect_fee
+            origin = time_of_day if self.bands_type == RateBandType.TIME_OF_DAY else 0
+            return self.connect_fee + _get_banded_cost(
+                self, origin + free, origin + duration
+            )
+        units = ceil(duration / (self.rate_increment or 1)) - self.interval_start
+        return self.connect_fee + int(max(0, units)) * self.rate
+
+    def get_maximum_allowed_units(
+        self, balance: int, max_units: int, time_of_day: int = 0
+    ) -> Tuple[bool, int]:
+        if self.bands:
+            return self._get_banded_maximum_allowed_units(
+                balance, max_units, time_of_day
+            )
+        rate = self.rate
+        allowed_units = (
+            int((balance - self.connect_fee) / rate) * (self.rate_increment or 1)
+            if rate
+            else max_units
+        )
+        allowed_units = (
+            min(allowed_units + self.interval_start, max_units) if allowed_units else 0
+        )
+        max_allowed_units = allowed_units if allowed_units and allowed_units > 0 else 0
+        authorized = balance > 0 or (self.connect_fee == 0 and rate == 0)
+        return (authorized, max_allowed_units)
+
+    def _get_banded_maximum_allowed_units(
+        self, balance: int, max_units: int, time_of_day: int
+    ) -> Tuple[bool, int]:
+        free = self.interval_start * (self.rate_increment or 1)
+        _, segments = _get_segments(self)
+        free_of_charge = self.connect_fee == 0 and not any(rate for rate, _ in segments)
+        authorized = balance > 0 or free_of_charge
+        budget = balance - self.connect_fee
+        if budget < 0:
+            return (authorized, 0)
+        period = self._period
+        start = (time_of_day + free) % period if period else free
+        horizon = max(0, max_units - free)
+        end = _get_banded_allowed_seconds(self, start, budget, horizon)
+        return (authorized, min(free + end, max_units))
+
+    @property
+    def _period(self) -> Optional[int]:
+        return SECONDS_PER_DAY if self.bands_type == RateBandType.TIME_OF_DAY else None
+
+
+@lru_cache(maxsize=4096)
+def _intern_rate_plan(*values) -> RatePlan:
+    return RatePlan(*values)
+
+
+EMPTY_RATE_PLAN = RatePlan()
+
+
+@lru_cache(maxsize=4096)
+def _get_segments(
+    rate_plan: RatePlan,
+) -> Tuple[Tuple[int, ...], Tuple[Tuple[int, int], ...]]:
+    """Starts and (rate, increment) of the segments of a banded rate plan"""
+    period = rate_plan._period
+    segments = {0: (rate_plan.rate, rate_plan.rate_increment or 1)}
+    for band in rate_plan.bands:
+        start = band.start % period if period else max(0, band.start)
+        segments[start] = (band.rate, band.rate_increment or 1)
+    starts = tuple(sorted(segments))
+    return (starts, tuple(segments[start] for start in starts))
+
+
+def _get_segment(rate_plan: RatePlan, position: int) -> Tuple[Optional[int], int, int]:
+    """End, rate and increment of the segment of a banded rate plan at position"""
+    starts, segments = _get_segments(rate_plan)
+    period = rate_plan._period
+    offset = position % period if period else position
+    index = bisect_right(starts, offset) - 1
+    rate, increment = segments[index]
+    end = starts[index + 1] if index + 1 < len(starts) else period
+    return (position - offset + end if end is not None else None, rate, increment)
+
+
+def _get_banded_cost(rate_plan: RatePlan, start: int, end: int) -> int:
+    """Cost of the seconds from start to end, each segment of a banded rate
+    plan being billed in its own increments"""
+    cost = 0
+    position = start
+    while position < end:
+        segment_end, rate, increment = _get_segment(rate_plan, position)
+        until = end if segment_end is None else min(end, segment_end)
+        cost += -(-(until - position) // increment) * rate
+        position = until
+    return cost
+
+
+@lru_cache(maxsize=4096)
+def _get_breakpoints(
+    rate_plan: RatePlan,
+) -> Tuple[
+    Tuple[int, ...],
+    Tuple[Optional[int], ...],
+    Tuple[int, ...],
+    Tuple[int, ...],
+    Tuple[int, ...],
+]:
+    """Starts, ends, rates and increments of the segments of a banded rate plan
+    over one period, with the cost of the whole segments before each of them;
+    the last segment of DURATION bands never ends and costs nothing here"""
+    period = rate_plan._period
+    starts, segments = _get_segments(rate_plan)
+    ends = starts[1:] + (period,)
+    costs = [0]
+    for start, end, (rate, increment) in zip(starts, ends, segments):
+        cost = -(-(end - start) // increment) * rate if end is not None else 0
+        costs.append(costs[-1] + cost)
+    return (
+        starts,
+        ends,
+        tuple(rate for rate, _ in segments),
+        tuple(increment for _, increment in segments),
+        tuple(costs),
+    )
+
+
+def _get_banded_allowed_seconds(
+    rate_plan: RatePlan, start: int, budget: int, horizon: int
+) -> int:
+    """Seconds from start, up to horizon, a banded rate plan bills within budget"""
+    starts, ends, rates, increments, costs = _get_breakpoints(rate_plan)
+    period = rate_plan._period
+    segments = len(starts)
+    index = bisect_right(starts, start) - 1
+    end = ends[index]
+    origin = 0
+    if end is not None:
+        cost = -(-(end - start) // increments[index]) * rates[index]
+        if budget >= cost:
+            # the segment of start is paid, move on to the whole segments
+            budget -= cost
+            first = index + 1
+            if period is not None and budget >= costs[segments] - costs[first]:
+                budget -= costs[segments] - costs[first]
+                if not costs[segments]:
+                    return horizon
+                periods, budget = divmod(budget, costs[segments])
+                origin = (periods + 1) * period
+                first = 0
+            index = bisect_right(costs, costs[first] + budget, first, segments) - 1
+            budget -= costs[index] - costs[first]
+    rate = rates[index]
+    if not rate:
+        return horizon
+    seconds = max(0, origin + starts[index] - start)
+    return min(horizon, seconds + budget // rate * increments[index])
+
+
+@lru_cache(maxsize=65536)
+def _get_maximum_allowed_units(
+    rate_plan: RatePlan, balance: int, max_units: int
+) -> Tuple[bool, int]:
+    """Memo of RatePlan.get_maximum_allowed_units, balances and rate plans
+    repeat heavily while many transactions are authorized at once"""
+    return rate_plan.get_maximum_allowed_units(balance, max_units)
+
 
 class RaterService(object):
     """Rater service"""
 
     MAX_UNITS_FOR_TRANSACTIONS = 3600 * 4
 
+    # smaller batches are rated faster by the plain loop than through NumPy
+    NUMPY_MIN_TRANSACTIONS = 64
+
     def __init__(self, tz=None):
         self.tz = tz or timezone('UTC')
 
     def tz_localize(self, dt: datetime) -> datetime:
         return self.tz.localize(dt) if dt.tzinfo is None else dt
 
+    def get_time_of_day(self, dt: datetime) -> int:
+        dt = self.tz_localize(dt).astimezone(self.tz)
+        return dt.hour * 3600 + dt.minute * 60 + dt.second
+
     def get_transaction_fee_and_duration(self, transaction: dict) -> Tuple[int, int]:
         timestamp_begin = (
             transaction['timestamp_begin']
             if isinstance(transaction['timestamp_begin'], datetime)
-            else parser.parse(transaction['timestamp_begin'])
+            else parse_timestamp(transaction['timestamp_begin'])
         )
         timestamp_end = (
             transaction['timestamp_end']
             if isinstance(transaction['timestamp_end'], datetime)
             else (
-                parser.parse(transaction['timestamp_end'])
+                parse_timestamp(transaction['timestamp_end'])
                 if transaction['timestamp_end']
                 else datetime.utcnow()
             )
@@ -38,40 +314,172 @@ class RaterService(object):
             return (0, 0)
         timestamp_delta = timestamp_end - timestamp_begin
         duration = timestamp_delta.seconds + (1 if timestamp_delta.microseconds else 0)
-        destination_rate = transaction.get('destination_rate') or {}
-        connect_fee = destination_rate.get('connect_fee', 0)
-        interval_start = destination_rate.get('interval_start', 0)
-        rate = destination_rate.get('rate', 0)
-        rate_increment = destination_rate.get('rate_increment') or 1
-        return (
-            connect_fee
-            + int(max(0, ceil(duration / rate_increment) - interval_start)) * rate,
-            duration,
-        )
+        rate_plan = RatePlan.from_destination_rate(transaction.get('destination_rate'))
+        if rate_plan is None:
+            return (0, duration)
+        time_of_day = self.get_time_of_day(timestamp_begin) if rate_plan.bands else 0
+        return (rate_plan.get_fee(duration, time_of_day), duration)
 
     def get_transaction_fee(self, transaction: dict) -> int:
         fee, _ = self.get_transaction_fee_and_duration(transaction)
         return fee
 
+    def get_transactions_fees_and_durations(
+        self,
+        timestamp_begin: Sequence[float],
+        timestamp_end: Sequence[float],
+        connect_fee: Sequence[int],
+        rate: Sequence[int],
+        rate_increment: Sequence[int],
+        interval_start: Sequence[int],
+    ) -> Tuple[List[int], List[int]]:
+        """Rate a batch of transactions given as columns.
+
+        Timestamps are epoch seconds; the i-th fee and duration are the same
+        get_transaction_fee_and_duration returns for the i-th transaction.
+        NumPy is used when installed for batches of NUMPY_MIN_TRANSACTIONS
+        or more, a plain loop otherwise.
+        """
+        if np is None or len(timestamp_begin) < self.NUMPY_MIN_TRANSACTIONS:
+            return _rate_columns_python(
+                timestamp_begin,
+                timestamp_end,
+                connect_fee,
+                rate,
+                rate_increment,
+                interval_start,
+            )
+        fees, durations = _rate_columns_numpy(
+            timestamp_begin,
+            timestamp_end,
+            connect_fee,
+            rate,
+            rate_increment,
+            interval_start,
+        )
+        return (fees.tolist(), durations.tolist())
+
+    def get_transactions_fee(self, transactions: Iterable[dict]) -> int:
+        begin: List[float] = []
+        end: List[float] = []
+        connect_fee: List[int] = []
+        rate: List[int] = []
+        rate_increment: List[int] = []
+        interval_start: List[int] = []
+        banded_fee = 0
+        now = self.tz_localize(datetime.utcnow()).timestamp()
+        for transaction in transactions:
+            timestamp_begin = transaction['timestamp_begin']
+            if not isinstance(timestamp_begin, datetime):
+                timestamp_begin = parse_timestamp(timestamp_begin)
+            timestamp_end = transaction['timestamp_end']
+            if timestamp_end and not isinstance(timestamp_end, datetime):
+                timestamp_end = parse_timestamp(timestamp_end)
+            rate_plan = (
+                RatePlan.from_destination_rate(transaction.get('destination_rate'))
+                or EMPTY_RATE_PLAN
+            )
+            if rate_plan.bands:
+                banded_fee += self.get_transaction_fee(transaction)
+                continue
+            begin.append(self.tz_localize(timestamp_begin).timestamp())
+            end.append(
+                self.tz_localize(timestamp_end).timestamp() if timestamp_end else now
+            )
+            connect_fee.append(rate_plan.connect_fee)
+            rate.append(rate_plan.rate)
+            rate_increment.append(rate_plan.rate_increment or 1)
+            interval_start.append(rate_plan.interval_start)
+        if not begin:
+            return banded_fee
+        fees, _ = self.get_transactions_fees_and_durations(
+            begin, end, connect_fee, rate, rate_increment, interval_start
+        )
+        return banded_fee + sum(fees)
+
     def get_maximum_allowed_units_for_transaction(
-        self, balance: int, destination_rate: dict
+        self,
+        balance: int,
+        destination_rate: Any,
+        timestamp_begin: Optional[datetime] = None,
     ) -> Tuple[bool, int]:
-        if not destination_rate:
+        rate_plan = RatePlan.from_destination_rate(destination_rate)
+        if rate_plan is None:
             return (False, 0)
-        connect_fee = destination_rate.get('connect_fee', 0)
-        interval_start = destination_rate.get('interval_start', 0)
-        rate = destination_rate.get('rate', 0)
-        rate_increment = destination_rate.get('rate_increment') or 1
-        allowed_units = (
-            int((balance - connect_fee) / rate) * rate_increment
-            if rate
-            else self.MAX_UNITS_FOR_TRANSACTIONS
+        if not rate_plan.rate and not rate_plan.bands:
+            # free of charge past the connect fee, nothing worth caching
+            authorized = balance > 0 or rate_plan.connect_fee == 0
+            return (authorized, self.MAX_UNITS_FOR_TRANSACTIONS)
+        if rate_plan.bands_type == RateBandType.TIME_OF_DAY and rate_plan.bands:
+            # the units depend on the second of the day the transaction begins
+            # at, a memo keyed on it would hardly hit and evict the other plans
+            return rate_plan.get_maximum_allowed_units(
+                balance,
+                self.MAX_UNITS_FOR_TRANSACTIONS,
+                self.get_time_of_day(timestamp_begin or datetime.utcnow()),
+            )
+        return _get_maximum_allowed_units(
+            rate_plan, balance, self.MAX_UNITS_FOR_TRANSACTIONS
         )
-        allowed_units = (
-            min(allowed_units + interval_start, self.MAX_UNITS_FOR_TRANSACTIONS)
-            if allowed_units
-            else 0
+
+    @staticmethod
+    def get_maximum_allowed_units_cache_info():
+        """Hits, misses and size of the maximum allowed units memo"""
+        return _get_maximum_allowed_units.cache_info()
+
+    @classmethod
+    def get_maximum_allowed_units_stats(cls) -> Dict[str, Any]:
+        info = cls.get_maximum_allowed_units_cache_info()
+        lookups = info.hits + info.misses
+        return dict(
+            size=info.currsize,
+            hits=info.hits,
+            misses=info.misses,
+            hit_ratio=round(info.hits / lookups, 4) if lookups else 0.0,
         )
-        max_allowed_units = allowed_units if allowed_units and allowed_units > 0 else 0
-        authorized = balance > 0 or (connect_fee == 0 and rate == 0)
-        return (authorized, max_allowed_units)
+
+
+def _rate_columns_numpy(
+    timestamp_begin, timestamp_end, connect_fee, rate, rate_increment, interval_start
+):
+    begin = np.asarray(timestamp_begin, dtype=np.float64)
+    end = np.asarray(timestamp_end, dtype=np.float64)
+    # work in whole microseconds, as timedelta does
+    delta = np.rint((end - begin) * 1e6).astype(np.int64)
+    elapsed = delta > 0
+    # timedelta.seconds plus one for any partial second
+    duration = (delta // 1000000) % 86400 + (delta % 1000000 != 0)
+    duration = np.where(elapsed, duration, 0)
+    increment = np.asarray(rate_increment, dtype=np.int64)
+    increment = np.where(increment == 0, 1, increment)
+    units = -(-duration // increment)
+    units = np.maximum(0, units - np.asarray(interval_start, dtype=np.int64))
+    fee = np.asarray(connect_fee, dtype=np.int64) + units * np.asarray(
+        rate, dtype=np.int64
+    )
+    return (np.where(elapsed, fee, 0), duration)
+
+
+def _rate_columns_python(
+    timestamp_begin, timestamp_end, connect_fee, rate, rate_increment, interval_start
+):
+    fees: List[int] = []
+    durations: List[int] = []
+    for begin, end, fee, rate_, increment, start in zip(
+        timestamp_begin,
+        timestamp_end,
+        connect_fee,
+        rate,
+        rate_increment,
+        interval_start,
+    ):
+        delta = round((end - begin) * 1e6)
+        if delta <= 0:
+            fees.append(0)
+            durations.append(0)
+            continue
+        duration = (delta // 1000000) % 86400 + (1 if delta % 1000000 else 0)
+        units = -(-duration // (increment or 1))
+        fees.append(fee + max(0, units - start) * rate_)
+        durations.append(duration)
+    return (fees, durations)
@@ -0,0 +1,140 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional
+
+
+def _run_worker(target: Callable[[], Any]):
+    # the signals are handled by the worker itself, not by the supervisor copy
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target()
+
+
+class Supervisor(object):
+    """Runs target in worker processes, restarting the ones which exit, with
+    a delay doubling while they keep exiting early, until stop is called or
+    SIGINT or SIGTERM is received; the workers are then sent SIGTERM, and
+    killed if still running after shutdown_timeout seconds"""
+
+    _processes: List[Optional[BaseProcess]]
+    _started: List[float]
+    _restart_at: Dict[int, float]
+    _delays: List[float]
+
+    LOGGING_FORMAT: str = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+    def __init__(
+        self,
+        target: Callable[[], Any],
+        workers: int,
+        restart_delay: float = 1,
+        max_restart_delay: float = 30,
+        min_uptime: float = 10,
+        shutdown_timeout: float = 30,
+    ):
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.shutdown_timeout = shutdown_timeout
+        self.restarts = 0
+        self._context = multiprocessing.get_context('fork')
+        self._processes = [None] * workers
+        self._started = [0.0] * workers
+        self._restart_at = {}
+        self._delays = [restart_delay] * workers
+        self._stopping = threading.Event()
+        self._setup_logger()
+
+    def _setup_logger(self):
+        logger = logging.getLogger('%s[%s]' % (self.__class__.__name__, os.getpid()))
+        logger.setLevel(logging.INFO)
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(self.LOGGING_FORMAT))
+        logger.addHandler(handler)
+        self.logger = logger
+
+    def _start(self, slot: int):
+        process = self._context.Process(
+            target=_run_worker, args=(self.target,), name='worker-%d' % slot
+        )
+        process.start()
+        self._processes[slot] = process
+        self._started[slot] = monotonic()
+        self.logger.info("Started worker %d, pid %s", slot, process.pid)
+
+    def _exited(self, slot: int):
+        process = self._processes[slot]
+        assert process is not None
+        process.join()
+        self._processes[slot] = None
+        uptime = monotonic() - self._started[slot]
+        # back off the workers which fail on start, e.g. the bus being down
+        if uptime < self.min_uptime:
+            delay = self._delays[slot]
+            self._delays[slot] = min(delay * 2, self.max_restart_delay)
+        else:
+            delay = self._delays[slot] = self.restart_delay
+        self._restart_at[slot] = monotonic() + delay
+        self.logger.warning(
+            "Worker %d, pid %s, exited with code %s, restarting in %.1fs",
+            slot,
+            process.pid,
+            process.exitcode,
+            delay,
+        )
+
+    def stop(self, *args):
+        self._stopping.set()
+
+    def run(self) -> int:
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+        self.logger.info("Starting %d workers", self.workers)
+        for slot in range(self.workers):
+            self._start(slot)
+        while not self._stopping.is_set():
+            sentinels = {
+                process.sentinel: slot
+                for slot, process in enumerate(self._processes)
+                if process is not None
+            }
+            timeout = 0.5
+            if self._restart_at:
+                timeout = max(0, min(min(self._restart_at.values()) - monotonic(), 0.5))
+            ready = wait(list(sentinels), timeout=timeout)
+            for sentinel, slot in sentinels.items():
+                if sentinel in ready:
+                    self._exited(slot)
+            now = monotonic()
+            for slot, restart_at in list(self._restart_at.items()):
+                if restart_at <= now and not self._stopping.is_set():
+                    del self._restart_at[slot]
+                    self.restarts += 1
+                    self._start(slot)
+        return self._shutdown()
+
+    def _shutdown(self) -> int:
+        processes = [process for process in self._processes if process is not None]
+        self.logger.info("Stopping %d workers", len(processes))
+        for process in processes:
+            if process.is_alive() and process.pid is not None:
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = monotonic() + self.shutdown_timeout
+        for process in processes:
+            process.join(max(0, deadline - monotonic()))
+            if process.is_alive():
+                self.logger.warning("Killing worker pid %s", process.pid)
+                process.kill()
+                process.join()
+        return 0
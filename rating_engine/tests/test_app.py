@@ -207,3 +207,15 @@ async def test_app_record_transaction_invalid_data(app):
     assert response.get('errors') is not None
     #
     await bus.close()
+
+
+def test_set_event_loop_policy():
+    import asyncio
+
+    from rating_engine import app as app_module
+
+    assert app_module.set_event_loop_policy('asyncio') == 'asyncio'
+    chosen = app_module.set_event_loop_policy('uvloop')
+    assert chosen == ('uvloop' if app_module.uvloop is not None else 'asyncio')
+    app_module.set_event_loop_policy('asyncio')
+    assert type(asyncio.get_event_loop_policy()).__module__.startswith('asyncio')
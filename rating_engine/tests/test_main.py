@@ -1,6 +1,7 @@
 import asyncio
 
 from click.testing import CliRunner
+from unittest.mock import patch
 
 
 def test_main():
@@ -9,9 +10,45 @@ def test_main():
     async def shutdown(loop):
         loop.stop()
 
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     loop.run_until_complete(shutdown(loop))
 
     runner = CliRunner()
     result = runner.invoke(main)
     assert result.exit_code == 1
+
+
+def test_main_workers():
+    from rating_engine.main import main
+
+    runner = CliRunner()
+    with patch('rating_engine.main.get_app') as get_app, patch(
+        'rating_engine.main.Supervisor'
+    ) as supervisor:
+        supervisor.return_value.run.return_value = 0
+        result = runner.invoke(main, ['--workers', '3'])
+        assert result.exit_code == 0, result.output
+        assert supervisor.call_args[1]['workers'] == 3
+        supervisor.return_value.run.assert_called_once_with()
+        get_app.assert_not_called()
+        # the workers run the app with the configuration of the command
+        target = supervisor.call_args[0][0]
+        target()
+        get_app.return_value.run.assert_called_once_with()
+        assert get_app.call_args[0][0]['loop'] == 'asyncio'
+
+
+def test_main_single_worker():
+    from rating_engine.main import main
+
+    runner = CliRunner()
+    with patch('rating_engine.main.get_app') as get_app, patch(
+        'rating_engine.main.Supervisor'
+    ) as supervisor:
+        result = runner.invoke(main, ['--workers', '1'])
+        assert result.exit_code == 0, result.output
+        supervisor.assert_not_called()
+        get_app.return_value.run.assert_called_once_with()
+        # the transaction states are kept on demand only
+        assert get_app.call_args[0][0]['transaction_state_ttl'] == 0
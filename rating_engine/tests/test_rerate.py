@@ -0,0 +1,147 @@
+import csv
+import io
+import json
+
+from click.testing import CliRunner
+
+from rating_engine.main import main
+from rating_engine.rerate import Pricelist, rerate
+from rating_engine.services.rater import RaterService
+
+
+DESTINATION_RATES = [
+    {
+        'carrier_tag': 'CARRIER',
+        'pricelist_tag': 'NEW',
+        'prefix': '39',
+        'description': 'Italy',
+        'connect_fee': 10,
+        'rate': 60,
+        'rate_increment': 60,
+        'interval_start': 0,
+    },
+    {
+        'carrier_tag': 'CARRIER',
+        'pricelist_tag': 'NEW',
+        'prefix': '393',
+        'description': 'Italy Mobile',
+        'connect_fee': 0,
+        'rate': 1,
+        'rate_increment': 1,
+        'interval_start': 0,
+        'bands': [{'start': 60, 'rate': 2, 'rate_increment': 30}],
+    },
+]
+
+
+def get_transactions(count: int):
+    return [
+        {
+            'transaction_tag': str(n),
+            'destination': '3932912345' if n % 3 == 0 else ('3906123' if n % 3 else ''),
+            'timestamp_begin': '2020-03-20T10:00:00Z',
+            'timestamp_end': '2020-03-20T10:%02d:%02dZ' % (n % 60, (n * 7) % 60),
+        }
+        for n in range(count)
+    ]
+
+
+def get_expected(transactions):
+    rater = RaterService()
+    pricelist = Pricelist(DESTINATION_RATES)
+    return [
+        rater.get_transaction_fee_and_duration(
+            dict(
+                transaction,
+                destination_rate=pricelist.get_rate_plan(transaction['destination']),
+            )
+        )
+        for transaction in transactions
+    ]
+
+
+def test_pricelist_longest_prefix():
+    pricelist = Pricelist(DESTINATION_RATES)
+    assert pricelist.get_rate_plan('3932912345').prefix == '393'
+    assert pricelist.get_rate_plan('3906123').prefix == '39'
+    assert pricelist.get_rate_plan('4420123') is None
+    assert pricelist.get_rate_plan(None) is None
+
+
+def test_rerate_jsonl_inline():
+    transactions = get_transactions(100)
+    output = io.StringIO()
+    count = rerate(
+        io.StringIO(''.join(json.dumps(t) + '\n' for t in transactions)),
+        output,
+        DESTINATION_RATES,
+        workers=0,
+        chunk_size=7,
+    )
+    assert count == 100
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [r['transaction_tag'] for r in records] == [
+        t['transaction_tag'] for t in transactions
+    ]
+    assert [(r['fee'], r['duration']) for r in records] == get_expected(transactions)
+
+
+def test_rerate_command_csv(tmp_path):
+    transactions = get_transactions(50)
+    input_path = tmp_path / 'transactions.csv'
+    with open(input_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(transactions[0]))
+        writer.writeheader()
+        writer.writerows(transactions)
+    pricelist_path = tmp_path / 'pricelist.json'
+    pricelist_path.write_text(json.dumps({'destination_rates': DESTINATION_RATES}))
+    output_path = tmp_path / 'rerated.csv'
+
+    runner = CliRunner()
+    result = runner.invoke(
+        main,
+        [
+            'rerate',
+            str(input_path),
+            str(output_path),
+            '--pricelist',
+            str(pricelist_path),
+            '--workers',
+            '2',
+            '--chunk-size',
+            '8',
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    with open(output_path, newline='') as f:
+        records = list(csv.DictReader(f))
+    assert [r['transaction_tag'] for r in records] == [
+        t['transaction_tag'] for t in transactions
+    ]
+    assert [(int(r['fee']), int(r['duration'])) for r in records] == get_expected(
+        transactions
+    )
+    assert records[1]['prefix'] == '39'
+
+
+def test_rerate_command_negative_workers(tmp_path):
+    input_path = tmp_path / 'transactions.jsonl'
+    input_path.write_text('')
+    pricelist_path = tmp_path / 'pricelist.json'
+    pricelist_path.write_text(json.dumps({'destination_rates': DESTINATION_RATES}))
+
+    runner = CliRunner()
+    result = runner.invoke(
+        main,
+        [
+            'rerate',
+            str(input_path),
+            str(tmp_path / 'rerated.jsonl'),
+            '--pricelist',
+            str(pricelist_path),
+            '--workers',
+            '-1',
+        ],
+    )
+    assert result.exit_code == 2
+    assert not (tmp_path / 'rerated.jsonl').exists()
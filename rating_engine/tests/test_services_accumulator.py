@@ -0,0 +1,125 @@
+import random
+import unittest
+
+from datetime import datetime, timedelta
+from pytz import timezone
+
+from rating_engine.services.accumulator import PendingCostService
+from rating_engine.services.rater import RatePlan, RaterService
+
+
+class ServicesAccumulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.tz = timezone('UTC')
+        self.rater = RaterService(tz=self.tz)
+        self.service = PendingCostService(self.rater)
+        self.now = self.tz.localize(datetime(2019, 1, 1, 10, 0, 0))
+
+    def get_transaction(self, transaction_tag, seconds_ago, **destination_rate):
+        return {
+            'transaction_tag': transaction_tag,
+            'timestamp_begin': (self.now - timedelta(seconds=seconds_ago)).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            'timestamp_end': None,
+            'destination_rate': RatePlan.from_destination_rate(destination_rate),
+        }
+
+    def get_expected_pending_cost(self, transactions, now):
+        return sum(
+            self.rater.get_transaction_fee(dict(transaction, timestamp_end=now))
+            for transaction in transactions
+        )
+
+    def test_pending_cost_matches_rater(self):
+        random.seed(0)
+        transactions = [
+            self.get_transaction(
+                str(n),
+                random.randint(-30, 600),
+                connect_fee=random.choice((0, 10, 100)),
+                rate=random.choice((0, 1, 100)),
+                rate_increment=random.choice((0, 1, 30, 60)),
+                interval_start=random.choice((0, 1, 2, 30)),
+            )
+            for n in range(100)
+        ]
+        for seconds in (0, 0.5, 1, 29.999, 30, 30.001, 61, 300, 3599.5):
+            now = self.now + timedelta(seconds=seconds)
+            pending_cost = self.service.get_pending_cost(
+                'default', '1000', transactions, now=now
+            )
+            self.assertEqual(
+                self.get_expected_pending_cost(transactions, now), pending_cost
+            )
+
+    def test_pending_cost_begin_and_end_transaction(self):
+        rate = dict(connect_fee=10, rate=1, rate_increment=1, interval_start=0)
+        first = self.get_transaction('1', 60, **rate)
+        second = self.get_transaction('2', 30, **rate)
+        self.assertEqual(
+            70, self.service.get_pending_cost('default', '1000', [first], self.now)
+        )
+        self.service.begin_transaction('default', '1000', second)
+        accumulator = self.service.get_accumulator('default', '1000')
+        self.assertEqual(110, accumulator.get_pending_cost(self.now))
+        self.service.end_transaction('default', '1000', '1')
+        self.assertEqual(40, accumulator.get_pending_cost(self.now))
+        self.assertEqual(
+            50,
+            accumulator.get_pending_cost(self.now + timedelta(seconds=10)),
+        )
+
+    def test_pending_cost_reconcile(self):
+        rate = dict(connect_fee=0, rate=100, rate_increment=60, interval_start=0)
+        first = self.get_transaction('1', 90, **rate)
+        second = self.get_transaction('2', 30, **rate)
+        self.assertEqual(
+            300,
+            self.service.get_pending_cost('default', '1000', [first, second], self.now),
+        )
+        self.assertEqual(
+            100, self.service.get_pending_cost('default', '1000', [second], self.now)
+        )
+        ended = dict(first, timestamp_end=self.now - timedelta(seconds=80))
+        self.assertEqual(
+            200,
+            self.service.get_pending_cost('default', '1000', [ended, second], self.now),
+        )
+        self.assertEqual(
+            0, self.service.get_pending_cost('default', '1000', [], self.now)
+        )
+        self.assertEqual({}, self.service._accumulators)
+
+    def test_pending_cost_long_transaction(self):
+        rate = dict(connect_fee=10, rate=1, rate_increment=1, interval_start=0)
+        transaction = self.get_transaction('1', 1800, **rate)
+        self.assertEqual(
+            1810,
+            self.service.get_pending_cost('default', '1000', [transaction], self.now),
+        )
+        accumulator = self.service.get_accumulator('default', '1000')
+        self.assertEqual(1, len(accumulator._steps))
+        self.assertEqual(
+            1820,
+            accumulator.get_pending_cost(self.now + timedelta(seconds=9.5)),
+        )
+        self.assertEqual(1, len(accumulator._steps))
+
+    def test_pending_cost_evict_idle_accumulators(self):
+        clock = [0.0]
+        service = PendingCostService(
+            self.rater, idle_timeout=60, clock=lambda: clock[0]
+        )
+        rate = dict(connect_fee=10, rate=1, rate_increment=1, interval_start=0)
+        service.begin_transaction(
+            'default', '1000', self.get_transaction('1', 0, **rate)
+        )
+        clock[0] = 30
+        service.begin_transaction(
+            'default', '1001', self.get_transaction('2', 0, **rate)
+        )
+        self.assertEqual(2, len(service))
+        clock[0] = 61
+        service.get_accumulator('default', '1001')
+        self.assertEqual([('default', '1001')], list(service._accumulators))
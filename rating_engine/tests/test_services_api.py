@@ -0,0 +1,228 @@
+import asyncio
+import json
+import pytest  # type: ignore
+import re
+
+from ..enums import AccountProfile
+from ..services.api import APIService
+
+
+class MockedAPIService(APIService):
+    """Answers the account look-ups, and the mutations with ok set to whether
+    the account_tag is even"""
+
+    def __init__(self, **kw):
+        super().__init__(api_url='http://localhost/graphql', **kw)
+        self.payloads = []
+        self.queries = []
+        self.persisted = {}
+
+    async def _query(self, payload):
+        self.payloads.append(payload)
+        await asyncio.sleep(0.01)
+        query = payload.get('query')
+        if 'extensions' in payload:
+            sha256 = payload['extensions']['persistedQuery']['sha256Hash']
+            if query is None:
+                if sha256 not in self.persisted:
+                    return {'errors': [{'message': 'PersistedQueryNotFound'}]}
+                query = self.persisted[sha256]
+            self.persisted[sha256] = query
+        variables = payload.get('variables') or {}
+        query = re.sub(r'^(\w+) \(.*?\) \{', r'\1 {', query)
+        query = re.sub(r'\$(\w+)', lambda m: json.dumps(variables[m[1]]), query)
+        self.queries.append(query)
+        data = {}
+        for alias, tenant, account_tag in re.findall(
+            r'(?:(\w+): )?Account\(tenant: "(\w+)", account_tag: "(\d+)"\)', query
+        ):
+            data[alias or 'Account'] = {
+                'account_tag': account_tag,
+                'tenant': tenant,
+                'linked_accounts': [],
+            }
+        for alias, field, account_tag in re.findall(
+            r'(?:(a\d+): )?(\w+)\s*\(\s*tenant: "\w+"\s*account_tag: "(\d+)"', query
+        ):
+            data[alias or field] = {'ok': int(account_tag) % 2 == 0}
+        return {'data': data}
+
+
+@pytest.mark.asyncio
+async def test_api_batch_mutations():
+    api = MockedAPIService(batch_mutations=True)
+    responses = await asyncio.gather(
+        api.commit_account_transaction('default', '1000', '100', 10),
+        api.commit_account_transaction('default', '1001', '100', 10),
+        api.rollback_account_transaction('default', '1002', '100'),
+    )
+    assert responses == [True, False, True]
+    assert len(api.queries) == 1
+    assert 'a0: commitAccountTransaction(' in api.queries[0]
+    assert 'a1: commitAccountTransaction(' in api.queries[0]
+    assert 'a2: rollbackAccountTransaction(' in api.queries[0]
+    # a lone mutation is sent as it is
+    assert await api.rollback_account_transaction('default', '1002', '100') is True
+    assert api.queries[1] == 'mutation {\n%s\n}' % (
+        APIService.QUERY_ROLLBACK_ACCOUNT_TRANSACTION
+        % dict(tenant='"default"', account_tag='"1002"', transaction_tag='"100"')
+    )
+
+
+@pytest.mark.asyncio
+async def test_api_without_batch_mutations():
+    api = MockedAPIService()
+    responses = await asyncio.gather(
+        api.commit_account_transaction('default', '1000', '100', 10),
+        api.rollback_account_transaction('default', '1001', '100'),
+    )
+    assert responses == [True, False]
+    assert len(api.queries) == 2
+
+
+@pytest.mark.asyncio
+async def test_api_identical_lookups_share_one_query():
+    api = MockedAPIService()
+    results = await asyncio.gather(
+        *(
+            api.get_account_and_destination_account_by_id(
+                'default', '1000', '39', '2000'
+            )
+            for _ in range(5)
+        )
+    )
+    assert len(api.queries) == 1
+    assert 'DestinationAccount: Account(' in api.queries[0]
+    for account, destination_account in results:
+        assert account['account_tag'] == '1000'
+        assert destination_account['account_tag'] == '2000'
+        account.pop('linked_accounts')
+    assert len({id(account) for account, _ in results}) == 5
+    assert api.lookup_stats == dict(lookups=5, shared=4, batched=0, queries=1)
+    # a look-up in flight is not shared past a mutation
+    lookup = asyncio.ensure_future(
+        api.get_account_and_destination_account_by_id('default', '1000')
+    )
+    await asyncio.sleep(0)
+    await api.rollback_account_transaction('default', '1000', '100')
+    await api.get_account_and_destination_account_by_id('default', '1000')
+    await lookup
+    assert len(api.queries) == 4
+
+
+@pytest.mark.asyncio
+async def test_api_lookups_in_window_are_merged():
+    api = MockedAPIService(lookup_window=0.005)
+    results = await asyncio.gather(
+        api.get_account_and_destination_account_by_id('default', '1000'),
+        api.get_account_and_destination_account_by_id('default', '1001', '39'),
+        api.get_account_and_destination_account_by_id('other', None, None, '2000'),
+    )
+    assert len(api.queries) == 1
+    assert 'a0: Account(' in api.queries[0]
+    assert 'd2: Account(' in api.queries[0]
+    assert [
+        (
+            account and (account['tenant'], account['account_tag']),
+            destination_account and destination_account['account_tag'],
+        )
+        for account, destination_account in results
+    ] == [(('default', '1000'), None), (('default', '1001'), None), (None, '2000')]
+    assert api.lookup_stats == dict(lookups=3, shared=0, batched=3, queries=1)
+
+
+@pytest.mark.asyncio
+async def test_api_variables():
+    api = MockedAPIService(variables=True, batch_mutations=True)
+    responses = await asyncio.gather(
+        api.commit_account_transaction('default', '1000', '100', None),
+        api.rollback_account_transaction('default', '1001', '100'),
+    )
+    assert responses == [True, False]
+    payload = api.payloads[0]
+    assert payload['query'].startswith(
+        'mutation ($tenant_0: String!, $account_tag_0: String!, '
+        '$transaction_tag_0: String!, $fee_0: Int, $tenant_1: String!'
+    )
+    assert 'a0: commitAccountTransaction(' in payload['query']
+    assert payload['variables']['fee_0'] == 0
+    assert payload['variables']['account_tag_1'] == '1001'
+    # the document of the same fields is compiled once, whatever the values
+    await asyncio.gather(
+        api.commit_account_transaction('other', '1002', '101', 20),
+        api.rollback_account_transaction('other', '1003', '101'),
+    )
+    assert api.payloads[1]['query'] is payload['query']
+
+
+@pytest.mark.asyncio
+async def test_api_persisted_queries():
+    api = MockedAPIService(persisted_queries=True)
+    account, _ = await api.get_account_and_destination_account_by_id('default', '1000')
+    assert account['account_tag'] == '1000'
+    # unknown hash, then registered along with the document
+    assert [sorted(payload) for payload in api.payloads] == [
+        ['extensions', 'variables'],
+        ['extensions', 'query', 'variables'],
+    ]
+    account, _ = await api.get_account_and_destination_account_by_id('default', '1002')
+    assert account['account_tag'] == '1002'
+    assert len(api.payloads) == 3
+    assert 'query' not in api.payloads[2]
+
+
+@pytest.mark.asyncio
+async def test_api_lookup_profiles():
+    api = MockedAPIService()
+    await asyncio.gather(
+        api.get_account_and_destination_account_by_id(
+            'default', '1000', '39', '2000', profile=AccountProfile.END
+        ),
+        api.get_account_and_destination_account_by_id(
+            'default', '1000', '39', '2000', profile=AccountProfile.AUTHORIZATION
+        ),
+    )
+    # the profiles are looked up apart, each with its own fields
+    assert len(api.queries) == 2
+    end, authorization = api.queries
+    assert 'running_transactions' not in end
+    assert 'destination_rate' not in end
+    assert 'running_transactions' in authorization
+    assert 'least_cost_routing(destination: "39")' in authorization
+    assert 'notification_email' not in authorization
+
+
+@pytest.mark.asyncio
+async def test_api_connection_pool(tmp_path):
+    from aiohttp import web
+
+    async def graphql(request):
+        payload = await request.json()
+        await asyncio.sleep(0.2 if 'slow' in payload['query'] else 0.01)
+        return web.json_response({'data': {'ok': True}})
+
+    app = web.Application()
+    app.router.add_post('/graphql', graphql)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    path = str(tmp_path / 'api.sock')
+    await web.UnixSite(runner, path).start()
+    api = APIService(
+        api_url='http://localhost/graphql',
+        unix_socket=path,
+        max_connections=1,
+        read_timeout=0.1,
+    )
+    try:
+        results = await asyncio.gather(*(api._query({'query': 'q'}) for _ in range(3)))
+        assert results == [{'data': {'ok': True}}] * 3
+        assert await api._query({'query': 'slow'}) is None
+        stats = api.get_pool_stats()
+        assert stats['requests'] == 4
+        assert stats['max_in_flight'] == 3
+        assert stats['waiting'] == 2
+        assert stats['timeouts'] == 1
+        assert stats['in_flight'] == 0
+    finally:
+        await api.close()
+        await runner.cleanup()
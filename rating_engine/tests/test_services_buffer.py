@@ -0,0 +1,100 @@
+import asyncio
+import pytest  # type: ignore
+
+from typing import List
+
+from ..services.buffer import WriteBehindBuffer
+
+
+class Sink(object):
+    def __init__(self, delay: float = 0, failures: int = 0):
+        self.delay = delay
+        self.failures = failures
+        self.batches: List[list] = []
+
+    async def __call__(self, items):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError()
+        self.batches.append(items)
+
+
+@pytest.mark.asyncio
+async def test_buffer_flushes_by_size():
+    sink = Sink()
+    buffer = WriteBehindBuffer(sink, max_size=3, max_delay=10)
+    for n in range(7):
+        buffer.add(n)
+    await asyncio.sleep(0.005)
+    assert sink.batches == [[0, 1, 2], [3, 4, 5]]
+    assert len(buffer) == 1
+
+
+@pytest.mark.asyncio
+async def test_buffer_flushes_after_delay():
+    sink = Sink()
+    buffer = WriteBehindBuffer(sink, max_size=100, max_delay=0.01)
+    buffer.add(1)
+    buffer.add(2)
+    await asyncio.sleep(0.02)
+    assert sink.batches == [[1, 2]]
+    assert buffer.stats() == dict(
+        items=2,
+        flushes=1,
+        size_flushes=0,
+        retries=0,
+        fallbacks=0,
+        errors=0,
+        pending=0,
+        flushing=0,
+    )
+
+
+@pytest.mark.asyncio
+async def test_buffer_close_waits_for_all_the_flushes():
+    sink = Sink(delay=0.01)
+    buffer = WriteBehindBuffer(sink, max_size=2, max_delay=10)
+    for n in range(3):
+        buffer.add(n)
+    await buffer.close()
+    assert sink.batches == [[0, 1], [2]]
+    assert buffer.stats()['flushing'] == 0
+
+
+@pytest.mark.asyncio
+async def test_buffer_counts_the_failed_flushes():
+    async def fail(items):
+        raise RuntimeError()
+
+    buffer = WriteBehindBuffer(fail, max_size=1, retry_delay=0.001)
+    buffer.add(1)
+    await buffer.close()
+    assert buffer.stats()['retries'] == 2
+    assert buffer.stats()['errors'] == 1
+
+
+@pytest.mark.asyncio
+async def test_buffer_retries_the_failed_flushes():
+    sink = Sink(failures=2)
+    buffer = WriteBehindBuffer(sink, max_size=2, retry_delay=0.001)
+    for n in range(3):
+        buffer.add(n)
+    await buffer.close()
+    assert sorted(sink.batches) == [[0, 1], [2]]
+    assert buffer.stats()['retries'] == 2
+    assert buffer.stats()['errors'] == 0
+
+
+@pytest.mark.asyncio
+async def test_buffer_falls_back_when_the_retries_fail():
+    fallback = Sink()
+    buffer = WriteBehindBuffer(
+        Sink(failures=3), max_size=2, retry_delay=0.001, fallback=fallback
+    )
+    buffer.add(1)
+    buffer.add(2)
+    await buffer.close()
+    assert fallback.batches == [[1, 2]]
+    assert buffer.stats()['fallbacks'] == 1
+    assert buffer.stats()['errors'] == 0
@@ -0,0 +1,146 @@
+import pytest
+
+from rating_engine.services.api import APIService
+from rating_engine.services.cache import AccountCache, TransactionStateCache, TTLCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def get_account(account_tag, linked_accounts=()):
+    return {
+        'account_tag': account_tag,
+        'balance': 100,
+        'destination_rate': None,
+        'running_transactions': [],
+        'linked_accounts': [get_account(tag) for tag in linked_accounts],
+    }
+
+
+class MockedAPIService(APIService):
+    def __init__(self, account_cache):
+        super().__init__(
+            api_url='http://localhost/graphql', account_cache=account_cache
+        )
+        self.queries = []
+
+    async def _query(self, payload):
+        query = payload['query']
+        self.queries.append(query)
+        if 'rollbackAccountTransaction' in query:
+            return {'data': {'rollbackAccountTransaction': {'ok': True}}}
+        if 'commitAccountTransaction' in query:
+            return {'data': {'commitAccountTransaction': {'ok': True}}}
+        return {
+            'data': {
+                'Account': get_account('1000', linked_accounts=['1001']),
+                'DestinationAccount': get_account('2000'),
+            }
+        }
+
+
+def test_ttl_cache_expires_and_evicts():
+    clock = Clock()
+    cache = TTLCache(ttl=10, maxsize=2, clock=clock)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+    assert cache.get('c') is None
+    assert cache.stats() == dict(
+        size=0, hits=2, misses=3, hit_ratio=0.4, evictions=1, invalidations=0
+    )
+
+
+def test_account_cache_invalidates_linked_accounts():
+    cache = AccountCache(ttl=60)
+    key = cache.get_key('default', '1000', '39123', '2000')
+    accounts = (get_account('1000', linked_accounts=['1001']), get_account('2000'))
+    cache.put_accounts(key, accounts, cache.generation)
+    account, _ = cache.get_accounts(key)
+    account.pop('linked_accounts')
+    assert cache.get_accounts(key)[0]['linked_accounts'][0]['account_tag'] == '1001'
+    cache.invalidate_account('other', '1001')
+    assert key in cache
+    cache.invalidate_account('default', '1001')
+    assert key not in cache
+    assert cache.stats()['invalidations'] == 1
+    # a look-up started before an invalidation is not cached
+    generation = cache.generation
+    cache.invalidate_account('default', '3000')
+    cache.put_accounts(key, accounts, generation)
+    assert key in cache
+    cache.invalidate(key)
+    generation = cache.generation
+    cache.invalidate_account('default', '1001')
+    cache.put_accounts(key, accounts, generation)
+    assert key not in cache
+
+
+def test_account_cache_forgets_old_invalidations():
+    cache = AccountCache(ttl=60, maxsize=2)
+    key = cache.get_key('default', '1000', None, None)
+    accounts = (get_account('1000'), None)
+    generation = cache.generation
+    for account_tag in ('3000', '3001', '3002'):
+        cache.invalidate_account('default', account_tag)
+    cache.put_accounts(key, accounts, generation)
+    assert key not in cache
+    cache.put_accounts(key, accounts, cache.generation)
+    assert key in cache
+
+
+@pytest.mark.asyncio
+async def test_api_account_cache_write_through_invalidation():
+    api = MockedAPIService(AccountCache(ttl=60))
+    for _ in range(3):
+        accounts = await api.get_account_and_destination_account_by_id(
+            'default', '1000', '39123', '2000'
+        )
+        account, destination_account = accounts
+        assert account['account_tag'] == '1000'
+        assert destination_account['account_tag'] == '2000'
+        account.pop('linked_accounts')
+    assert len(api.queries) == 1
+    await api.rollback_account_transaction('default', '1001', 'tx')
+    await api.get_account_and_destination_account_by_id(
+        'default', '1000', '39123', '2000'
+    )
+    assert len(api.queries) == 3
+    await api.commit_account_transaction('default', '2000', 'tx', 0)
+    await api.get_account_and_destination_account_by_id(
+        'default', '1000', '39123', '2000'
+    )
+    assert len(api.queries) == 5
+    assert api.account_cache.stats()['hit_ratio'] == 0.4
+
+
+def test_transaction_state_cache():
+    cache = TransactionStateCache(ttl=10)
+    cache.put_state('default', '100', dict(source='100'))
+    assert cache.get_state('default', '100') is None
+    cache.put_state(
+        'default', '100', dict(account_tag='1000', source='100', inbound=False)
+    )
+    state = cache.get_state('default', '100')
+    assert state == dict(
+        account_tag='1000',
+        destination_account_tag=None,
+        source='100',
+        source_ip=None,
+        destination=None,
+        carrier_ip=None,
+    )
+    state['account_tag'] = None
+    assert cache.get_state('default', '100')['account_tag'] == '1000'
+    cache.invalidate_state('default', '100')
+    assert cache.get_state('default', '100') is None
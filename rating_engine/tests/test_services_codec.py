@@ -0,0 +1,112 @@
+import json
+import pytest  # type: ignore
+
+from datetime import datetime
+from pytz import timezone
+
+from ..services import codec as codec_service
+
+PAYLOAD = {
+    'request': {
+        'tenant': 'default',
+        'transaction_tag': 'è100',
+        'timestamp_auth': timezone('UTC').localize(datetime(2020, 1, 1, 10, 0, 0)),
+        'tags': ['A', 'B'],
+        'balance': -10,
+        'authorized': True,
+        'carriers': [],
+        'unauthorized_reason': None,
+    }
+}
+
+
+def test_json_codec_is_the_reference_wire_format():
+    codec = codec_service.get_codec('json')
+    data = codec.dumps(PAYLOAD)
+    assert data == json.dumps(
+        PAYLOAD, ensure_ascii=False, default=codec_service.default
+    ).encode('utf-8')
+    assert b'"2020-01-01T10:00:00Z"' in data
+    assert codec.loads(data) == json.loads(data.decode('utf-8'))
+
+
+@pytest.mark.parametrize(
+    'name', sorted(set(codec_service.get_available_codecs()) - {'json'})
+)
+def test_fast_codecs_are_json_compatible(name):
+    codec = codec_service.get_codec(name)
+    reference = codec_service.get_codec('json')
+    data = codec.dumps(PAYLOAD)
+    assert json.loads(data.decode('utf-8')) == reference.loads(reference.dumps(PAYLOAD))
+    assert codec.loads(data) == codec.loads(reference.dumps(PAYLOAD))
+    # values JSON has no type for fall back to the default
+    assert codec.loads(codec.dumps([datetime])) == [repr(datetime)]
+
+
+@pytest.mark.skipif(
+    'orjson' not in codec_service.get_available_codecs(), reason='orjson not installed'
+)
+def test_orjson_codec_converts_datetimes_to_utc():
+    codec = codec_service.get_codec('orjson')
+    reference = codec_service.get_codec('json')
+    value = [timezone('Europe/Rome').localize(datetime(2020, 1, 1, 11, 0, 0, 500))]
+    assert codec.dumps(value) == b'["2020-01-01T10:00:00Z"]'
+    assert codec.dumps(value) == reference.dumps(value)
+
+
+@pytest.mark.parametrize(
+    'name', sorted(set(codec_service.get_available_codecs()) - {'json'})
+)
+def test_fast_codecs_encode_the_bytes_of_the_reference(name):
+    rome = timezone('Europe/Rome')
+    payload = dict(
+        PAYLOAD,
+        running_transactions=[
+            {
+                'timestamp_begin': rome.localize(datetime(2020, 1, 1, 11, 0, 0, 500)),
+                'timestamp_end': None,
+                'fee': 1.5,
+                'tags': ('A',),
+            }
+        ],
+    )
+    # the standard library codec, less the spaces after the separators
+    reference = json.dumps(
+        payload,
+        ensure_ascii=False,
+        separators=(',', ':'),
+        default=codec_service.default,
+    ).encode('utf-8')
+    assert codec_service.get_codec(name).dumps(payload) == reference
+    assert b'"timestamp_begin":"2020-01-01T10:00:00Z"' in reference
+
+
+def test_codec_is_abstract():
+    with pytest.raises(TypeError):
+        codec_service.Codec()
+
+
+def test_get_codec():
+    assert codec_service.get_codec(None).name == 'json'
+    assert codec_service.get_codec('auto').name in codec_service.get_available_codecs()
+    with pytest.raises(ValueError):
+        codec_service.get_codec('unknown')
+
+
+@pytest.mark.parametrize('encoding', codec_service.get_available_compressions())
+def test_compression(encoding):
+    data = codec_service.get_codec('json').dumps(PAYLOAD)
+    compressed = codec_service.compress(data, encoding)
+    assert codec_service.decompress(compressed, encoding) == data
+    with pytest.raises(ValueError):
+        codec_service.decompress(compressed, 'gzip')
+
+
+def test_msgpack_codec():
+    pytest.importorskip('msgpack')
+    codec = codec_service.MsgpackCodec()
+    payload = dict(PAYLOAD['request'], timestamp_begin=datetime(2020, 1, 1, 10, 0, 0))
+    value = codec.loads(codec.dumps(payload))
+    # naive datetimes are taken as UTC
+    assert value == dict(payload, timestamp_begin=payload['timestamp_auth'])
+    assert codec.loads(codec.dumps([datetime])) == [repr(datetime)]
@@ -0,0 +1,285 @@
+import asyncio
+import pytest  # type: ignore
+
+from typing import AbstractSet, List, Optional
+
+from ..schema import engine as schema
+from ..services.cache import TransactionStateCache
+from ..services.engine import EngineService
+
+
+def get_account(account_tag: str, linked_accounts=()) -> dict:
+    return {
+        'account_tag': account_tag,
+        'active': True,
+        'balance': 1000,
+        'tags': [],
+        'destination_rate': None,
+        'running_transactions': [],
+        'linked_accounts': [get_account(tag) for tag in linked_accounts],
+    }
+
+
+class MockedAPI(object):
+    """API answering after a delay, failing the mutations of some accounts"""
+
+    def __init__(
+        self,
+        failing: AbstractSet[tuple] = frozenset(),
+        delay: float = 0.01,
+        batch_mutations: bool = False,
+    ):
+        self.failing = failing
+        self.delay = delay
+        self.batch_mutations = batch_mutations
+        self.calls: List[tuple] = []
+        self.running = 0
+        self.max_running = 0
+
+    async def _call(self, method: str, account_tag: Optional[str], response):
+        self.calls.append((method, account_tag))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        if (method, account_tag) in self.failing:
+            return None
+        return response
+
+    async def get_primary_transactions_by_tenant_and_tag(self, tenant, transaction_tag):
+        return await self._call('restore', None, [])
+
+    async def get_account_and_destination_account_by_id(self, tenant, **kw):
+        return (
+            get_account('1000', linked_accounts=['1001', '1002']),
+            get_account('2000', linked_accounts=['2001']),
+        )
+
+    async def begin_account_transaction(self, tenant, account_tag, **kw):
+        return await self._call(
+            'begin',
+            account_tag,
+            dict(
+                transaction_tag=kw['transaction_tag'],
+                timestamp_begin=kw['timestamp_begin'],
+                timestamp_end=None,
+            ),
+        )
+
+    async def rollback_account_transaction(self, tenant, account_tag, transaction_tag):
+        return await self._call('rollback', account_tag, True)
+
+    async def end_account_transaction(self, tenant, account_tag, **kw):
+        return await self._call(
+            'end',
+            account_tag,
+            dict(
+                transaction_tag=kw['transaction_tag'],
+                timestamp_begin='2020-01-01T10:00:00Z',
+                timestamp_end=None,
+                destination_rate=None,
+                tags=[],
+            ),
+        )
+
+    async def upsert_transaction(self, tenant, account_tag, transaction, *args):
+        return await self._call('upsert', account_tag, True)
+
+    async def commit_account_transaction(self, tenant, account_tag, *args):
+        return await self._call('commit', account_tag, True)
+
+    async def upsert_authorization_transaction(self, tenant, account_tag, transaction):
+        return await self._call('authorization', account_tag, True)
+
+
+def get_record_request() -> schema.RecordTransactionRequest:
+    return schema.RecordTransactionRequest(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        destination_account_tag='2000',
+        destination='393291234567',
+        tags=[],
+    )
+
+
+def get_begin_request() -> schema.BeginTransactionRequest:
+    return schema.BeginTransactionRequest(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        destination_account_tag='2000',
+        destination='393291234567',
+    )
+
+
+@pytest.mark.asyncio
+async def test_begin_transaction_runs_the_accounts_concurrently():
+    api = MockedAPI()
+    engine = EngineService(api, None, max_concurrent_mutations=3)
+    response = await engine.begin_transaction(get_begin_request())
+    assert response == schema.BeginTransactionResponse(ok=True)
+    assert api.calls == [
+        ('begin', tag) for tag in ('1000', '1001', '1002', '2000', '2001')
+    ]
+    assert api.max_running == 3
+
+
+@pytest.mark.asyncio
+async def test_begin_transaction_rolls_back_on_failure():
+    api = MockedAPI(failing={('begin', '1002'), ('begin', '2000')})
+    engine = EngineService(api, None)
+    response = await engine.begin_transaction(get_begin_request())
+    assert response == schema.BeginTransactionResponse(
+        ok=False, failed_account_tag='1002', failed_reason='INTERNAL_ERROR'
+    )
+    assert sorted(tag for method, tag in api.calls if method == 'rollback') == [
+        '1000',
+        '1001',
+        '2001',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_end_transaction_pipelines_the_accounts_concurrently():
+    api = MockedAPI()
+    engine = EngineService(api, None)
+    request = schema.EndTransactionRequest(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        destination_account_tag='2000',
+    )
+    response = await engine.end_transaction(request)
+    assert response == schema.EndTransactionResponse(ok=True)
+    assert api.max_running == 5
+    for account_tag in ('1000', '1001', '1002', '2000', '2001'):
+        assert [method for method, tag in api.calls if tag == account_tag] == [
+            'end',
+            'upsert',
+            'commit',
+        ]
+
+
+@pytest.mark.asyncio
+async def test_end_transaction_reports_the_first_failure():
+    api = MockedAPI(failing={('commit', '1000'), ('upsert', '2001')})
+    engine = EngineService(api, None)
+    request = schema.EndTransactionRequest(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        destination_account_tag='2000',
+    )
+    response = await engine.end_transaction(request)
+    assert response == schema.EndTransactionResponse(
+        ok=False, failed_account_tag='1000', failed_reason='INTERNAL_ERROR'
+    )
+
+
+@pytest.mark.asyncio
+async def test_transaction_state_is_kept_from_begin_to_end():
+    api = MockedAPI(delay=0)
+    engine = EngineService(api, None, transaction_states=TransactionStateCache(ttl=60))
+    response = await engine.begin_transaction(get_begin_request())
+    assert response == schema.BeginTransactionResponse(ok=True)
+    request = schema.EndTransactionRequest(tenant='default', transaction_tag='100')
+    response = await engine.end_transaction(request)
+    assert response == schema.EndTransactionResponse(ok=True)
+    assert request.account_tag == '1000'
+    assert request.destination_account_tag == '2000'
+    assert ('restore', None) not in api.calls
+    # dropped once ended, the primary transactions are looked up again
+    request = schema.EndTransactionRequest(tenant='default', transaction_tag='100')
+    await engine.end_transaction(request)
+    assert ('restore', None) in api.calls
+
+
+@pytest.mark.asyncio
+async def test_transaction_state_is_not_kept_for_unauthorized_transactions():
+    states = TransactionStateCache(ttl=60)
+    engine = EngineService(MockedAPI(delay=0), None, transaction_states=states)
+    request = schema.AuthorizationRequest(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        destination='393291234567',
+    )
+    response = await engine.authorization(request)
+    assert response.unauthorized_reason == 'UNREACHEABLE_DESTINATION'
+    assert states.get_state('default', '100') is None
+
+
+@pytest.mark.asyncio
+async def test_authorization_transactions_are_recorded_at_once():
+    api = MockedAPI(failing={('authorization', '2001')})
+    engine = EngineService(api, None)
+    requests = [
+        schema.AuthorizationTransactionRequest(
+            tenant='default',
+            transaction_tag=str(n),
+            account_tag='100%d' % n,
+            destination_account_tag='200%d' % n,
+            timestamp_auth='2020-01-01T10:00:00Z',
+        )
+        for n in range(3)
+    ]
+    responses = await engine.authorization_transactions(requests)
+    assert responses == [
+        schema.AuthorizationTransactionResponse(ok=True),
+        schema.AuthorizationTransactionResponse(
+            failed_account_tag='2001', failed_reason='INTERNAL_ERROR'
+        ),
+        schema.AuthorizationTransactionResponse(ok=True),
+    ]
+    assert api.max_running == 6
+
+
+@pytest.mark.asyncio
+async def test_record_transaction_stops_at_the_first_failure():
+    api = MockedAPI(failing={('upsert', '1001')})
+    engine = EngineService(api, None)
+    response = await engine.record_transaction(get_record_request())
+    assert response == schema.RecordTransactionResponse(
+        failed_account_tag='1001', failed_reason='INTERNAL_ERROR'
+    )
+    assert api.calls == [('upsert', '1000'), ('upsert', '1001')]
+    assert api.max_running == 1
+
+
+@pytest.mark.asyncio
+async def test_record_transaction_with_batch_mutations_writes_every_account():
+    api = MockedAPI(failing={('upsert', '1001')}, batch_mutations=True)
+    engine = EngineService(api, None)
+    response = await engine.record_transaction(get_record_request())
+    assert response == schema.RecordTransactionResponse(
+        failed_account_tag='1001', failed_reason='INTERNAL_ERROR'
+    )
+    # sent at once, the accounts other than the failing one are written
+    assert api.calls == [
+        ('upsert', tag) for tag in ('1000', '1001', '1002', '2000', '2001')
+    ]
+
+
+class FailingBus(object):
+    async def rpc_call_async(self, *args, **kw):
+        raise ConnectionError()
+
+
+@pytest.mark.asyncio
+async def test_authorization_transactions_are_written_when_the_bus_fails():
+    api = MockedAPI(delay=0)
+    engine = EngineService(api, FailingBus(), authorization_batch_size=10)
+    engine.authorization_records.retry_delay = 0.001
+    request = schema.AuthorizationTransactionRequest(
+        tenant='default',
+        transaction_tag='100',
+        account_tag='1000',
+        destination_account_tag='2000',
+        timestamp_auth='2020-01-01T10:00:00Z',
+    )
+    engine.authorization_records.add(request.dict())
+    await engine.close()
+    assert api.calls == [('authorization', '1000'), ('authorization', '2000')]
+    assert engine.authorization_records.stats()['fallbacks'] == 1
+    assert engine.authorization_records.stats()['errors'] == 0
@@ -1,9 +1,20 @@
 import unittest
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil import parser
+from math import ceil
 from pytz import timezone
 
-from rating_engine.services.rater import RaterService
+from rating_engine.enums import RateBandType
+from rating_engine.services.rater import (
+    RatePlan,
+    RaterService,
+    _get_breakpoints,
+    _rate_columns_numpy,
+    _rate_columns_python,
+    np,
+    parse_timestamp,
+)
 
 
 class ServicesRaterTest(unittest.TestCase):
@@ -184,3 +195,308 @@ class ServicesRaterTest(unittest.TestCase):
         }
         fee = self.service.get_transaction_fee(transaction=transaction)
         self.assertEqual(0, fee)
+
+    def test_rater_batch_matches_single_transaction(self):
+        begin = self.tz.localize(datetime(2019, 1, 1, 10, 0, 0))
+        cases = [
+            # (seconds, microseconds, connect_fee, rate, rate_increment, interval_start)
+            (90, 0, 0, 1, 1, 0),
+            (90, 0, 0, 1, 1, 30),
+            (90, 0, 0, 100, 60, 0),
+            (90, 0, 0, 100, 60, 1),
+            (90, 0, 100, 100, 60, 0),
+            (30, 0, 0, 100, 60, 2),
+            (30, 250000, 10, 3, 1, 0),
+            (59, 999999, 0, 100, 60, 0),
+            (0, 1, 5, 1, 0, 0),
+            (0, 0, 5, 1, 1, 0),
+            (-30, 0, 5, 1, 1, 0),
+        ]
+        transactions = [
+            {
+                'timestamp_begin': begin,
+                'timestamp_end': begin
+                + timedelta(seconds=case[0], microseconds=case[1]),
+                'destination_rate': {
+                    'connect_fee': case[2],
+                    'rate': case[3],
+                    'rate_increment': case[4],
+                    'interval_start': case[5],
+                },
+            }
+            for case in cases
+        ]
+        expected = [
+            self.service.get_transaction_fee_and_duration(transaction)
+            for transaction in transactions
+        ]
+        columns = (
+            [tx['timestamp_begin'].timestamp() for tx in transactions],
+            [tx['timestamp_end'].timestamp() for tx in transactions],
+            [case[2] for case in cases],
+            [case[3] for case in cases],
+            [case[4] for case in cases],
+            [case[5] for case in cases],
+        )
+        for rate_columns in (
+            self.service.get_transactions_fees_and_durations,
+            _rate_columns_python,
+        ):
+            fees, durations = rate_columns(*columns)
+            self.assertEqual(expected, list(zip(fees, durations)))
+        if np is not None:
+            fees, durations = _rate_columns_numpy(*columns)
+            self.assertEqual(expected, list(zip(fees.tolist(), durations.tolist())))
+            # large batches go through NumPy
+            size = self.service.NUMPY_MIN_TRANSACTIONS // len(cases) + 1
+            fees, durations = self.service.get_transactions_fees_and_durations(
+                *(column * size for column in columns)
+            )
+            self.assertEqual(expected * size, list(zip(fees, durations)))
+        self.assertEqual(
+            sum(fee for fee, _ in expected),
+            self.service.get_transactions_fee(transactions),
+        )
+
+    def test_rater_batch_with_no_transactions(self):
+        self.assertEqual(0, self.service.get_transactions_fee([]))
+
+    def test_rate_plan_is_interned_and_hashable(self):
+        destination_rate = {
+            'carrier_tag': 'CARRIER',
+            'pricelist_tag': 'DEFAULT',
+            'prefix': '39',
+            'description': 'Italy',
+            'connect_fee': 100,
+            'rate': 100,
+            'rate_increment': 60,
+            'interval_start': 0,
+        }
+        rate_plan = RatePlan.from_destination_rate(destination_rate)
+        self.assertIs(rate_plan, RatePlan.from_destination_rate(dict(destination_rate)))
+        self.assertIs(rate_plan, RatePlan.from_destination_rate(rate_plan))
+        self.assertEqual({rate_plan: 1}[RatePlan(**destination_rate)], 1)
+        self.assertIsNone(RatePlan.from_destination_rate(None))
+        self.assertIsNone(RatePlan.from_destination_rate({}))
+
+    def test_rater_with_rate_plan(self):
+        rate_plan = RatePlan.from_destination_rate(
+            {'connect_fee': 100, 'rate': 100, 'rate_increment': 60}
+        )
+        transaction = {
+            'timestamp_begin': self.tz.localize(datetime(2019, 1, 1, 10, 0, 0)),
+            'timestamp_end': self.tz.localize(datetime(2019, 1, 1, 10, 1, 30)),
+            'destination_rate': rate_plan,
+        }
+        self.assertEqual(300, self.service.get_transaction_fee(transaction))
+        self.assertEqual(
+            (True, 540),
+            self.service.get_maximum_allowed_units_for_transaction(1000, rate_plan),
+        )
+
+    def test_parse_timestamp(self):
+        for value in (
+            '2020-01-01T00:00:00Z',
+            '2020-02-29T23:59:59Z',
+            '2020-01-01T00:00:00.250000Z',
+            '2020-01-01T01:00:00+01:00',
+            '2020-13-01T00:00:00Z',
+        ):
+            try:
+                expected = parser.parse(value)
+            except ValueError:
+                self.assertRaises(ValueError, parse_timestamp, value)
+                continue
+            self.assertEqual(expected, parse_timestamp(value))
+            self.assertEqual(expected.utcoffset(), parse_timestamp(value).utcoffset())
+
+    def get_banded_fee_by_second(self, rate_plan, duration, time_of_day=0):
+        increment = rate_plan.rate_increment or 1
+        free = rate_plan.interval_start * increment
+        if duration <= free:
+            return rate_plan.connect_fee
+        bands = sorted(rate_plan.bands)
+        fee = rate_plan.connect_fee
+        run: list = []
+        for second in range(free, duration):
+            if rate_plan.bands_type == RateBandType.TIME_OF_DAY:
+                position = (time_of_day + second) % 86400
+            else:
+                position = second
+            band = (0, rate_plan.rate, increment)
+            for start, rate, rate_increment in bands:
+                if start <= position:
+                    band = (start, rate, rate_increment or 1)
+            if run and run[0] != band:
+                fee += ceil(len(run) / run[0][2]) * run[0][1]
+                run = []
+            run.append(band)
+        return fee + ceil(len(run) / run[0][2]) * run[0][1]
+
+    def test_rate_plan_with_duration_bands(self):
+        rate_plan = RatePlan.from_destination_rate(
+            {
+                'connect_fee': 10,
+                'rate': 3,
+                'rate_increment': 30,
+                'interval_start': 1,
+                'bands': [
+                    {'start': 600, 'rate': 2, 'rate_increment': 60},
+                    {'start': 120, 'rate': 1, 'rate_increment': 7},
+                ],
+            }
+        )
+        self.assertEqual(((120, 1, 7), (600, 2, 60)), rate_plan.bands)
+        for duration in range(0, 1500, 7):
+            self.assertEqual(
+                self.get_banded_fee_by_second(rate_plan, duration),
+                rate_plan.get_fee(duration),
+            )
+        for balance in range(-5, 300, 3):
+            _, allowed_units = rate_plan.get_maximum_allowed_units(balance, 1000)
+            expected = 0
+            if balance >= rate_plan.connect_fee:
+                expected = max(
+                    units
+                    for units in range(30, 1001)
+                    if rate_plan.get_fee(units) <= balance
+                )
+            self.assertEqual(expected, allowed_units)
+
+    def test_rate_plan_with_time_of_day_bands(self):
+        rate_plan = RatePlan.from_destination_rate(
+            {
+                'connect_fee': 0,
+                'rate': 1,
+                'rate_increment': 60,
+                'bands': [
+                    {'start': 8 * 3600, 'rate': 5, 'rate_increment': 60},
+                    {'start': 20 * 3600, 'rate': 2, 'rate_increment': 1},
+                ],
+                'bands_type': 'TIME_OF_DAY',
+            }
+        )
+        for time_of_day in (0, 8 * 3600 - 90, 20 * 3600 - 1, 86400 - 30):
+            for duration in range(0, 400, 7):
+                self.assertEqual(
+                    self.get_banded_fee_by_second(rate_plan, duration, time_of_day),
+                    rate_plan.get_fee(duration, time_of_day),
+                )
+            for balance in (0, 1, 4, 5, 6, 20, 101):
+                _, allowed_units = rate_plan.get_maximum_allowed_units(
+                    balance, 600, time_of_day
+                )
+                self.assertEqual(
+                    max(
+                        units
+                        for units in range(0, 601)
+                        if rate_plan.get_fee(units, time_of_day) <= balance
+                    ),
+                    allowed_units,
+                )
+        # 7:59 to 8:01, one minute off-peak and one minute peak
+        transaction = {
+            'timestamp_begin': self.tz.localize(datetime(2019, 1, 1, 7, 59, 0)),
+            'timestamp_end': self.tz.localize(datetime(2019, 1, 1, 8, 1, 0)),
+            'destination_rate': rate_plan,
+        }
+        self.assertEqual(6, self.service.get_transaction_fee(transaction))
+        self.assertEqual(6, self.service.get_transactions_fee([transaction]))
+        self.assertEqual(
+            (True, 60 + 60),
+            self.service.get_maximum_allowed_units_for_transaction(
+                6, rate_plan, transaction['timestamp_begin']
+            ),
+        )
+
+    def test_rate_plan_time_of_day_breakpoints_per_rate_plan(self):
+        rate_plan = RatePlan.from_destination_rate(
+            {
+                'rate': 1,
+                'rate_increment': 60,
+                'bands': [{'start': 8 * 3600, 'rate': 5, 'rate_increment': 60}],
+                'bands_type': 'TIME_OF_DAY',
+            }
+        )
+        before = _get_breakpoints.cache_info()
+        for time_of_day in range(0, 86400, 900):
+            rate_plan.get_maximum_allowed_units(1000, 86400 * 3, time_of_day)
+        after = _get_breakpoints.cache_info()
+        self.assertEqual(before.misses + 1, after.misses)
+
+    def test_rater_get_maximum_allowed_units_for_transaction_is_memoized(self):
+        rate_plan = RatePlan(connect_fee=7, rate=3, rate_increment=60)
+        uncached = rate_plan.get_maximum_allowed_units(
+            1000, self.service.MAX_UNITS_FOR_TRANSACTIONS
+        )
+        before = self.service.get_maximum_allowed_units_cache_info()
+        for _ in range(3):
+            self.assertEqual(
+                uncached,
+                self.service.get_maximum_allowed_units_for_transaction(1000, rate_plan),
+            )
+        after = self.service.get_maximum_allowed_units_cache_info()
+        self.assertEqual(before.misses + 1, after.misses)
+        self.assertEqual(before.hits + 2, after.hits)
+
+    def test_rater_get_maximum_allowed_units_for_transaction_time_of_day(self):
+        rate_plan = RatePlan.from_destination_rate(
+            {
+                'rate': 1,
+                'rate_increment': 60,
+                'bands': [{'start': 8 * 3600, 'rate': 5, 'rate_increment': 60}],
+                'bands_type': 'TIME_OF_DAY',
+            }
+        )
+        before = self.service.get_maximum_allowed_units_stats()
+        for second in range(0, 120, 7):
+            timestamp_begin = self.tz.localize(datetime(2019, 1, 1, 7, 58, 0))
+            timestamp_begin += timedelta(seconds=second)
+            self.assertEqual(
+                rate_plan.get_maximum_allowed_units(
+                    6,
+                    self.service.MAX_UNITS_FOR_TRANSACTIONS,
+                    self.service.get_time_of_day(timestamp_begin),
+                ),
+                self.service.get_maximum_allowed_units_for_transaction(
+                    6, rate_plan, timestamp_begin
+                ),
+            )
+        after = self.service.get_maximum_allowed_units_stats()
+        self.assertEqual(before['hits'], after['hits'])
+        self.assertEqual(before['misses'], after['misses'])
+
+    def test_rater_get_maximum_allowed_units_stats(self):
+        rate_plan = RatePlan(connect_fee=11, rate=3, rate_increment=60)
+        before = self.service.get_maximum_allowed_units_stats()
+        for _ in range(4):
+            self.service.get_maximum_allowed_units_for_transaction(1000, rate_plan)
+        stats = self.service.get_maximum_allowed_units_stats()
+        self.assertEqual(before['misses'] + 1, stats['misses'])
+        self.assertEqual(before['hits'] + 3, stats['hits'])
+        self.assertLessEqual(1, stats['size'])
+        self.assertEqual(
+            round(stats['hits'] / (stats['hits'] + stats['misses']), 4),
+            stats['hit_ratio'],
+        )
+
+    def test_rater_get_maximum_allowed_units_for_transaction_with_zero_rate(self):
+        before = self.service.get_maximum_allowed_units_cache_info()
+        for balance, connect_fee, authorized in ((0, 0, True), (0, 1, False)):
+            rate_plan = RatePlan(connect_fee=connect_fee, rate=0, rate_increment=60)
+            self.assertEqual(
+                rate_plan.get_maximum_allowed_units(
+                    balance, self.service.MAX_UNITS_FOR_TRANSACTIONS
+                ),
+                self.service.get_maximum_allowed_units_for_transaction(
+                    balance, rate_plan
+                ),
+            )
+            self.assertEqual(
+                (authorized, self.service.MAX_UNITS_FOR_TRANSACTIONS),
+                self.service.get_maximum_allowed_units_for_transaction(
+                    balance, rate_plan
+                ),
+            )
+        after = self.service.get_maximum_allowed_units_cache_info()
+        self.assertEqual(before.hits + before.misses, after.hits + after.misses)
@@ -0,0 +1,36 @@
+import os
+import signal
+import threading
+import time
+
+from ..supervisor import Supervisor
+
+
+def exit_at_once():
+    os._exit(1)
+
+
+def sleep_until_terminated():
+    signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+    time.sleep(60)
+
+
+def test_supervisor_restarts_the_workers():
+    supervisor = Supervisor(
+        exit_at_once, workers=2, restart_delay=0.01, max_restart_delay=0.04
+    )
+    threading.Timer(0.5, supervisor.stop).start()
+    assert supervisor.run() == 0
+    assert supervisor.restarts >= 4
+    # the delay doubled, up to max_restart_delay, as the workers failed early
+    assert supervisor._delays == [0.04, 0.04]
+
+
+def test_supervisor_stops_the_workers():
+    supervisor = Supervisor(sleep_until_terminated, workers=2, shutdown_timeout=5)
+    threading.Timer(0.3, supervisor.stop).start()
+    started = time.monotonic()
+    assert supervisor.run() == 0
+    assert time.monotonic() - started < 5
+    assert supervisor.restarts == 0
+    assert not any(supervisor._processes[slot].is_alive() for slot in range(2))
@@ -27,6 +27,12 @@ setup(
         "python-dateutil",
         "pytz",
     ],
+    extras_require={
+        "numpy": ["numpy"],
+        "uvloop": ["uvloop"],
+        "msgpack": ["msgpack>=1.0"],
+        "zstd": ["zstandard"],
+    },
     packages=find_packages(exclude=("tests")),
     classifiers=[
         "Programming Language :: Python :: 3",